@@ -1,22 +1,37 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks, Request, Header, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool as starlette_run_in_threadpool
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Optional, Dict, Any
 import os
-import shutil
+import json
+import time
+import asyncio
 import logging
 from pathlib import Path
 
 from config import Config
 from document_processor import DocumentProcessor
-from vector_store import VectorStore
+from vector_store import CollectionNotFoundError, VectorStore, normalize_collection_name
 from qa_engine import QAEngine
+from reranker import get_reranker
+from upload_store import UploadStore, UploadTooLargeError
+from metrics import REGISTRY, HTTP_SECONDS
+from token_usage import USAGE_DIMENSIONS, get_usage_store, usage_scope
+from llm_router import get_router
+from shared_state import get_shared_store
+from tracing import span, parse_traceparent, format_traceparent
+import profiling
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+async def run_in_threadpool(func, *args, **kwargs):
+    """在线程池中执行同步函数；请求开启单请求剖析时在执行线程中一并记录"""
+    return await starlette_run_in_threadpool(profiling.profiled(func), *args, **kwargs)
+
 # 创建FastAPI应用
 app = FastAPI(
     title="知识库大模型API",
@@ -33,35 +48,231 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# 多进程部署（serve.py 启动多个工作进程）时，工作进程只读索引，写操作提交给入库进程
+READ_ONLY_INDEX = Config.API_WORKERS > 1
+
 # 初始化组件
-vector_store = VectorStore()
+vector_store = VectorStore(read_only=READ_ONLY_INDEX)
 document_processor = DocumentProcessor(
     chunk_size=Config.CHUNK_SIZE,
     chunk_overlap=Config.CHUNK_OVERLAP
 )
 qa_engine = QAEngine(vector_store)
+upload_store = UploadStore()
+
+# 启用重排序时预加载交叉编码器，避免首个请求承担模型加载耗时
+if Config.RERANK_ENABLED:
+    get_reranker().warmup()
+
+# PROFILE_SAMPLING 开启时从启动起持续采样，否则可通过 /admin/profiling 接口按需开关
+profiling.start_from_env("api")
 
 # 确保上传目录存在
 os.makedirs(Config.UPLOAD_DIR, exist_ok=True)
 
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """请求体声明的大小超过上传上限时，在读取请求体之前直接拒绝"""
+    if request.url.path == "/upload":
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and \
+                int(content_length) > Config.MAX_UPLOAD_REQUEST_SIZE * 1024 * 1024:
+            return JSONResponse(
+                status_code=413,
+                content={"detail": f"上传内容超过 {Config.MAX_UPLOAD_REQUEST_SIZE} MB 上限"}
+            )
+    return await call_next(request)
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """按路由模板记录请求耗时（而非实际路径，避免 /sources/{chunk_id} 等产生大量标签）"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_SECONDS.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=str(status)
+        )
+
+@app.middleware("http")
+async def profile_request(request: Request, call_next):
+    """携带剖析请求头和管理令牌的请求用 cProfile 单独记录，结果文件名放在响应头 X-Profile-File 中"""
+    if not profiling.wants_request_profile(request.headers):
+        return await call_next(request)
+    
+    profiler = profiling.RequestProfiler(f"{request.method} {request.url.path}")
+    if not profiler.start():
+        response = await call_next(request)
+        response.headers["X-Profile-Status"] = "busy"
+        return response
+    try:
+        response = await call_next(request)
+    finally:
+        path = profiler.stop()
+    response.headers["X-Profile-File"] = os.path.basename(path)
+    return response
+
+@app.middleware("http")
+async def trace_request(request: Request, call_next):
+    """为每个请求创建根 span（沿用上游 traceparent），并在响应头中返回 trace 信息"""
+    remote_parent = parse_traceparent(request.headers.get("traceparent"))
+    with span(f"{request.method} {request.url.path}", kind="server", remote_parent=remote_parent,
+              **{"http.method": request.method, "http.target": request.url.path}) as current:
+        response = await call_next(request)
+        route = request.scope.get("route")
+        if route is not None:
+            current.name = f"{request.method} {route.path}"
+        current.set_attribute("http.status_code", response.status_code)
+        if response.status_code >= 500:
+            current.status = "error"
+        response.headers["traceparent"] = format_traceparent(current)
+        response.headers["X-Trace-Id"] = current.trace_id
+        return response
+
 # Pydantic模型
 class QuestionRequest(BaseModel):
     question: str
+    collection: Optional[str] = None
+    filter: Optional[Dict[str, Any]] = None
+    # 检索参数（为空时使用 Config 中的默认值）
+    strategy: Optional[str] = None
+    k: Optional[int] = None
+    score_threshold: Optional[float] = None
+    max_context_tokens: Optional[int] = None
+    rerank: Optional[bool] = None
+    # 无状态调用方设为 False，可跳过基于对话历史的问题改写
+    use_history: bool = True
+    # 会话标识：按会话保存对话历史（多个工作进程共享）并统计大模型用量
+    session_id: Optional[str] = None
 
 class QuestionResponse(BaseModel):
     answer: str
     sources: List[dict]
     question: str
+    # 本次请求的大模型用量：calls / prompt_tokens / completion_tokens / total_tokens / cost / estimated
+    usage: Optional[Dict[str, Any]] = None
+
+class BatchQuestionRequest(BaseModel):
+    questions: List[str]
+    collection: Optional[str] = None
+    filter: Optional[Dict[str, Any]] = None
+    strategy: Optional[str] = None
+    k: Optional[int] = None
+    score_threshold: Optional[float] = None
+    max_context_tokens: Optional[int] = None
+    rerank: Optional[bool] = None
+    max_concurrency: Optional[int] = None
+    session_id: Optional[str] = None
+
+class BatchAnswer(BaseModel):
+    question: str
+    answer: Optional[str] = None
+    sources: List[dict] = []
+    error: Optional[str] = None
+
+class BatchQuestionResponse(BaseModel):
+    results: List[BatchAnswer]
+    total: int
+    failed: int
+    usage: Optional[Dict[str, Any]] = None
 
 class UploadResponse(BaseModel):
     message: str
     processed_files: List[str]
     total_chunks: int
+    collection: Optional[str] = None
+    # 多进程部署时的入库任务ID，等待超时仍未完成时可通过 /ingest/jobs/{job_id} 查询
+    job_ids: List[str] = []
+
+class ProfilingStartRequest(BaseModel):
+    interval_ms: Optional[float] = None
+    # 到时自动停止，为空时需手动调用停止接口
+    duration_s: Optional[float] = None
 
 class StatsResponse(BaseModel):
     total_documents: int
     persist_directory: str
     embedding_model: str
+    collection: Optional[str] = None
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """管理接口校验：请求头 X-Admin-Token 须与 ADMIN_TOKEN 一致"""
+    if not Config.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="未配置 ADMIN_TOKEN，管理接口不可用")
+    if not profiling.check_admin_token(x_admin_token):
+        raise HTTPException(status_code=401, detail="管理令牌无效")
+
+async def run_ingest_job(kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+    """提交单个入库任务并等待完成，返回值同 wait_for_ingest_jobs"""
+    store = get_shared_store()
+    job_id = await run_in_threadpool(store.enqueue_job, kind, payload)
+    return await wait_for_ingest_jobs([job_id])
+
+async def wait_for_ingest_jobs(job_ids: List[str]) -> Dict[str, Any]:
+    """
+    等待一组入库任务完成（最长 INGEST_WAIT_TIMEOUT 秒）
+    
+    返回 {"total_chunks": 已完成任务的文档块合计, "pending": 超时仍未完成的任务ID}；任一任务失败时返回 500
+    """
+    store = get_shared_store()
+    deadline = time.monotonic() + Config.INGEST_WAIT_TIMEOUT
+    pending = list(job_ids)
+    total_chunks = 0
+    while pending:
+        for job_id in list(pending):
+            job = await run_in_threadpool(store.get_job, job_id)
+            if job["status"] == "failed":
+                raise HTTPException(status_code=500, detail=f"入库任务 {job_id} 失败: {job['error']}")
+            if job["status"] == "done":
+                total_chunks += (job["result"] or {}).get("total_chunks", 0)
+                pending.remove(job_id)
+        if not pending or time.monotonic() >= deadline:
+            break
+        await asyncio.sleep(Config.INGEST_POLL_INTERVAL)
+    if pending:
+        logger.warning(f"等待入库任务超时，仍有 {len(pending)} 个任务未完成")
+    return {"total_chunks": total_chunks, "pending": pending}
+
+def parse_metadata_form(metadata: Optional[str]) -> Optional[Dict[str, Any]]:
+    """解析表单中JSON格式的元数据字段"""
+    if not metadata:
+        return None
+    try:
+        value = json.loads(metadata)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="metadata 必须是合法的JSON对象")
+    if not isinstance(value, dict):
+        raise HTTPException(status_code=400, detail="metadata 必须是合法的JSON对象")
+    # 向量库的元数据只支持字符串、数字和布尔值，列表、对象或 null 会导致写入失败
+    invalid = [key for key, item in value.items() if not isinstance(item, (str, int, float, bool))]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"metadata 的值只能是字符串、数字或布尔值: {', '.join(invalid)}")
+    if "doc_id" in value:
+        raise HTTPException(status_code=400, detail="doc_id 请通过 doc_ids 字段按文件指定")
+    return value
+
+def parse_doc_ids_form(doc_ids: Optional[str], file_count: int) -> List[Optional[str]]:
+    """解析表单中按文件顺序给出的文档ID列表（JSON数组，元素为字符串或 null），未提供时均为 None"""
+    if not doc_ids:
+        return [None] * file_count
+    try:
+        value = json.loads(doc_ids)
+    except json.JSONDecodeError:
+        value = None
+    if not isinstance(value, list) or len(value) != file_count or \
+            not all(item is None or (isinstance(item, str) and item) for item in value):
+        raise HTTPException(status_code=400, detail="doc_ids 必须是与上传文件一一对应的字符串数组")
+    given = [item for item in value if item]
+    if len(given) != len(set(given)):
+        raise HTTPException(status_code=400, detail="doc_ids 不能重复")
+    return value
 
 @app.get("/")
 async def root():
@@ -74,51 +285,99 @@ async def health_check():
     return {"status": "healthy", "service": "知识库大模型API"}
 
 @app.post("/upload", response_model=UploadResponse)
-async def upload_documents(background_tasks: BackgroundTasks, files: List[UploadFile] = File(...)):
-    """上传文档"""
+async def upload_documents(
+    background_tasks: BackgroundTasks,
+    files: List[UploadFile] = File(...),
+    collection: Optional[str] = Form(None),
+    metadata: Optional[str] = Form(None),
+    doc_ids: Optional[str] = Form(None)
+):
+    """
+    上传文档（可指定目标集合，metadata 为附加到每个文档块的JSON元数据）
+    
+    doc_ids 为与上传文件一一对应的文档ID（JSON数组）：指定后，集合中同一文档ID的旧版本块会被新内容替换；
+    未指定时只新增，不会删除同名文件已有的块
+    
+    文件按块写入以内容哈希命名的存储路径，全部保存完成后才开始入库，任一文件超过 MAX_FILE_SIZE 时返回 413；
+    解析和向量化在线程池中执行，不阻塞事件循环。多进程部署时交给入库进程执行，
+    最多等待 INGEST_WAIT_TIMEOUT 秒，超时后返回任务ID
+    """
+    extra_metadata = parse_metadata_form(metadata)
+    file_doc_ids = parse_doc_ids_form(doc_ids, len(files))
     try:
         processed_files = []
         total_chunks = 0
+        job_ids = []
         
-        for file in files:
+        # 先保存并检查全部文件，任一文件超过大小限制时整个请求返回 413，不会只入库前面的文件
+        stored_files = []
+        for file, doc_id in zip(files, file_doc_ids):
             # 检查文件格式
-            file_extension = Path(file.filename).suffix.lower()
+            file_extension = Path(file.filename or "").suffix.lower()
             if file_extension not in Config.SUPPORTED_FORMATS:
                 continue
+            stored_files.append((await upload_store.save(file), doc_id))
+        
+        for stored, doc_id in stored_files:
+            processed_files.append(stored.file_name)
             
-            # 保存文件
-            file_path = os.path.join(Config.UPLOAD_DIR, file.filename)
-            with open(file_path, "wb") as buffer:
-                shutil.copyfileobj(file.file, buffer)
-            
-            processed_files.append(file.filename)
-            
-            # 处理文档
-            chunks = document_processor.process_file(file_path)
+            # 处理文档：存储路径按内容命名，原始文件名和哈希作为元数据保留
+            file_metadata = dict(extra_metadata or {})
+            file_metadata.update({"file_name": stored.file_name, "content_sha256": stored.sha256})
+            if doc_id:
+                file_metadata["doc_id"] = doc_id
+            if READ_ONLY_INDEX:
+                job_ids.append(await run_in_threadpool(
+                    get_shared_store().enqueue_job, "file",
+                    {"path": stored.path, "metadata": file_metadata, "collection": collection}
+                ))
+                continue
+            chunks = await run_in_threadpool(document_processor.process_file, stored.path, file_metadata)
             if chunks:
-                vector_store.add_documents(chunks)
+                await run_in_threadpool(vector_store.add_documents, chunks, collection)
                 total_chunks += len(chunks)
         
+        message = f"成功处理 {len(processed_files)} 个文件"
+        if job_ids:
+            outcome = await wait_for_ingest_jobs(job_ids)
+            total_chunks = outcome["total_chunks"]
+            if outcome["pending"]:
+                message = f"已接收 {len(processed_files)} 个文件，{len(outcome['pending'])} 个仍在处理中"
+        
         return UploadResponse(
-            message=f"成功处理 {len(processed_files)} 个文件",
+            message=message,
             processed_files=processed_files,
-            total_chunks=total_chunks
+            total_chunks=total_chunks,
+            collection=collection,
+            job_ids=job_ids
         )
     
+    except UploadTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"上传文档失败: {e}")
         raise HTTPException(status_code=500, detail=f"上传文档失败: {str(e)}")
 
 @app.post("/upload-directory")
-async def upload_directory(directory_path: str):
+async def upload_directory(directory_path: str, collection: Optional[str] = None):
     """上传整个目录的文档"""
     try:
         if not os.path.exists(directory_path):
             raise HTTPException(status_code=400, detail="目录不存在")
         
+        if READ_ONLY_INDEX:
+            outcome = await run_ingest_job("directory", {"path": os.path.abspath(directory_path),
+                                                         "collection": collection})
+            if outcome["pending"]:
+                return {"message": f"目录 {directory_path} 仍在处理中", "total_chunks": 0,
+                        "job_ids": outcome["pending"]}
+            return {"message": f"成功处理目录: {directory_path}", "total_chunks": outcome["total_chunks"]}
+        
         chunks = document_processor.process_directory(directory_path)
         if chunks:
-            vector_store.add_documents(chunks)
+            vector_store.add_documents(chunks, collection_name=collection)
         
         return {
             "message": f"成功处理目录: {directory_path}",
@@ -131,37 +390,130 @@ async def upload_directory(directory_path: str):
 
 @app.post("/ask", response_model=QuestionResponse)
 async def ask_question(request: QuestionRequest):
-    """提问"""
+    """提问（问答在线程池中执行，排队等待限流或 429 退避时不阻塞事件循环）"""
+    def run_question():
+        with usage_scope(endpoint="/ask", session_id=request.session_id) as usage:
+            response = qa_engine.ask_question(
+                request.question,
+                collection_name=request.collection,
+                metadata_filter=request.filter,
+                retrieval_options={
+                    "strategy": request.strategy,
+                    "k": request.k,
+                    "score_threshold": request.score_threshold,
+                    "max_context_tokens": request.max_context_tokens,
+                    "rerank": request.rerank
+                },
+                use_history=request.use_history,
+                session_id=request.session_id
+            )
+        return response, usage.summary()
+    
     try:
         if not request.question.strip():
             raise HTTPException(status_code=400, detail="问题不能为空")
         
-        response = qa_engine.ask_question(request.question)
-        return QuestionResponse(**response)
+        response, usage = await run_in_threadpool(run_question)
+        return QuestionResponse(**response, usage=usage)
     
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         logger.error(f"提问失败: {e}")
         raise HTTPException(status_code=500, detail=f"提问失败: {str(e)}")
 
+@app.post("/ask/batch", response_model=BatchQuestionResponse)
+async def ask_batch(request: BatchQuestionRequest):
+    """批量提问：结果与问题顺序一致，单题失败不影响其他题目"""
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="问题列表不能为空")
+    if len(request.questions) > Config.BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"单次最多提交 {Config.BATCH_MAX_QUESTIONS} 个问题")
+    
+    def run_batch():
+        # 在工作线程内设置用量上下文
+        with usage_scope(endpoint="/ask/batch", session_id=request.session_id) as usage:
+            results = qa_engine.ask_batch(
+                request.questions,
+                collection_name=request.collection,
+                metadata_filter=request.filter,
+                retrieval_options={
+                    "strategy": request.strategy,
+                    "k": request.k,
+                    "score_threshold": request.score_threshold,
+                    "max_context_tokens": request.max_context_tokens,
+                    "rerank": request.rerank
+                },
+                max_concurrency=request.max_concurrency
+            )
+        return results, usage.summary()
+    
+    try:
+        results, usage = await run_in_threadpool(run_batch)
+        return BatchQuestionResponse(
+            results=[BatchAnswer(**item) for item in results],
+            total=len(results),
+            failed=sum(1 for item in results if item["error"]),
+            usage=usage
+        )
+    
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        logger.error(f"批量提问失败: {e}")
+        raise HTTPException(status_code=500, detail=f"批量提问失败: {str(e)}")
+
 @app.get("/search")
-async def search_documents(query: str, k: int = 4):
-    """搜索相关文档"""
+async def search_documents(
+    query: str,
+    k: int = 4,
+    collection: Optional[str] = None,
+    file_type: Optional[str] = None,
+    file_name: Optional[str] = None,
+    source: Optional[str] = None,
+    strategy: str = "similarity",
+    fetch_k: Optional[int] = None,
+    lambda_mult: Optional[float] = None,
+    score_threshold: Optional[float] = None,
+    max_tokens: Optional[int] = None,
+    rerank: Optional[bool] = None,
+    rerank_top_n: Optional[int] = None
+):
+    """
+    搜索相关文档（可限定集合并按文件类型/文件名/来源过滤）
+    
+    strategy 可选 similarity / mmr / threshold；score_threshold 为最低相关度，
+    max_tokens 为返回结果的累计token预算；rerank 为是否使用交叉编码器重排序
+    """
     try:
         if not query.strip():
             raise HTTPException(status_code=400, detail="搜索查询不能为空")
         
-        results = qa_engine.search_documents(query, k)
-        return {"query": query, "results": results}
+        metadata_filter = {"file_type": file_type, "file_name": file_name, "source": source}
+        results = await run_in_threadpool(
+            qa_engine.search_documents,
+            query, k, collection_name=collection, metadata_filter=metadata_filter,
+            strategy=strategy, fetch_k=fetch_k, lambda_mult=lambda_mult,
+            score_threshold=score_threshold, max_context_tokens=max_tokens,
+            rerank=rerank, rerank_top_n=rerank_top_n
+        )
+        return {"query": query, "collection": collection, "strategy": strategy, "results": results}
     
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"搜索文档失败: {e}")
         raise HTTPException(status_code=500, detail=f"搜索文档失败: {str(e)}")
 
 @app.get("/chat-history")
-async def get_chat_history():
-    """获取对话历史"""
+async def get_chat_history(session_id: Optional[str] = None):
+    """获取对话历史（session_id 为空时为默认对话）"""
     try:
-        history = qa_engine.get_chat_history()
+        history = await run_in_threadpool(qa_engine.get_chat_history, session_id)
         return {"history": history}
     
     except Exception as e:
@@ -169,10 +521,10 @@ async def get_chat_history():
         raise HTTPException(status_code=500, detail=f"获取对话历史失败: {str(e)}")
 
 @app.delete("/chat-history")
-async def clear_chat_history():
-    """清除对话历史"""
+async def clear_chat_history(session_id: Optional[str] = None):
+    """清除对话历史（session_id 为空时为默认对话）"""
     try:
-        success = qa_engine.clear_memory()
+        success = await run_in_threadpool(qa_engine.clear_memory, session_id)
         if success:
             return {"message": "对话历史已清除"}
         else:
@@ -183,20 +535,145 @@ async def clear_chat_history():
         raise HTTPException(status_code=500, detail=f"清除对话历史失败: {str(e)}")
 
 @app.get("/stats", response_model=StatsResponse)
-async def get_stats():
+async def get_stats(collection: Optional[str] = None):
     """获取系统统计信息"""
     try:
-        stats = vector_store.get_collection_stats()
+        stats = await run_in_threadpool(vector_store.get_collection_stats, collection)
         return StatsResponse(**stats)
     
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except Exception as e:
         logger.error(f"获取统计信息失败: {e}")
         raise HTTPException(status_code=500, detail=f"获取统计信息失败: {str(e)}")
 
+@app.get("/ingest/jobs/{job_id}")
+async def get_ingest_job(job_id: str):
+    """多进程部署时入库任务的状态（queued / running / done / failed）及结果"""
+    job = await run_in_threadpool(get_shared_store().get_job, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"未找到入库任务: {job_id}")
+    return job
+
+@app.get("/llm/providers")
+async def get_llm_providers():
+    """多服务商路由的各服务商延迟、错误率与熔断状态"""
+    if not Config.LLM_ROUTING:
+        return {"routing": False, "providers": []}
+    return {"routing": True, "providers": get_router().stats()}
+
+@app.get("/usage")
+async def get_usage(group_by: Optional[str] = None, session_id: Optional[str] = None,
+                    collection: Optional[str] = None, endpoint: Optional[str] = None,
+                    since_hours: Optional[float] = None):
+    """
+    大模型用量汇总
+    
+    group_by 为逗号分隔的维度，可选 endpoint / session_id / collection / provider / model / stage /
+    k / context_docs / chunk_size / day；为空时返回总计
+    """
+    dimensions = [item.strip() for item in (group_by or "").split(",") if item.strip()]
+    filters = {key: value for key, value in
+               {"session_id": session_id, "collection": collection, "endpoint": endpoint}.items() if value}
+    since = time.time() - since_hours * 3600 if since_hours else None
+    try:
+        rows = await run_in_threadpool(get_usage_store().summary, dimensions, since, filters)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"group_by": dimensions, "dimensions": list(USAGE_DIMENSIONS), "rows": rows}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """Prometheus 文本格式的运行指标（当前进程）"""
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/admin/profiling", dependencies=[Depends(require_admin)])
+async def get_profiling_status():
+    """采样剖析状态及已有的剖析结果文件"""
+    return {"sampler": profiling.sampler.status(), **profiling.list_profiles()}
+
+@app.post("/admin/profiling/start", dependencies=[Depends(require_admin)])
+async def start_profiling(request: ProfilingStartRequest):
+    """开启采样剖析（当前进程）"""
+    interval = request.interval_ms / 1000 if request.interval_ms else None
+    if not profiling.sampler.start(interval=interval, duration=request.duration_s):
+        raise HTTPException(status_code=409, detail="采样剖析已在运行")
+    return profiling.sampler.status()
+
+@app.post("/admin/profiling/stop", dependencies=[Depends(require_admin)])
+async def stop_profiling():
+    """停止采样剖析并写出折叠栈文件"""
+    path = await run_in_threadpool(profiling.sampler.stop)
+    if path is None:
+        raise HTTPException(status_code=409, detail="采样剖析未在运行")
+    return {"path": path, "samples": profiling.sampler.samples}
+
+@app.get("/sources/{chunk_id}")
+async def get_source(chunk_id: str, collection: Optional[str] = None, context: int = 0):
+    """
+    按块ID获取引用原文片段及其出处（文件、页码、字符偏移）
+    
+    context 大于0时同时返回同一页内前后各 context 个相邻块，便于展示上下文
+    """
+    chunk = vector_store.source_store.get_chunk(
+        chunk_id, normalize_collection_name(collection) if collection else None
+    )
+    if chunk is None:
+        raise HTTPException(status_code=404, detail=f"未找到文档块: {chunk_id}")
+    
+    if context > 0:
+        neighbors = vector_store.source_store.get_neighbors(chunk, before=context, after=context)
+        chunk["context_before"] = neighbors["before"]
+        chunk["context_after"] = neighbors["after"]
+    return chunk
+
+@app.get("/rerank/stats")
+async def get_rerank_stats():
+    """获取重排序耗时统计"""
+    return get_reranker().get_stats()
+
+@app.get("/collections")
+async def list_collections():
+    """列出所有集合（课程/租户）"""
+    try:
+        return {"collections": await run_in_threadpool(vector_store.list_collections)}
+    
+    except Exception as e:
+        logger.error(f"列出集合失败: {e}")
+        raise HTTPException(status_code=500, detail=f"列出集合失败: {str(e)}")
+
+@app.delete("/collections/{collection}")
+async def delete_collection(collection: str):
+    """删除指定集合"""
+    try:
+        if READ_ONLY_INDEX:
+            # 先在本进程确认集合存在（不存在时返回 404），再交给入库进程删除
+            await run_in_threadpool(vector_store.get_collection, collection)
+            outcome = await run_ingest_job("delete_collection", {"collection": collection})
+            if outcome["pending"]:
+                return {"message": f"集合 {collection} 删除中", "job_ids": outcome["pending"]}
+            return {"message": f"集合 {collection} 已删除"}
+        success = vector_store.delete_collection(collection)
+        if success:
+            return {"message": f"集合 {collection} 已删除"}
+        else:
+            raise HTTPException(status_code=500, detail="删除集合失败")
+    
+    except CollectionNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.error(f"删除集合失败: {e}")
+        raise HTTPException(status_code=500, detail=f"删除集合失败: {str(e)}")
+
 @app.delete("/reset")
 async def reset_knowledge_base():
     """重置知识库"""
     try:
+        if READ_ONLY_INDEX:
+            outcome = await run_ingest_job("reset", {})
+            if outcome["pending"]:
+                return {"message": "知识库重置中", "job_ids": outcome["pending"]}
+            return {"message": "知识库已重置"}
         success = vector_store.reset()
         if success:
             return {"message": "知识库已重置"}
@@ -208,6 +685,7 @@ async def reset_knowledge_base():
         raise HTTPException(status_code=500, detail=f"重置知识库失败: {str(e)}")
 
 if __name__ == "__main__":
+    # 开发模式（单进程、自动重载）；生产环境多进程部署使用 python serve.py --workers N
     import uvicorn
     uvicorn.run(
         "api:app",
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+性能基准测试
+用固定随机种子生成中英文合成语料和文字图片，分阶段测量文档解析、向量化入库、检索、
+OCR和回答生成（连接本地模拟大模型服务）的延迟分位数与吞吐量，结果保存为JSON便于对比
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Any, List, Optional
+
+STAGES = ("parse", "index", "query", "ocr", "generate")
+
+_ZH_WORDS = [
+    "知识", "复习", "考试", "概念", "定理", "证明", "函数", "导数", "积分", "矩阵", "向量", "概率",
+    "分布", "样本", "算法", "数据", "结构", "网络", "协议", "系统", "内存", "进程", "线程", "调度",
+    "经济", "市场", "需求", "供给", "价格", "历史", "文化", "社会", "实验", "结论", "方法", "模型",
+    "分析", "设计", "实现", "优化", "性能", "误差", "收敛", "稳定", "边界", "条件", "性质", "应用",
+]
+_EN_WORDS = [
+    "knowledge", "review", "exam", "concept", "theorem", "proof", "function", "derivative", "integral",
+    "matrix", "vector", "probability", "distribution", "sample", "algorithm", "data", "structure",
+    "network", "protocol", "system", "memory", "process", "thread", "schedule", "market", "demand",
+    "supply", "price", "history", "culture", "experiment", "method", "model", "analysis", "design",
+    "optimization", "performance", "error", "convergence", "stable", "boundary", "condition", "property",
+]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """线性插值分位数"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * p / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(samples_ms: List[float], wall_seconds: float, items: Optional[int] = None) -> Dict[str, Any]:
+    """汇总单个阶段的延迟分位数与吞吐量（items 为处理的条目数，默认等于样本数）"""
+    items = len(samples_ms) if items is None else items
+    return {
+        "count": len(samples_ms),
+        "mean_ms": sum(samples_ms) / len(samples_ms) if samples_ms else 0.0,
+        "p50_ms": percentile(samples_ms, 50),
+        "p95_ms": percentile(samples_ms, 95),
+        "p99_ms": percentile(samples_ms, 99),
+        "max_ms": max(samples_ms) if samples_ms else 0.0,
+        "wall_s": wall_seconds,
+        "throughput_per_s": items / wall_seconds if wall_seconds > 0 else 0.0,
+    }
+
+
+def timed_calls(func: Callable, args_list: List[Any], concurrency: int = 1) -> Dict[str, Any]:
+    """逐个（或并发）执行调用并记录每次耗时"""
+    def run(arg):
+        start = time.perf_counter()
+        func(arg)
+        return (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    if concurrency > 1:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            samples = list(executor.map(run, args_list))
+    else:
+        samples = [run(arg) for arg in args_list]
+    return summarize(samples, time.perf_counter() - start)
+
+
+# ---------------------------------------------------------------- 合成数据
+
+def _sentence(rng: random.Random, language: str) -> str:
+    if language == "zh":
+        return "".join(rng.choice(_ZH_WORDS) for _ in range(rng.randint(6, 14))) + "。"
+    words = [rng.choice(_EN_WORDS) for _ in range(rng.randint(8, 18))]
+    return " ".join(words).capitalize() + "."
+
+
+def generate_corpus(output_dir: str, docs: int, paragraphs: int, seed: int) -> List[str]:
+    """生成中英文各半的 txt/md 合成语料，返回文件路径列表"""
+    rng = random.Random(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    paths = []
+    for i in range(docs):
+        language = "zh" if i % 2 == 0 else "en"
+        markdown = i % 4 >= 2
+        lines = []
+        for j in range(paragraphs):
+            if markdown and j % 3 == 0:
+                lines.append(f"## {'第' + str(j // 3 + 1) + '节' if language == 'zh' else 'Section ' + str(j // 3 + 1)}")
+            lines.append(" ".join(_sentence(rng, language) for _ in range(rng.randint(3, 6))))
+            lines.append("")
+        path = os.path.join(output_dir, f"doc_{i:04d}_{language}.{'md' if markdown else 'txt'}")
+        with open(path, "w", encoding="utf-8") as file:
+            file.write("\n".join(lines))
+        paths.append(path)
+    return paths
+
+
+def generate_queries(count: int, seed: int) -> List[str]:
+    """生成中英文查询"""
+    rng = random.Random(seed + 1)
+    return [
+        "".join(rng.choice(_ZH_WORDS) for _ in range(3)) + "是什么？" if i % 2 == 0
+        else "What is the " + " ".join(rng.choice(_EN_WORDS) for _ in range(3)) + "?"
+        for i in range(count)
+    ]
+
+
+def generate_images(count: int, seed: int, size=(1240, 1754)) -> List[Any]:
+    """生成带噪声和轻微倾斜的文字页面图片（PIL默认字体只含西文字形，图片为英文文本）"""
+    from PIL import Image, ImageDraw, ImageFilter
+
+    rng = random.Random(seed + 2)
+    images = []
+    for _ in range(count):
+        image = Image.new("L", size, color=rng.randint(215, 250))
+        draw = ImageDraw.Draw(image)
+        y = 80
+        while y < size[1] - 80:
+            draw.text((80, y), _sentence(rng, "en")[:90], fill=rng.randint(0, 60))
+            y += 36
+        for _ in range(size[0] * size[1] // 400):
+            draw.point((rng.randrange(size[0]), rng.randrange(size[1])), fill=rng.randint(0, 255))
+        image = image.rotate(rng.uniform(-1.5, 1.5), fillcolor=230).filter(ImageFilter.GaussianBlur(0.6))
+        images.append(image.convert("RGB"))
+    return images
+
+
+# ---------------------------------------------------------------- 各阶段
+
+def bench_parse(context: Dict[str, Any]) -> Dict[str, Any]:
+    from document_processor import DocumentProcessor
+    from config import Config
+
+    processor = DocumentProcessor(chunk_size=Config.CHUNK_SIZE, chunk_overlap=Config.CHUNK_OVERLAP)
+    chunks: List[Any] = []
+    result = timed_calls(lambda path: chunks.extend(processor.process_file(path)), context["corpus"])
+    result["chunks"] = len(chunks)
+    context["chunks"] = chunks
+    return result
+
+
+def bench_index(context: Dict[str, Any]) -> Dict[str, Any]:
+    from vector_store import VectorStore
+    from source_store import SourceStore
+
+    if "chunks" not in context:
+        bench_parse(context)
+    chunks = context["chunks"]
+    store = VectorStore(persist_directory=os.path.join(context["workdir"], "chroma"), collection_name="benchmark",
+                        source_store=SourceStore(os.path.join(context["workdir"], "sources.db")))
+    context["vector_store"] = store
+
+    # 只编码
+    texts = [chunk.page_content for chunk in chunks]
+    batch = context["args"].embed_batch
+    embed = timed_calls(store.embeddings.embed_documents, [texts[i:i + batch] for i in range(0, len(texts), batch)])
+    embed["throughput_per_s"] = len(texts) / embed["wall_s"] if embed["wall_s"] else 0.0
+
+    # 编码 + 写入 + 持久化（按文件分批，与上传接口一致）
+    by_source: Dict[str, List[Any]] = {}
+    for chunk in chunks:
+        by_source.setdefault(chunk.metadata["source"], []).append(chunk)
+    index = timed_calls(store.add_documents, list(by_source.values()))
+    index["throughput_per_s"] = len(chunks) / index["wall_s"] if index["wall_s"] else 0.0
+    return {"embed": embed, "add_documents": index, "chunks": len(chunks)}
+
+
+def bench_query(context: Dict[str, Any]) -> Dict[str, Any]:
+    if "vector_store" not in context:
+        bench_index(context)
+    store = context["vector_store"]
+    queries = context["queries"]
+    k = context["args"].k
+    results = {
+        "similarity_search_with_score": timed_calls(lambda q: store.similarity_search_with_score(q, k=k), queries),
+        "retrieve_mmr": timed_calls(lambda q: store.retrieve(q, k=k, strategy="mmr"), queries),
+        "batch_retrieve": timed_calls(lambda qs: store.batch_retrieve(qs, k=k), [queries]),
+    }
+    # batch_retrieve 一次处理全部查询，吞吐量按查询数计算
+    batch = results["batch_retrieve"]
+    batch["throughput_per_s"] = len(queries) / batch["wall_s"] if batch["wall_s"] else 0.0
+    return results
+
+
+def bench_ocr(context: Dict[str, Any]) -> Dict[str, Any]:
+    from enhanced_ocr import image_processor
+
+    images = generate_images(context["args"].images, context["args"].seed)
+    serial = timed_calls(lambda image: image_processor.analyze_image(image, method="text"), images)
+
+    start = time.perf_counter()
+    results = image_processor.batch_analyze(images, method="text")
+    wall = time.perf_counter() - start
+    batch = summarize([r.get("elapsed_ms", 0.0) for r in results], wall)
+    return {"analyze_image": serial, "batch_analyze": batch}
+
+
+def bench_generate(context: Dict[str, Any]) -> Dict[str, Any]:
+    from langchain.chat_models import ChatOpenAI
+    from stub_llm_server import start_stub_server
+    from config import Config
+
+    args = context["args"]
+    server = start_stub_server(latency_ms=args.stub_latency_ms)
+    try:
+        llm = ChatOpenAI(model_name=Config.OPENAI_MODEL, openai_api_key="stub", openai_api_base=server.base_url,
+                         max_retries=0)
+        contexts = [" ".join(chunk.page_content for chunk in context.get("chunks", [])[i:i + 4])
+                    for i in range(len(context["queries"]))]
+
+        def ask(item):
+            query, passage = item
+            llm.predict(f"上下文信息:\n{passage}\n\n问题: {query}\n回答:")
+
+        result = timed_calls(ask, list(zip(context["queries"], contexts)), concurrency=args.concurrency)
+        result["stub_latency_ms"] = args.stub_latency_ms
+        result["concurrency"] = args.concurrency
+        return result
+    finally:
+        server.shutdown()
+
+
+_STAGE_FUNCS = {
+    "parse": bench_parse,
+    "index": bench_index,
+    "query": bench_query,
+    "ocr": bench_ocr,
+    "generate": bench_generate,
+}
+
+
+# ---------------------------------------------------------------- 结果比较
+
+def _flatten(results: Dict[str, Any], prefix: str = "") -> Dict[str, Dict[str, Any]]:
+    """把嵌套的阶段结果展开为 {"stage.sub": 指标}"""
+    flat = {}
+    for key, value in results.items():
+        if not isinstance(value, dict):
+            continue
+        name = f"{prefix}{key}"
+        if "p50_ms" in value:
+            flat[name] = value
+        else:
+            flat.update(_flatten(value, name + "."))
+    return flat
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """比较两次运行的 p50/p95，返回超过阈值（百分比）的退化项"""
+    old = _flatten(baseline.get("stages", {}))
+    new = _flatten(current.get("stages", {}))
+    regressions = []
+    print(f"\n{'指标':40s} {'基线p50':>10s} {'当前p50':>10s} {'基线p95':>10s} {'当前p95':>10s} {'变化':>8s}")
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name], new[name]
+        change = (after["p95_ms"] - before["p95_ms"]) / before["p95_ms"] * 100 if before["p95_ms"] else 0.0
+        flag = " ⚠️" if change > threshold else ""
+        print(f"{name:40s} {before['p50_ms']:10.1f} {after['p50_ms']:10.1f} "
+              f"{before['p95_ms']:10.1f} {after['p95_ms']:10.1f} {change:+7.1f}%{flag}")
+        if change > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def run(args) -> Dict[str, Any]:
+    workdir = tempfile.mkdtemp(prefix="kb_bench_")
+    context: Dict[str, Any] = {
+        "args": args,
+        "workdir": workdir,
+        "corpus": generate_corpus(os.path.join(workdir, "corpus"), args.docs, args.paragraphs, args.seed),
+        "queries": generate_queries(args.queries, args.seed),
+    }
+    results: Dict[str, Any] = {
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "git": _git_revision(),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "params": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+        "stages": {},
+    }
+    try:
+        for stage in args.stages:
+            print(f"▶ {stage} ...")
+            try:
+                results["stages"][stage] = _STAGE_FUNCS[stage](context)
+            except ImportError as e:
+                results["stages"][stage] = {"skipped": f"缺少依赖: {e}"}
+            print(json.dumps(results["stages"][stage], ensure_ascii=False, indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="知识库系统性能基准测试")
+    parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES)
+    parser.add_argument("--docs", type=int, default=40, help="合成文档数量")
+    parser.add_argument("--paragraphs", type=int, default=20, help="每个文档的段落数")
+    parser.add_argument("--queries", type=int, default=50, help="查询数量")
+    parser.add_argument("--images", type=int, default=8, help="OCR图片数量")
+    parser.add_argument("--k", type=int, default=4, help="检索返回数量")
+    parser.add_argument("--embed-batch", type=int, default=64, help="编码批大小")
+    parser.add_argument("--concurrency", type=int, default=8, help="生成阶段并发数")
+    parser.add_argument("--stub-latency-ms", type=float, default=50.0, help="模拟大模型服务的延迟")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="结果JSON路径（默认 benchmark_results/时间戳.json）")
+    parser.add_argument("--compare", default=None, help="与之前的结果JSON对比")
+    parser.add_argument("--threshold", type=float, default=10.0, help="p95退化超过该百分比时返回非零退出码")
+    args = parser.parse_args()
+
+    results = run(args)
+
+    output = args.output or os.path.join("benchmark_results", datetime.now().strftime("%Y%m%d_%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(results, file, ensure_ascii=False, indent=2)
+    print(f"\n结果已保存: {output}")
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as file:
+            regressions = compare(json.load(file), results, args.threshold)
+        if regressions:
+            print(f"\n❌ {len(regressions)} 项 p95 退化超过 {args.threshold}%: {', '.join(regressions)}")
+            sys.exit(1)
+        print("\n✅ 没有超过阈值的性能退化")
+
+
+if __name__ == "__main__":
+    main()
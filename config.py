@@ -7,13 +7,103 @@ class Config:
     # OpenAI配置
     OPENAI_API_KEY = os.getenv("OPENAI_API_KEY", "")
     OPENAI_MODEL = os.getenv("OPENAI_MODEL", "gpt-3.5-turbo")
+    # 兼容 OpenAI 协议的接口地址，为空时使用官方地址；离线测试可指向本地模拟服务 stub_llm_server.py
+    OPENAI_API_BASE = os.getenv("OPENAI_API_BASE", "")
+    # 多轮对话中改写问题使用的模型，可配置为更便宜、更快的模型；为空时与回答模型相同
+    CONDENSE_MODEL = os.getenv("CONDENSE_MODEL", "")
     
     # 向量数据库配置
     CHROMA_PERSIST_DIRECTORY = os.getenv("CHROMA_PERSIST_DIRECTORY", "./chroma_db")
+    # 默认集合名（与旧版本 langchain 默认集合保持一致，已有数据无需迁移）
+    DEFAULT_COLLECTION = os.getenv("DEFAULT_COLLECTION", "langchain")
     
     # 文档处理配置
     CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", "1000"))
     CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", "200"))
+    # 文档块原文与出处（页码、字符偏移）存储，用于按块ID展示引用原文
+    SOURCE_STORE_PATH = os.getenv("SOURCE_STORE_PATH", "./source_store.db")
+    
+    # 检索配置
+    RETRIEVAL_STRATEGY = os.getenv("RETRIEVAL_STRATEGY", "similarity")  # similarity / mmr / threshold
+    RETRIEVAL_K = int(os.getenv("RETRIEVAL_K", "4"))
+    RETRIEVAL_FETCH_K = int(os.getenv("RETRIEVAL_FETCH_K", "20"))  # MMR 候选数量
+    MMR_LAMBDA = float(os.getenv("MMR_LAMBDA", "0.5"))
+    SCORE_THRESHOLD = float(os.getenv("SCORE_THRESHOLD")) if os.getenv("SCORE_THRESHOLD") else None
+    CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))  # 0 表示不限制
+    
+    # 重排序配置（本地交叉编码器，CPU运行）
+    RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+    RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/ms-marco-MiniLM-L-6-v2")
+    RERANK_TOP_N = int(os.getenv("RERANK_TOP_N", "20"))  # 参与重排序的候选数量
+    RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+    RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "300"))  # 0 表示不限制
+    
+    # 批量问答配置
+    BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "500"))
+    BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))  # 同时进行的LLM调用数
+    
+    # 多服务商路由配置
+    LLM_ROUTING = os.getenv("LLM_ROUTING", "false").lower() == "true"  # 问答引擎是否通过路由调用大模型
+    # JSON 列表 [{"name", "base_url", "api_key", "model"}]，为空时只使用上面 OPENAI_* 对应的服务
+    LLM_PROVIDERS = os.getenv("LLM_PROVIDERS", "")
+    LLM_REQUEST_TIMEOUT = float(os.getenv("LLM_REQUEST_TIMEOUT", "60"))  # 秒
+    LLM_STATS_WINDOW = int(os.getenv("LLM_STATS_WINDOW", "50"))  # 统计延迟和错误率的最近调用数
+    LLM_HEDGING = os.getenv("LLM_HEDGING", "true").lower() == "true"
+    LLM_HEDGE_MIN_MS = float(os.getenv("LLM_HEDGE_MIN_MS", "500"))
+    LLM_HEDGE_DEFAULT_MS = float(os.getenv("LLM_HEDGE_DEFAULT_MS", "3000"))  # 样本不足时的对冲等待时间
+    LLM_CIRCUIT_FAILURES = int(os.getenv("LLM_CIRCUIT_FAILURES", "5"))  # 连续失败多少次后熔断
+    LLM_CIRCUIT_COOLDOWN = float(os.getenv("LLM_CIRCUIT_COOLDOWN", "30"))  # 熔断后多少秒放行试探请求
+    
+    # 大模型调用限流配置（按服务商，0 表示不限制）
+    LLM_DEFAULT_RPM = float(os.getenv("LLM_DEFAULT_RPM", "0"))
+    LLM_DEFAULT_TPM = float(os.getenv("LLM_DEFAULT_TPM", "0"))
+    # JSON {"服务商": {"rpm", "tpm", "max_concurrency", "latency_target"}}，覆盖上面的默认值
+    LLM_RATE_LIMITS = os.getenv("LLM_RATE_LIMITS", "")
+    LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # 自适应并发上限的最大值
+    LLM_LATENCY_TARGET = float(os.getenv("LLM_LATENCY_TARGET", "30"))  # 秒，超过时降低并发，0 表示只按 429 调整
+    LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))  # 429 重试次数
+    LLM_QUEUE_TIMEOUT = float(os.getenv("LLM_QUEUE_TIMEOUT", "60"))  # 秒，排队超过该时间放弃
+    LLM_EXPECTED_COMPLETION_TOKENS = int(os.getenv("LLM_EXPECTED_COMPLETION_TOKENS", "512"))  # TPM 预扣的生成长度
+    
+    # 大模型用量统计配置
+    USAGE_TRACKING = os.getenv("USAGE_TRACKING", "true").lower() == "true"
+    USAGE_DB_PATH = os.getenv("USAGE_DB_PATH", "./usage.db")
+    # 价格表（每千token，美元），JSON格式 {"模型": [提示价格, 生成价格]}，与内置价格合并
+    LLM_PRICING = os.getenv("LLM_PRICING", "")
+    
+    # 链路追踪配置
+    TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")  # jsonl / otlp / none（只计时不导出）
+    TRACE_FILE = os.getenv("TRACE_FILE", "./traces/traces.jsonl")
+    OTLP_ENDPOINT = os.getenv("OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+    TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "knowledge-base-api")
+    TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1.0"))  # 新请求的采样比例
+    
+    # 性能剖析配置
+    PROFILE_DIR = os.getenv("PROFILE_DIR", "./profiles")
+    PROFILE_SAMPLING = os.getenv("PROFILE_SAMPLING", "false").lower() == "true"  # 启动时即开启采样剖析
+    PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+    PROFILE_HEADER = os.getenv("PROFILE_HEADER", "X-Profile")  # 携带该请求头（及管理令牌）的请求单独剖析
+    # 管理接口令牌（请求头 X-Admin-Token），为空时管理接口不可用
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+    
+    # PDF文本提取配置
+    PDF_BACKEND = os.getenv("PDF_BACKEND", "pymupdf")  # pymupdf / pdfplumber / pypdf2
+    # 页面上横竖线段数达到该值时视为表格页，交给 pdfplumber 提取
+    PDF_TABLE_RULING_LINES = int(os.getenv("PDF_TABLE_RULING_LINES", "12"))
+    # 文本块少于该数量的页面不可能是表格页，跳过开销较大的矢量图形检查
+    PDF_TABLE_MIN_BLOCKS = int(os.getenv("PDF_TABLE_MIN_BLOCKS", "6"))
+    PDF_OCR_DPI = int(os.getenv("PDF_OCR_DPI", "200"))  # 扫描页栅格化分辨率，Tesseract 在 200-300 DPI 下识别效果最好
+    PDF_MIN_TEXT_CHARS = int(os.getenv("PDF_MIN_TEXT_CHARS", "20"))  # 文本层少于该字符数的页面视为扫描页
+    
+    # 图片OCR配置
+    OCR_ENGINE = os.getenv("OCR_ENGINE", "auto")  # auto（优先进程内tesserocr）/ tesserocr / pytesseract
+    OCR_TEXT_TIER = os.getenv("OCR_TEXT_TIER", "auto")  # fast / quality / auto（按图像大小和延迟预算选择）
+    OCR_LATENCY_BUDGET_MS = float(os.getenv("OCR_LATENCY_BUDGET_MS", "1500"))  # 单张图片文本增强的延迟预算
+    OCR_LAYOUT_ANALYSIS = os.getenv("OCR_LAYOUT_ANALYSIS", "false").lower() == "true"  # 默认按版面区域识别
+    OCR_LAYOUT_WORKERS = int(os.getenv("OCR_LAYOUT_WORKERS", "4"))  # 版面区域并行识别的线程数
+    OCR_POOL_WORKERS = int(os.getenv("OCR_POOL_WORKERS", "0")) or os.cpu_count() or 1  # 批量OCR进程数，0 表示CPU核数
+    OCR_CACHE_DIR = os.getenv("OCR_CACHE_DIR", "./ocr_cache")
+    OCR_CACHE_MAX_MB = int(os.getenv("OCR_CACHE_MAX_MB", "256"))  # 0 表示关闭磁盘缓存
     
     # 嵌入模型配置
     EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
@@ -21,10 +111,20 @@ class Config:
     # 服务器配置
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", "8000"))
+
+    # 多进程部署配置（python serve.py）
+    # API 工作进程数，大于 1 时工作进程只读索引，写操作交给单独的入库进程（由 serve.py 设置）
+    API_WORKERS = int(os.getenv("API_WORKERS", "1"))
+    # 工作进程间共享的状态（索引版本、入库任务队列、会话对话历史）
+    SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "./shared_state.db")
+    INDEX_CHECK_INTERVAL = float(os.getenv("INDEX_CHECK_INTERVAL", "1.0"))  # 秒，检查索引是否有更新的间隔
+    INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", "0.5"))  # 秒，入库进程和等待任务的轮询间隔
+    INGEST_WAIT_TIMEOUT = float(os.getenv("INGEST_WAIT_TIMEOUT", "300"))  # 秒，上传接口等待入库完成的最长时间
     
     # 文件上传配置
     UPLOAD_DIR = os.getenv("UPLOAD_DIR", "./uploads")
-    MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "10"))  # MB
+    MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "10"))  # MB，单个文件
+    MAX_UPLOAD_REQUEST_SIZE = int(os.getenv("MAX_UPLOAD_REQUEST_SIZE", "100"))  # MB，单次上传请求
     
     # 支持的文档格式
     SUPPORTED_FORMATS = [".txt", ".pdf", ".docx", ".md"] 
\ No newline at end of file
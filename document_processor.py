@@ -1,11 +1,11 @@
 import os
-import PyPDF2
-from docx import Document
-import markdown
-from bs4 import BeautifulSoup
-from typing import List, Dict, Any
+import hashlib
+from typing import List, Dict, Any, Optional, Iterator, Tuple
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.schema import Document as LangchainDocument
+from pdf_extractor import extract_pdf_text, iter_pdf_pages
+from section_readers import iter_docx_sections, iter_markdown_sections, sections_to_text
+from metrics import timed
 import logging
 
 logging.basicConfig(level=logging.INFO)
@@ -19,6 +19,7 @@ class DocumentProcessor:
             chunk_size=chunk_size,
             chunk_overlap=chunk_overlap,
             length_function=len,
+            add_start_index=True,
         )
     
     def read_text_file(self, file_path: str) -> str:
@@ -31,81 +32,119 @@ class DocumentProcessor:
             return ""
     
     def read_pdf_file(self, file_path: str) -> str:
-        """读取PDF文件"""
+        """读取PDF文件，扫描页自动OCR"""
         try:
-            text = ""
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
-            return text
+            return extract_pdf_text(file_path)
         except Exception as e:
             logger.error(f"读取PDF文件失败: {e}")
             return ""
     
     def read_docx_file(self, file_path: str) -> str:
-        """读取Word文档"""
+        """读取Word文档（含表格）"""
         try:
-            doc = Document(file_path)
-            text = ""
-            for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
-            return text
+            return sections_to_text(iter_docx_sections(file_path))
         except Exception as e:
             logger.error(f"读取Word文档失败: {e}")
             return ""
     
     def read_markdown_file(self, file_path: str) -> str:
-        """读取Markdown文件"""
+        """读取Markdown文件（转换为纯文本）"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as file:
-                md_content = file.read()
-                # 转换为纯文本
-                html = markdown.markdown(md_content)
-                soup = BeautifulSoup(html, 'html.parser')
-                return soup.get_text()
+            return sections_to_text(iter_markdown_sections(file_path))
         except Exception as e:
             logger.error(f"读取Markdown文件失败: {e}")
             return ""
     
-    def process_file(self, file_path: str) -> List[LangchainDocument]:
-        """处理单个文件并返回文档块"""
-        file_extension = os.path.splitext(file_path)[1].lower()
+    def _iter_segments(self, file_path: str, file_extension: str) -> Iterator[Tuple[Dict[str, Any], str]]:
+        """
+        按出处单位逐段读取文件
+        
+        Yields:
+            (段落元数据, 文本)；PDF按页产出（元数据含 page），Word和Markdown按标题章节产出
+            （元数据含 section，即以 " > " 连接的标题路径），纯文本整篇作为一段
+        """
+        try:
+            if file_extension == '.pdf':
+                for page in sorted(iter_pdf_pages(file_path), key=lambda p: p["page"]):
+                    yield {"page": page["page"]}, page["text"]
+            elif file_extension in ('.docx', '.md'):
+                sections = iter_docx_sections(file_path) if file_extension == '.docx' else iter_markdown_sections(file_path)
+                for path, text in sections:
+                    yield ({"section": " > ".join(path)} if path else {}), text
+            elif file_extension == '.txt':
+                yield {}, self.read_text_file(file_path)
+        except Exception as e:
+            logger.error(f"读取文件失败 {file_path}: {e}")
+    
+    @staticmethod
+    def _annotate_chunk(chunk: LangchainDocument) -> None:
+        """
+        为文档块补充出处信息：char_start / char_end 为块在所在页或章节（纯文本为全文）中的字符偏移，
+        content_hash 为块内容哈希，chunk_id 由文件、页码/章节、偏移和内容哈希确定，重复导入时保持不变
+        """
+        metadata = chunk.metadata
+        char_start = metadata.pop("start_index", -1)
+        content_hash = hashlib.sha256(chunk.page_content.encode('utf-8')).hexdigest()[:16]
+        metadata["char_start"] = char_start
+        metadata["char_end"] = char_start + len(chunk.page_content) if char_start >= 0 else -1
+        metadata["content_hash"] = content_hash
+        key = (f"{metadata.get('source')}|{metadata.get('page', 0)}|{metadata.get('section', '')}|"
+               f"{char_start}|{content_hash}")
+        metadata["chunk_id"] = hashlib.sha1(key.encode('utf-8')).hexdigest()[:24]
+    
+    def process_file(self, file_path: str, extra_metadata: Optional[Dict[str, Any]] = None) -> List[LangchainDocument]:
+        """
+        处理单个文件并返回文档块
         
-        # 根据文件类型选择读取方法
-        if file_extension == '.txt':
-            content = self.read_text_file(file_path)
-        elif file_extension == '.pdf':
-            content = self.read_pdf_file(file_path)
-        elif file_extension == '.docx':
-            content = self.read_docx_file(file_path)
-        elif file_extension == '.md':
-            content = self.read_markdown_file(file_path)
-        else:
+        每个文档块的元数据包含页码（PDF）或章节标题路径（Word/Markdown）、字符偏移、
+        内容哈希、chunk_id 和分块大小，可据此直接定位并展示原文片段
+        
+        Args:
+            file_path: 文件路径
+            extra_metadata: 附加到每个文档块上的元数据（如课程、章节），可用于检索时过滤
+        """
+        file_extension = os.path.splitext(file_path)[1].lower()
+        if file_extension not in ('.txt', '.pdf', '.docx', '.md'):
             logger.warning(f"不支持的文件格式: {file_extension}")
             return []
         
-        if not content.strip():
+        metadata = {
+            "source": file_path,
+            "file_type": file_extension,
+            "file_name": os.path.basename(file_path),
+            # 建索引时的分块大小，用量统计按实际检索到的块记录
+            "chunk_size": self.chunk_size
+        }
+        if extra_metadata:
+            metadata.update(extra_metadata)
+        
+        with timed("parse", items=1):
+            segments = [(segment, content) for segment, content in self._iter_segments(file_path, file_extension)
+                        if content and content.strip()]
+        
+        # 逐段（PDF逐页、Word/Markdown逐章节）分割，块不会跨越页面或章节边界
+        chunks = []
+        with timed("split") as split_timer:
+            for segment, content in segments:
+                segment_metadata = dict(metadata)
+                segment_metadata.update(segment)
+                chunks.extend(self.text_splitter.split_documents([
+                    LangchainDocument(page_content=content, metadata=segment_metadata)
+                ]))
+            split_timer.items = len(chunks)
+        
+        if not chunks:
             logger.warning(f"文件内容为空: {file_path}")
             return []
         
-        # 创建Langchain文档对象
-        doc = LangchainDocument(
-            page_content=content,
-            metadata={
-                "source": file_path,
-                "file_type": file_extension,
-                "file_name": os.path.basename(file_path)
-            }
-        )
-        
-        # 分割文档
-        chunks = self.text_splitter.split_documents([doc])
+        for chunk in chunks:
+            self._annotate_chunk(chunk)
         logger.info(f"文件 {file_path} 被分割为 {len(chunks)} 个块")
         
         return chunks
     
-    def process_directory(self, directory_path: str) -> List[LangchainDocument]:
+    def process_directory(self, directory_path: str,
+                          extra_metadata: Optional[Dict[str, Any]] = None) -> List[LangchainDocument]:
         """处理目录中的所有支持的文件"""
         all_chunks = []
         supported_formats = ['.txt', '.pdf', '.docx', '.md']
@@ -117,7 +156,7 @@ class DocumentProcessor:
                 
                 if file_extension in supported_formats:
                     logger.info(f"处理文件: {file_path}")
-                    chunks = self.process_file(file_path)
+                    chunks = self.process_file(file_path, extra_metadata)
                     all_chunks.extend(chunks)
         
         logger.info(f"总共处理了 {len(all_chunks)} 个文档块")
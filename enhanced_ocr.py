@@ -9,14 +9,282 @@ import cv2
 import numpy as np
 from PIL import Image, ImageFilter, ImageEnhance
 import pytesseract
+import io
 import os
 import re
+import json
+import time
+import hashlib
+import logging
+import threading
 import streamlit as st
-from typing import Dict, List
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Union
+from layout_analysis import analyze_layout, is_formula, PSM_BY_REGION
+from config import Config
+from metrics import QUEUE_DEPTH, STAGE_ERRORS, observe_stage, record_cache, timed
+import ocr_worker
+
+logger = logging.getLogger(__name__)
+
+
+class OCREngine(ABC):
+    """OCR引擎接口"""
+    
+    name = "base"
+    
+    @abstractmethod
+    def image_to_string(self, image: Image.Image, lang: str, psm: Optional[int] = None, config: str = '') -> str:
+        """识别图像中的文字"""
+
+
+class PytesseractEngine(OCREngine):
+    """通过 pytesseract 调用 tesseract 命令行（每次识别启动一个子进程）"""
+    
+    name = "pytesseract"
+    
+    def image_to_string(self, image: Image.Image, lang: str, psm: Optional[int] = None, config: str = '') -> str:
+        if psm is not None:
+            config = f"{config} --psm {psm}".strip()
+        return pytesseract.image_to_string(image, lang=lang, config=config)
+
+
+class TesserocrEngine(OCREngine):
+    """
+    基于 tesserocr 的进程内Tesseract引擎
+    
+    每个线程按 (语言, 页面分割模式) 持有一个长驻的 PyTessBaseAPI 句柄，
+    traineddata 只加载一次，图像以内存对象传入，无需写临时文件
+    """
+    
+    name = "tesserocr"
+    
+    def __init__(self, tessdata_path: str = None):
+        import tesserocr
+        
+        self._tesserocr = tesserocr
+        self.tessdata_path = tessdata_path or os.environ.get('TESSDATA_PREFIX', '')
+        self._local = threading.local()
+    
+    def _get_api(self, lang: str, psm: Optional[int]):
+        apis = getattr(self._local, 'apis', None)
+        if apis is None:
+            apis = self._local.apis = {}
+        key = (lang, psm)
+        if key not in apis:
+            path = self.tessdata_path
+            if path and not path.endswith(os.sep):
+                path += os.sep
+            apis[key] = self._tesserocr.PyTessBaseAPI(
+                path=path,
+                lang=lang,
+                psm=self._tesserocr.PSM.AUTO if psm is None else psm
+            )
+        return apis[key]
+    
+    def probe(self, lang: str) -> None:
+        """创建当前线程的识别句柄：缺少语言的 traineddata 或 tessdata 路径错误时在此抛出"""
+        self._get_api(lang, None)
+    
+    def image_to_string(self, image: Image.Image, lang: str, psm: Optional[int] = None, config: str = '') -> str:
+        api = self._get_api(lang, psm)
+        # 支持 "-c 变量=值" 形式的参数
+        tokens = config.split()
+        for i, token in enumerate(tokens[:-1]):
+            if token == '-c' and '=' in tokens[i + 1]:
+                name, value = tokens[i + 1].split('=', 1)
+                api.SetVariable(name, value)
+        api.SetImage(image)
+        text = api.GetUTF8Text()
+        api.Clear()
+        return text
+
+
+def create_ocr_engine(preferred: str = 'auto', tessdata_path: str = None, lang: str = 'eng') -> OCREngine:
+    """
+    创建OCR引擎
+    
+    Args:
+        preferred: 'auto'（优先tesserocr，不可用时回退pytesseract）/ 'tesserocr' / 'pytesseract'
+        tessdata_path: tessdata目录
+        lang: 识别语言，用于预先加载 tesserocr 句柄
+    """
+    if preferred in ('auto', 'tesserocr'):
+        try:
+            engine = TesserocrEngine(tessdata_path)
+            # 句柄初始化失败（语言包缺失、tessdata 路径错误）时同样回退，而不是在首次识别时报错
+            engine.probe(lang)
+            return engine
+        except Exception as e:
+            if preferred == 'tesserocr' or not isinstance(e, ImportError):
+                logger.warning(f"tesserocr 不可用，回退到 pytesseract: {e}")
+    return PytesseractEngine()
+
+
+class OCRCache:
+    """
+    基于内容寻址的OCR磁盘缓存
+    
+    增强后的图像（PNG）和OCR结果（JSON）按键的前两位分目录存放，
+    总大小超过上限时按最近访问时间淘汰最旧的文件。多个进程可共享同一目录
+    """
+    
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._total_bytes = self._scan_size()
+    
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + suffix)
+    
+    def _scan_size(self) -> int:
+        total = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+    
+    def _touch(self, path: str) -> None:
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+    
+    def get_image(self, key: str) -> Optional[Image.Image]:
+        """读取缓存的增强图像"""
+        path = self._path(key, '.png')
+        try:
+            image = Image.open(path)
+            image.load()
+        except (OSError, ValueError):
+            self.misses += 1
+            record_cache('ocr_image', False)
+            return None
+        self._touch(path)
+        self.hits += 1
+        record_cache('ocr_image', True)
+        return image
+    
+    def get_result(self, key: str) -> Optional[Dict]:
+        """读取缓存的OCR结果"""
+        path = self._path(key, '.json')
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            self.misses += 1
+            record_cache('ocr_result', False)
+            return None
+        self._touch(path)
+        self.hits += 1
+        record_cache('ocr_result', True)
+        return result
+    
+    def put_image(self, key: str, image: Image.Image) -> None:
+        """写入增强图像"""
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', compress_level=1)
+        self._write(self._path(key, '.png'), buffer.getvalue())
+    
+    def put_result(self, key: str, result: Dict) -> None:
+        """写入OCR结果"""
+        self._write(self._path(key, '.json'), json.dumps(result, ensure_ascii=False).encode('utf-8'))
+    
+    def _write(self, path: str, data: bytes) -> None:
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        
+        with self._lock:
+            self._total_bytes += len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+    
+    def _evict(self) -> None:
+        """按最近访问时间淘汰最旧的文件，直到总大小降到上限的90%"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        
+        total = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in sorted(entries):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._total_bytes = total
+    
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            for root, _, files in os.walk(self.cache_dir):
+                for name in files:
+                    try:
+                        os.remove(os.path.join(root, name))
+                    except OSError:
+                        pass
+            self._total_bytes = 0
+
 
 class SimpleImageProcessor:
     """简化的图片处理器"""
     
+    # 类型检测时图像最长边缩放到的像素数
+    DETECT_MAX_SIDE = 800
+    # 类型检测结果缓存的图片数量
+    TYPE_CACHE_SIZE = 128
+    
+    # 文本增强档位：fast（快速）/ quality（高质量，原有降噪流程）/ auto（按图像大小和延迟预算选择）
+    TEXT_TIERS = ('fast', 'quality')
+    TEXT_TIER = Config.OCR_TEXT_TIER
+    # 单张图片文本增强的延迟预算（毫秒）
+    LATENCY_BUDGET_MS = Config.OCR_LATENCY_BUDGET_MS
+    # 快速档按该DPI归一化；图片不带DPI信息时长边最多保留 FAST_MAX_SIDE 像素（约A4纸300DPI）
+    TARGET_DPI = 300
+    FAST_MAX_SIDE = 3508
+    # 各档位每百万像素耗时的初始估计（毫秒），运行中按实测值滑动更新
+    TIER_COST_MS_PER_MP = {'fast': 15.0, 'quality': 400.0}
+    
+    # Tesseract识别语言与参数
+    OCR_LANG = 'chi_sim+eng'
+    OCR_CONFIG = ''
+    # OCR引擎：auto（优先进程内tesserocr）/ tesserocr / pytesseract
+    OCR_ENGINE = Config.OCR_ENGINE
+    # 是否默认启用版面分析（按区域OCR，输出结构化表格）
+    LAYOUT_ANALYSIS = Config.OCR_LAYOUT_ANALYSIS
+    # 版面区域并行识别的线程数
+    LAYOUT_WORKERS = Config.OCR_LAYOUT_WORKERS
+    # 批量OCR进程池的进程数（进程内只创建一次，所有调用方共用）
+    POOL_WORKERS = Config.OCR_POOL_WORKERS
+    
+    # OCR结果磁盘缓存（OCR_CACHE_MAX_MB 为 0 时关闭）
+    CACHE_DIR = Config.OCR_CACHE_DIR
+    CACHE_MAX_MB = Config.OCR_CACHE_MAX_MB
+    
     def __init__(self):
         # 配置Tesseract路径
         self.tesseract_path = r'E:\p\tesseract.exe'
@@ -25,14 +293,36 @@ class SimpleImageProcessor:
         # 设置环境变量
         os.environ['TESSDATA_PREFIX'] = self.tessdata_path
         pytesseract.pytesseract.tesseract_cmd = self.tesseract_path
+        
+        # OCR引擎（进程内长驻，pytesseract作为回退）
+        self.ocr_engine = create_ocr_engine(self.OCR_ENGINE, self.tessdata_path, self.OCR_LANG)
+        
+        # 图像内容哈希 -> 检测到的图像类型
+        self._type_cache: "OrderedDict[str, str]" = OrderedDict()
+        
+        # 各文本增强档位的实测耗时（毫秒/百万像素）
+        self._tier_cost = dict(self.TIER_COST_MS_PER_MP)
+        
+        # 批量OCR使用的进程池，首次使用时创建
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        
+        # 版面区域并行识别的线程池，首次使用时创建并一直保留：
+        # tesserocr 句柄按线程保存，线程长驻才能复用已加载 traineddata 的句柄
+        self._layout_executor = None
+        self._layout_lock = threading.Lock()
+        
+        # 增强图像与OCR结果的磁盘缓存
+        self.cache = OCRCache(self.CACHE_DIR, self.CACHE_MAX_MB * 1024 * 1024) if self.CACHE_MAX_MB > 0 else None
     
-    def enhance_image(self, image: Image.Image, method: str = 'auto') -> Image.Image:
+    def enhance_image(self, image: Image.Image, method: str = 'auto', tier: str = None) -> Image.Image:
         """
         增强图片质量
         
         Args:
             image: PIL图像对象
             method: 增强方法 ('auto', 'text', 'table', 'formula')
+            tier: 文本增强档位 ('auto', 'fast', 'quality')，默认取 TEXT_TIER
         
         Returns:
             增强后的图像
@@ -43,46 +333,166 @@ class SimpleImageProcessor:
         
         # 转换为numpy数组
         img_array = np.array(image)
-        
-        if method == 'auto':
-            method = self._detect_image_type(img_array)
-        
+        enhanced_image, _ = self._enhance_cached(image, img_array, self._image_key(img_array), method, tier)
+        return enhanced_image
+    
+    def _enhance_cached(self, image: Image.Image, img_array: np.ndarray, image_key: str,
+                        method: str, tier: str = None):
+        """增强图像，优先读取磁盘缓存；返回 (增强后的图像, 图像类型)"""
+        image_type = self._detect_image_type(img_array, image_key) if method == 'auto' else method
+        
+        tier = self.resolve_text_tier(image, tier)
+        cache_key = self._cache_key(image_key, 'enhance', image_type, tier)
+        enhanced_image = self.cache.get_image(cache_key) if self.cache else None
+        if enhanced_image is None:
+            enhanced_image = self._enhance(image, image_type, tier)
+            if self.cache:
+                self.cache.put_image(cache_key, enhanced_image)
+        return enhanced_image, image_type
+    
+    def _enhance(self, image: Image.Image, method: str, tier: str = None) -> Image.Image:
+        """按图像类型选择增强流程"""
         if method == 'text':
-            return self._enhance_for_text(image)
+            return self._enhance_for_text(image, tier)
         elif method == 'table':
             return self._enhance_for_table(image)
         elif method == 'formula':
             return self._enhance_for_formula(image)
         else:
-            return self._enhance_for_text(image)
+            return self._enhance_for_text(image, tier)
     
-    def _detect_image_type(self, img_array: np.ndarray) -> str:
-        """简单检测图像类型"""
+    def _image_key(self, img_array: np.ndarray) -> str:
+        """计算图像内容的哈希，用作缓存键"""
+        digest = hashlib.blake2b(np.ascontiguousarray(img_array).data, digest_size=16)
+        digest.update(str(img_array.shape).encode())
+        return digest.hexdigest()
+    
+    def _cache_key(self, image_key: str, *parts) -> str:
+        """由图像哈希与处理参数组合出磁盘缓存键"""
+        payload = "|".join([image_key] + [str(part) for part in parts])
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=20).hexdigest()
+    
+    def _detect_image_type(self, img_array: np.ndarray, key: str = None) -> str:
+        """检测图像类型（按图像内容缓存，同一张图片只分析一次）"""
+        key = key or self._image_key(img_array)
+        image_type = self._type_cache.get(key)
+        record_cache('image_type', image_type is not None)
+        if image_type is not None:
+            self._type_cache.move_to_end(key)
+            return image_type
+        
+        image_type = self._classify_image(img_array)
+        self._type_cache[key] = image_type
+        if len(self._type_cache) > self.TYPE_CACHE_SIZE:
+            self._type_cache.popitem(last=False)
+        return image_type
+    
+    def _classify_image(self, img_array: np.ndarray) -> str:
+        """
+        基于图像特征判断类型，不调用OCR
+        
+        - 表格：缩小后的图像中存在较多水平/垂直长直线
+        - 公式：连通域中横线状符号（分数线、等号、减号）占比高，且字符高度差异大（上下标）
+        - 其他视为文本
+        """
         # 转换为灰度图
-        gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
+        if img_array.ndim == 2:
+            gray = img_array
+        elif img_array.shape[2] == 4:
+            gray = cv2.cvtColor(img_array, cv2.COLOR_RGBA2GRAY)
+        else:
+            gray = cv2.cvtColor(img_array, cv2.COLOR_RGB2GRAY)
         
-        # 检测边缘
-        edges = cv2.Canny(gray, 50, 150)
+        # 缩小图像，特征统计与分辨率无关
+        height, width = gray.shape[:2]
+        scale = self.DETECT_MAX_SIDE / max(height, width)
+        if scale < 1:
+            gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+            height, width = gray.shape[:2]
         
         # 检测直线
-        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=50, maxLineGap=10)
+        edges = cv2.Canny(gray, 50, 150)
+        min_line_length = max(30, int(min(height, width) * 0.15))
+        lines = cv2.HoughLinesP(edges, 1, np.pi/180, threshold=50, minLineLength=min_line_length, maxLineGap=5)
+        
+        horizontal = vertical = 0
+        if lines is not None:
+            dx = np.abs(lines[:, 0, 2] - lines[:, 0, 0])
+            dy = np.abs(lines[:, 0, 3] - lines[:, 0, 1])
+            horizontal = int(np.count_nonzero(dy <= dx * 0.05))
+            vertical = int(np.count_nonzero(dx <= dy * 0.05))
+        
+        # 水平、垂直直线都较多，可能是表格
+        if (horizontal >= 3 and vertical >= 3) or horizontal + vertical > 15:
+            return 'table'
+        
+        # 连通域统计，与版面分析使用同一套公式判定
+        _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+        if is_formula(binary):
+            return 'formula'
+        return 'text'
+    
+    def select_text_tier(self, image: Image.Image, budget_ms: float = None) -> str:
+        """按图像像素数和延迟预算选择文本增强档位：预计耗时在预算内时使用高质量档"""
+        budget_ms = self.LATENCY_BUDGET_MS if budget_ms is None else budget_ms
+        megapixels = image.size[0] * image.size[1] / 1e6
+        if megapixels * self._tier_cost['quality'] <= budget_ms:
+            return 'quality'
+        return 'fast'
+    
+    def resolve_text_tier(self, image: Image.Image, tier: str = None) -> str:
+        """确定实际使用的文本增强档位：未指定时取 TEXT_TIER，'auto' 时按延迟预算选择"""
+        tier = tier or self.TEXT_TIER
+        if tier not in self.TEXT_TIERS:
+            tier = self.select_text_tier(image)
+        return tier
+    
+    def _enhance_for_text(self, image: Image.Image, tier: str = None) -> Image.Image:
+        """针对文本的图像增强，按档位选择处理流程并记录实测耗时"""
+        tier = self.resolve_text_tier(image, tier)
         
-        # 分析特征
-        line_count = len(lines) if lines is not None else 0
+        start = time.perf_counter()
+        if tier == 'fast':
+            result = self._enhance_for_text_fast(image)
+        else:
+            result = self._enhance_for_text_quality(image)
         
-        # 判断图像类型
-        if line_count > 15:  # 很多直线，可能是表格
-            return 'table'
+        # 滑动更新该档位每百万像素的耗时
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        megapixels = max(image.size[0] * image.size[1] / 1e6, 0.01)
+        self._tier_cost[tier] = 0.8 * self._tier_cost[tier] + 0.2 * (elapsed_ms / megapixels)
+        return result
+    
+    def _enhance_for_text_fast(self, image: Image.Image) -> Image.Image:
+        """快速文本增强：DPI归一化缩放 + 中值滤波 + Sauvola二值化"""
+        gray = np.array(image.convert('L'))
+        
+        # 按DPI归一化缩放，高分辨率手机照片缩小到约300DPI
+        height, width = gray.shape[:2]
+        dpi = image.info.get('dpi')
+        if dpi and dpi[0] and dpi[0] > self.TARGET_DPI:
+            scale = self.TARGET_DPI / float(dpi[0])
         else:
-            # 检查是否包含数学符号
-            text = pytesseract.image_to_string(Image.fromarray(img_array), lang='eng')
-            if any(symbol in text for symbol in ['=', '+', '-', '×', '÷', '∫', '∑', '√']):
-                return 'formula'
-            else:
-                return 'text'
+            scale = self.FAST_MAX_SIDE / max(height, width)
+        if scale < 1:
+            gray = cv2.resize(gray, (int(width * scale), int(height * scale)), interpolation=cv2.INTER_AREA)
+        
+        # 中值滤波去除椒盐噪点，代价远低于非局部均值降噪
+        denoised = cv2.medianBlur(gray, 3)
+        
+        return Image.fromarray(self._sauvola_threshold(denoised))
     
-    def _enhance_for_text(self, image: Image.Image) -> Image.Image:
-        """针对文本的图像增强"""
+    def _sauvola_threshold(self, gray: np.ndarray, window: int = 25, k: float = 0.2, r: float = 128.0) -> np.ndarray:
+        """Sauvola局部阈值二值化，用盒式滤波计算局部均值和方差"""
+        img = gray.astype(np.float32)
+        mean = cv2.boxFilter(img, cv2.CV_32F, (window, window), borderType=cv2.BORDER_REPLICATE)
+        sq_mean = cv2.boxFilter(img * img, cv2.CV_32F, (window, window), borderType=cv2.BORDER_REPLICATE)
+        std = np.sqrt(np.maximum(sq_mean - mean * mean, 0))
+        threshold = mean * (1 + k * (std / r - 1))
+        return np.where(img > threshold, 255, 0).astype(np.uint8)
+    
+    def _enhance_for_text_quality(self, image: Image.Image) -> Image.Image:
+        """高质量文本增强：全分辨率 CLAHE + 非局部均值降噪 + 锐化 + 自适应二值化"""
         # 转换为灰度图
         gray = image.convert('L')
         
@@ -152,33 +562,112 @@ class SimpleImageProcessor:
         
         return Image.fromarray(cleaned)
     
-    def extract_text(self, image: Image.Image, method: str = 'auto') -> str:
+    def extract_text(self, image: Image.Image, method: str = 'auto', tier: str = None) -> str:
         """
         提取图片中的文字
         
         Args:
             image: PIL图像对象
             method: 增强方法
+            tier: 文本增强档位
         
         Returns:
             提取的文字
         """
         try:
             # 增强图像
-            enhanced_image = self.enhance_image(image, method)
-            
-            # OCR识别
-            text = pytesseract.image_to_string(enhanced_image, lang='chi_sim+eng')
-            
-            # 后处理文字
-            text = self._post_process_text(text)
+            enhanced_image = self.enhance_image(image, method, tier)
             
-            return text.strip()
+            return self._ocr(enhanced_image)
         
         except Exception as e:
             st.error(f"文字提取失败: {str(e)}")
             return ""
     
+    def _ocr(self, enhanced_image: Image.Image) -> str:
+        """对增强后的图像做OCR识别并后处理"""
+        # OCR识别
+        text = self.ocr_engine.image_to_string(enhanced_image, lang=self.OCR_LANG, config=self.OCR_CONFIG)
+        
+        # 后处理文字
+        text = self._post_process_text(text)
+        
+        return text.strip()
+    
+    def _get_layout_executor(self) -> ThreadPoolExecutor:
+        """获取版面区域识别的长驻线程池（LAYOUT_WORKERS 个线程）"""
+        if self._layout_executor is None:
+            with self._layout_lock:
+                if self._layout_executor is None:
+                    self._layout_executor = ThreadPoolExecutor(max_workers=max(1, self.LAYOUT_WORKERS),
+                                                               thread_name_prefix='ocr-layout')
+        return self._layout_executor
+    
+    def _ocr_layout(self, enhanced_image: Image.Image) -> Dict:
+        """
+        按版面区域识别：文本块、公式、表格单元格分别以合适的页面分割模式OCR，插图跳过
+        
+        Returns:
+            {"text": 按阅读顺序拼接的文字, "regions": 区域列表, "tables": 每个表格的二维单元格文字}
+        """
+        regions = analyze_layout(np.array(enhanced_image.convert('L')))
+        
+        # 每个OCR任务: (区域序号, 行, 列, bbox, psm)
+        jobs = []
+        for idx, region in enumerate(regions):
+            if region['type'] == 'figure':
+                continue
+            if region['type'] == 'table':
+                for r, row in enumerate(region['rows']):
+                    for c, bbox in enumerate(row):
+                        jobs.append((idx, r, c, bbox, PSM_BY_REGION['cell']))
+            else:
+                jobs.append((idx, None, None, region['bbox'], PSM_BY_REGION[region['type']]))
+        
+        width, height = enhanced_image.size
+        
+        def recognize(job):
+            x, y, w, h = job[3]
+            pad = 4
+            crop = enhanced_image.crop((max(x - pad, 0), max(y - pad, 0),
+                                        min(x + w + pad, width), min(y + h + pad, height)))
+            text = self.ocr_engine.image_to_string(crop, lang=self.OCR_LANG, psm=job[4], config=self.OCR_CONFIG)
+            return self._post_process_text(text).strip()
+        
+        if len(jobs) <= 1:
+            texts = [recognize(job) for job in jobs]
+        else:
+            texts = list(self._get_layout_executor().map(recognize, jobs))
+        
+        # 组装结果
+        region_texts = {}
+        table_cells = {}
+        for job, text in zip(jobs, texts):
+            idx, r, c = job[0], job[1], job[2]
+            if r is None:
+                region_texts[idx] = text
+            else:
+                table_cells.setdefault(idx, {})[(r, c)] = text
+        
+        output_regions = []
+        tables = []
+        for idx, region in enumerate(regions):
+            item = {'type': region['type'], 'bbox': list(region['bbox'])}
+            if region['type'] == 'table':
+                cells = table_cells.get(idx, {})
+                rows = [[cells.get((r, c), '') for c in range(len(row))] for r, row in enumerate(region['rows'])]
+                tables.append(rows)
+                item['text'] = '\n'.join(' | '.join(row) for row in rows)
+            else:
+                item['text'] = region_texts.get(idx, '')
+            output_regions.append(item)
+        
+        return {
+            'text': '\n'.join(r['text'] for r in output_regions if r['text']),
+            'regions': output_regions,
+            'tables': tables
+        }
+    
     def _post_process_text(self, text: str) -> str:
         """文字后处理"""
         # 移除多余的空白字符
@@ -198,16 +687,23 @@ class SimpleImageProcessor:
         
         return text
     
-    def analyze_image(self, image: Image.Image) -> Dict:
+    @timed('ocr', items=1)
+    def analyze_image(self, image: Image.Image, method: str = 'auto', tier: str = None,
+                      return_enhanced: bool = False, use_layout: bool = None) -> Dict:
         """
         分析图片内容
         
         Args:
             image: PIL图像对象
+            method: 增强方法，'auto' 时自动检测图像类型
+            tier: 文本增强档位
+            return_enhanced: 是否在结果中返回增强后的图像（供预览复用）
+            use_layout: 是否按版面区域识别，默认取 LAYOUT_ANALYSIS；启用时结果额外包含 regions 和 tables
         
         Returns:
             分析结果字典
         """
+        use_layout = self.LAYOUT_ANALYSIS if use_layout is None else use_layout
         result = {
             'text': '',
             'image_type': 'unknown',
@@ -215,21 +711,215 @@ class SimpleImageProcessor:
         }
         
         try:
-            # 检测图像类型
+            # 检测图像类型（与 enhance_image 使用同样的RGB数组，共享检测缓存）
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
             img_array = np.array(image)
-            image_type = self._detect_image_type(img_array)
+            image_key = self._image_key(img_array)
+            
+            # 命中缓存时直接返回上次的识别结果；缓存键使用实际的档位，'auto' 选出的不同档位不共用结果
+            tier = self.resolve_text_tier(image, tier)
+            result_key = self._cache_key(image_key, 'ocr', method, tier,
+                                         self.OCR_LANG, self.OCR_CONFIG, use_layout)
+            cached = self.cache.get_result(result_key) if self.cache else None
+            if cached is not None and not return_enhanced:
+                result.update(cached)
+                return result
+            
+            # 增强图像并提取文字
+            enhanced_image, image_type = self._enhance_cached(image, img_array, image_key, method, tier)
             result['image_type'] = image_type
+            if return_enhanced:
+                result['enhanced_image'] = enhanced_image
+            if cached is not None:
+                result.update(cached)
+                return result
             
-            # 提取文字
-            result['text'] = self.extract_text(image, image_type)
+            if use_layout:
+                result.update(self._ocr_layout(enhanced_image))
+            else:
+                result['text'] = self._ocr(enhanced_image)
             
             # 计算置信度
             result['confidence'] = min(len(result['text']) / 100, 1.0)
             
+            if self.cache:
+                self.cache.put_result(result_key, {
+                    key: value for key, value in result.items() if key != 'enhanced_image'
+                })
+            
         except Exception as e:
             st.error(f"图像分析失败: {str(e)}")
+            result['error'] = str(e)
+            STAGE_ERRORS.inc(stage='ocr')
         
         return result
+    
+    def batch_analyze(self, images: List[Union[Image.Image, bytes, str]], method: str = 'auto',
+                      tier: str = None, max_workers: int = None,
+                      return_enhanced: bool = False, use_layout: bool = None) -> List[Dict]:
+        """
+        批量分析图片：在进程池中并行执行增强和OCR
+        
+        Args:
+            images: PIL图像、图片字节或图片路径列表
+            method: 增强方法
+            tier: 文本增强档位
+            max_workers: 本次调用最多同时占用的进程数，默认不超过进程池大小
+            return_enhanced: 是否返回增强后的图像
+            use_layout: 是否按版面区域识别
+        
+        Returns:
+            与输入顺序一致的分析结果列表，每项额外包含 index 和 elapsed_ms
+        """
+        tasks = [(i, image, method, tier, return_enhanced, use_layout) for i, image in enumerate(images)]
+        if len(tasks) <= 1 or max_workers == 1:
+            return [_analyze_task(task) for task in tasks]
+        
+        # 进程池由所有调用方共用、大小固定，max_workers 只限制本次调用同时在池中的任务数
+        pool = self._get_pool()
+        pool_size = max(1, self.POOL_WORKERS)
+        slots = threading.BoundedSemaphore(min(max_workers or pool_size, pool_size))
+        futures = []
+        for task in tasks:
+            slots.acquire()
+            try:
+                future = _submit_to_pool(pool, task)
+            except Exception:
+                slots.release()
+                raise
+            future.add_done_callback(lambda _: slots.release())
+            # 工作进程中的计时不会回传，由当前进程按结果里的 elapsed_ms 记录
+            future.add_done_callback(_record_pool_result)
+            futures.append(future)
+        return [future.result() for future in futures]
+    
+    def submit_analyze(self, image: Union[Image.Image, bytes, str], method: str = 'auto', tier: str = None,
+                       use_layout: bool = None):
+        """
+        向批量OCR进程池提交单张图片，立即返回 Future，结果格式同 batch_analyze 的单项
+        
+        适用于边产生图片边识别的场景（如逐页栅格化的扫描版PDF）；调用方自行限制同时提交的数量
+        """
+        future = _submit_to_pool(self._get_pool(), (0, image, method, tier, False, use_layout))
+        future.add_done_callback(_record_pool_result)
+        return future
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """获取批量OCR进程池：首次使用时按 POOL_WORKERS 创建，之后不再重建，避免影响其他调用方的任务"""
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=max(1, self.POOL_WORKERS),
+                                                 mp_context=ocr_worker.OCRWorkerContext(),
+                                                 initializer=ocr_worker.init_worker)
+            return self._pool
+    
+    def shutdown(self, wait: bool = True):
+        """关闭批量OCR进程池；已提交的任务照常执行完毕，不会被取消"""
+        with self._pool_lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=wait)
+
+    def benchmark_text_tiers(self, images: List[Image.Image], repeat: int = 3) -> Dict[str, Dict]:
+        """
+        测量各文本增强档位的耗时
+        
+        Args:
+            images: 测试图片列表
+            repeat: 每张图片重复次数
+        
+        Returns:
+            {档位: {"mean_ms", "max_ms", "ms_per_megapixel"}}
+        """
+        results = {}
+        total_megapixels = sum(img.size[0] * img.size[1] for img in images) / 1e6 * repeat
+        for tier in self.TEXT_TIERS:
+            timings = []
+            for image in images:
+                for _ in range(repeat):
+                    start = time.perf_counter()
+                    self._enhance_for_text(image, tier)
+                    timings.append((time.perf_counter() - start) * 1000)
+            results[tier] = {
+                "mean_ms": float(np.mean(timings)) if timings else 0.0,
+                "max_ms": float(np.max(timings)) if timings else 0.0,
+                "ms_per_megapixel": sum(timings) / total_megapixels if total_megapixels else 0.0
+            }
+        return results
 
 # 创建全局实例
-image_processor = SimpleImageProcessor() 
\ No newline at end of file
+image_processor = SimpleImageProcessor()
+
+# 进程池工作进程内的处理器实例
+_worker_processor = None
+
+
+def _init_ocr_worker():
+    """进程池工作进程初始化（由 ocr_worker.init_worker 在设置好线程数环境变量后调用）"""
+    global _worker_processor
+    cv2.setNumThreads(1)
+    # 工作进程导入本模块时已创建全局实例，直接复用
+    _worker_processor = image_processor
+    
+    # 开启 PROFILE_SAMPLING 时各工作进程单独输出采样结果
+    from profiling import start_worker_sampling
+    start_worker_sampling('ocr-worker')
+
+
+def _submit_to_pool(pool: ProcessPoolExecutor, task: tuple):
+    """向进程池提交任务：先增加队列深度再提交，任务很快完成时完成回调的减少不会先于增加"""
+    QUEUE_DEPTH.inc(queue='ocr_pool')
+    try:
+        return pool.submit(_analyze_task, task)
+    except Exception:
+        QUEUE_DEPTH.dec(queue='ocr_pool')
+        raise
+
+
+def _record_pool_result(future) -> None:
+    """进程池任务完成回调：更新队列深度并记录工作进程中的OCR耗时"""
+    QUEUE_DEPTH.dec(queue='ocr_pool')
+    if future.cancelled() or future.exception() is not None:
+        STAGE_ERRORS.inc(stage='ocr')
+        return
+    observe_stage('ocr', future.result()['elapsed_ms'] / 1000, items=1)
+
+
+def _load_image(source: Union[Image.Image, bytes, str]) -> Image.Image:
+    """从PIL图像、字节或路径加载图片"""
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        image = Image.open(io.BytesIO(source))
+    else:
+        image = Image.open(source)
+    image.load()
+    return image
+
+
+def _analyze_task(task) -> Dict:
+    """批量OCR的单个任务（在工作进程或当前进程中执行）"""
+    index, source, method, tier, return_enhanced, use_layout = task
+    processor = _worker_processor or image_processor
+    start = time.perf_counter()
+    try:
+        result = processor.analyze_image(_load_image(source), method, tier, return_enhanced, use_layout)
+    except Exception as e:
+        result = {'text': '', 'image_type': 'unknown', 'confidence': 0.0, 'error': str(e)}
+    result['index'] = index
+    result['elapsed_ms'] = (time.perf_counter() - start) * 1000
+    return result
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="文本增强档位耗时对比")
+    parser.add_argument("images", nargs="+", help="测试图片路径")
+    parser.add_argument("--repeat", type=int, default=3, help="每张图片重复次数")
+    args = parser.parse_args()
+    
+    test_images = [Image.open(path).convert('RGB') for path in args.images]
+    for tier_name, stats in image_processor.benchmark_text_tiers(test_images, args.repeat).items():
+        print(f"{tier_name:8s} 平均 {stats['mean_ms']:.1f} ms  最大 {stats['max_ms']:.1f} ms  "
+              f"{stats['ms_per_megapixel']:.1f} ms/MP") 
\ No newline at end of file
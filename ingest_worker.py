@@ -0,0 +1,138 @@
+"""
+入库进程
+多进程部署时唯一写索引的进程：从共享任务队列中依次取出上传文件、目录导入、删除集合和重置任务，
+解析、向量化并写入索引，每完成一个任务更新索引版本号，API 工作进程据此重新加载只读索引。
+通过共享存储中的租约保证同一时间只有一个入库进程在运行
+
+用法: python ingest_worker.py（通常由 serve.py 启动）
+"""
+
+import os
+import signal
+import socket
+import threading
+import logging
+from typing import Any, Dict
+from config import Config
+from document_processor import DocumentProcessor
+from vector_store import VectorStore
+from shared_state import SharedStore, get_shared_store
+from tracing import span
+import profiling
+
+logger = logging.getLogger(__name__)
+
+# 入库进程租约名及有效期（秒）；进程异常退出后，租约过期即可由新进程接管
+WRITER_LEASE = "ingest-writer"
+LEASE_TTL = 30.0
+
+
+class IngestWorker:
+    """单写入者入库进程"""
+
+    def __init__(self, store: SharedStore = None, vector_store: VectorStore = None,
+                 document_processor: DocumentProcessor = None):
+        self.store = store or get_shared_store()
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop_event = threading.Event()
+        self.vector_store = vector_store
+        self.document_processor = document_processor or DocumentProcessor(
+            chunk_size=Config.CHUNK_SIZE,
+            chunk_overlap=Config.CHUNK_OVERLAP
+        )
+
+    def stop(self, *args) -> None:
+        self._stop_event.set()
+
+    def _renew_lease(self) -> None:
+        """后台续期租约，处理耗时较长的任务时也不会过期；续期失败时停止处理"""
+        while not self._stop_event.wait(LEASE_TTL / 3):
+            if not self.store.acquire_lease(WRITER_LEASE, self.owner, LEASE_TTL):
+                logger.error("入库进程租约已被其他进程取得，停止处理")
+                self.stop()
+
+    def run(self) -> None:
+        """持续处理任务直至收到停止信号"""
+        while not self.store.acquire_lease(WRITER_LEASE, self.owner, LEASE_TTL):
+            logger.info("已有入库进程在运行，等待其租约过期")
+            if self._stop_event.wait(LEASE_TTL / 3):
+                return
+
+        renewer = threading.Thread(target=self._renew_lease, name="ingest-lease", daemon=True)
+        renewer.start()
+        try:
+            # 取得租约后再加载嵌入模型，避免两个进程同时打开索引写入
+            if self.vector_store is None:
+                self.vector_store = VectorStore()
+            requeued = self.store.requeue_running_jobs()
+            if requeued:
+                logger.info(f"重新排队上次未完成的 {requeued} 个入库任务")
+            logger.info(f"入库进程已启动: {self.owner}")
+
+            while not self._stop_event.is_set():
+                if not self.run_once():
+                    self._stop_event.wait(Config.INGEST_POLL_INTERVAL)
+        finally:
+            self.stop()
+            renewer.join()
+            self.store.release_lease(WRITER_LEASE, self.owner)
+            logger.info("入库进程已停止")
+
+    def run_once(self) -> bool:
+        """处理一个排队任务，没有任务时返回 False"""
+        job = self.store.claim_job()
+        if job is None:
+            return False
+
+        with span("ingest.job", **{"ingest.kind": job["kind"], "ingest.job_id": job["id"]}) as current:
+            try:
+                result = self.process(job["kind"], job["payload"])
+            except Exception as e:
+                current.record_error(e)
+                logger.error(f"入库任务 {job['id']}（{job['kind']}）失败: {e}")
+                self.store.finish_job(job["id"], error=str(e))
+            else:
+                self.store.finish_job(job["id"], result=result)
+                logger.info(f"入库任务 {job['id']}（{job['kind']}）完成: {result}")
+            finally:
+                # 失败的任务也可能已写入部分数据，一律更新版本号让 API 进程重新加载
+                self.store.bump_index_version()
+        return True
+
+    def process(self, kind: str, payload: Dict[str, Any]) -> Dict[str, Any]:
+        collection = payload.get("collection")
+        if kind == "file":
+            chunks = self.document_processor.process_file(payload["path"], payload.get("metadata"))
+            if chunks:
+                self.vector_store.add_documents(chunks, collection)
+            return {"total_chunks": len(chunks)}
+        if kind == "directory":
+            chunks = self.document_processor.process_directory(payload["path"])
+            if chunks:
+                self.vector_store.add_documents(chunks, collection_name=collection)
+            return {"total_chunks": len(chunks)}
+        if kind == "delete_collection":
+            if not self.vector_store.delete_collection(collection):
+                raise RuntimeError("删除集合失败")
+            return {"collection": collection}
+        if kind == "reset":
+            if not self.vector_store.reset():
+                raise RuntimeError("重置知识库失败")
+            return {}
+        raise ValueError(f"不支持的任务类型: {kind}")
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    worker = IngestWorker()
+    signal.signal(signal.SIGTERM, worker.stop)
+    signal.signal(signal.SIGINT, worker.stop)
+    profiling.start_from_env("ingest")
+    worker.run()
+
+
+if __name__ == "__main__":
+    main()
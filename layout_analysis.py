@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+版面分析模块
+用形态学操作和连通域分析把页面切分为文本块、表格（含单元格）、公式和插图区域，
+OCR只需在有内容的区域上运行，空白边距和插图直接跳过
+"""
+
+import cv2
+import numpy as np
+from typing import Dict, List, Tuple
+
+# 区域类型对应的 Tesseract 页面分割模式
+PSM_BY_REGION = {
+    'text': 6,      # 单个均匀文本块
+    'formula': 7,   # 单行
+    'cell': 7,      # 表格单元格按单行识别
+}
+
+# 公式判定阈值：横线状符号（分数线、等号、减号）占比与字符高度离散程度（上下标、根号、积分号）
+FORMULA_MIN_COMPONENTS = 3
+FORMULA_BAR_RATIO = 0.08
+FORMULA_HEIGHT_VARIATION = 0.5
+
+
+def _binarize(gray: np.ndarray) -> np.ndarray:
+    """反色二值化：前景（文字、线条）为255"""
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_MEAN_C, cv2.THRESH_BINARY_INV, 25, 15)
+
+
+def formula_score(binary: np.ndarray) -> Tuple[float, float]:
+    """
+    计算区域的公式特征
+
+    Args:
+        binary: 反色二值图（前景为255）
+
+    Returns:
+        (横线状符号占比, 字符高度离散程度)
+    """
+    _, _, stats, _ = cv2.connectedComponentsWithStats(binary, connectivity=8)
+    stats = stats[1:]
+    stats = stats[stats[:, cv2.CC_STAT_AREA] >= 4]  # 去掉噪点
+    if len(stats) < FORMULA_MIN_COMPONENTS:
+        return 0.0, 0.0
+
+    widths = stats[:, cv2.CC_STAT_WIDTH].astype(np.float32)
+    heights = stats[:, cv2.CC_STAT_HEIGHT].astype(np.float32)
+    median_height = float(np.median(heights))
+    bars = (widths >= heights * 3) & (heights <= max(2.0, median_height * 0.35))
+    bar_ratio = float(np.count_nonzero(bars)) / len(stats)
+    height_variation = float(np.std(heights) / max(median_height, 1.0))
+    return bar_ratio, height_variation
+
+
+def is_formula(binary: np.ndarray) -> bool:
+    """按 formula_score 判断区域（或整张图片）是否为公式，版面分析与图片类型检测共用"""
+    bar_ratio, height_variation = formula_score(binary)
+    return bar_ratio > FORMULA_BAR_RATIO and height_variation > FORMULA_HEIGHT_VARIATION
+
+
+def _find_tables(binary: np.ndarray) -> Tuple[List[Dict], np.ndarray]:
+    """检测表格区域及其单元格，返回 (表格列表, 表格线掩码)"""
+    height, width = binary.shape
+    horizontal = cv2.morphologyEx(
+        binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 30, 10), 1))
+    )
+    vertical = cv2.morphologyEx(
+        binary, cv2.MORPH_OPEN, cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(height // 30, 10)))
+    )
+    grid = cv2.bitwise_or(horizontal, vertical)
+
+    tables = []
+    contours, _ = cv2.findContours(
+        cv2.dilate(grid, np.ones((3, 3), np.uint8)), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE
+    )
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w * h < height * width * 0.01:
+            continue
+        # 表格必须同时含有横线和竖线
+        if not horizontal[y:y + h, x:x + w].any() or not vertical[y:y + h, x:x + w].any():
+            continue
+
+        # 单元格 = 表格框内非线条区域的连通域
+        cell_space = cv2.bitwise_not(cv2.dilate(grid[y:y + h, x:x + w], np.ones((3, 3), np.uint8)))
+        count, _, stats, _ = cv2.connectedComponentsWithStats(cell_space, connectivity=4)
+        cells = []
+        for i in range(1, count):
+            cx, cy, cw, ch, _ = stats[i]
+            if cw < 8 or ch < 8 or cw * ch > w * h * 0.9:
+                continue
+            cells.append((x + int(cx), y + int(cy), int(cw), int(ch)))
+
+        if cells:
+            tables.append({'type': 'table', 'bbox': (x, y, w, h), 'rows': _group_rows(cells)})
+
+    return tables, grid
+
+
+def _group_rows(cells: List[Tuple[int, int, int, int]]) -> List[List[Tuple[int, int, int, int]]]:
+    """按纵向位置把单元格分行，行内按横向位置排序"""
+    rows: List[List[Tuple[int, int, int, int]]] = []
+    for cell in sorted(cells, key=lambda c: (c[1], c[0])):
+        center = cell[1] + cell[3] / 2
+        if rows:
+            last = rows[-1][0]
+            if abs(center - (last[1] + last[3] / 2)) <= last[3] / 2:
+                rows[-1].append(cell)
+                continue
+        rows.append([cell])
+    return [sorted(row, key=lambda c: c[0]) for row in rows]
+
+
+def analyze_layout(gray: np.ndarray) -> List[Dict]:
+    """
+    版面分析
+
+    Args:
+        gray: 灰度（或二值）页面图像
+
+    Returns:
+        按阅读顺序排列的区域列表，每项包含 type（text/table/formula/figure）和 bbox (x, y, w, h)；
+        表格额外包含 rows（按行分组的单元格 bbox）
+    """
+    binary = _binarize(gray)
+    height, width = binary.shape
+
+    tables, grid = _find_tables(binary)
+
+    # 去掉表格线和表格区域，剩余内容按文本块合并
+    content = cv2.bitwise_and(binary, cv2.bitwise_not(grid))
+    for table in tables:
+        x, y, w, h = table['bbox']
+        content[y:y + h, x:x + w] = 0
+
+    # 去除孤立噪点
+    content = cv2.morphologyEx(content, cv2.MORPH_OPEN, np.ones((2, 2), np.uint8))
+
+    # 横向膨胀把字符连成行，纵向少量膨胀把相邻行连成块
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // 60, 9), max(height // 200, 3)))
+    blocks = cv2.dilate(content, kernel)
+    contours, _ = cv2.findContours(blocks, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    regions = list(tables)
+    min_area = max(height * width * 0.0002, 64)
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        if w * h < min_area or h < 6:
+            continue
+
+        block = content[y:y + h, x:x + w]
+        ink_ratio = float(np.count_nonzero(block)) / (w * h)
+
+        # 大面积、高墨水占比的区域视为插图
+        if ink_ratio > 0.45 and w * h > height * width * 0.02:
+            kind = 'figure'
+        else:
+            kind = 'formula' if is_formula(block) else 'text'
+        regions.append({'type': kind, 'bbox': (x, y, w, h)})
+
+    # 阅读顺序：先上后下，同一行内先左后右
+    line_height = max(height // 100, 10)
+    regions.sort(key=lambda r: (r['bbox'][1] // line_height, r['bbox'][0]))
+    return regions
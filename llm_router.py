@@ -0,0 +1,374 @@
+"""
+多服务商大模型路由模块
+为每个兼容 OpenAI 协议的服务商维护最近调用的延迟与错误率，按"错误率加权的中位延迟"选择
+最快的健康服务商；连续失败的服务商熔断一段时间后再放行一次试探请求。
+请求超过所选服务商的 p95 延迟仍未返回时，向下一个服务商发送对冲请求，先返回者胜出；
+请求失败时立即切换到下一个服务商。每个服务商的调用都经过共用的限流器（rate_limiter）
+"""
+
+import json
+import time
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+from config import Config
+from metrics import LLM_CIRCUIT_OPEN, LLM_HEDGES, LLM_PROVIDER_CALLS
+from tracing import span
+from rate_limiter import LimiterTimeoutError, get_limiter, is_rate_limit_error
+from token_usage import estimate_tokens, record_llm_usage
+
+logger = logging.getLogger(__name__)
+
+CIRCUIT_STATES = ("closed", "open", "half_open")
+
+# 计算 p95 前至少需要的成功样本数，不足时使用 LLM_HEDGE_DEFAULT_MS
+MIN_LATENCY_SAMPLES = 5
+
+
+@dataclass
+class ProviderConfig:
+    """一个兼容 OpenAI 协议的大模型服务"""
+    name: str
+    base_url: str
+    api_key: str
+    model: str
+    timeout: float = None
+
+
+@dataclass
+class LLMResponse:
+    """路由后的一次调用结果；服务商未返回用量时 token 数为 None"""
+    content: str
+    provider: str
+    model: str
+    prompt_tokens: Optional[int]
+    completion_tokens: Optional[int]
+    latency_ms: float
+    hedged: bool = False
+
+
+class LLMRouterError(Exception):
+    """所有候选服务商都失败或不可用"""
+
+    def __init__(self, errors: List[Tuple[str, BaseException]]):
+        detail = "; ".join(f"{name}: {error}" for name, error in errors) or "所有服务商均处于熔断状态"
+        super().__init__(f"大模型调用失败（{detail}）")
+        self.errors = errors
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class ProviderStats:
+    """服务商的滚动统计与熔断状态，线程安全"""
+
+    def __init__(self, name: str, window: int = None, failure_threshold: int = None, cooldown: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or Config.LLM_CIRCUIT_FAILURES
+        self.cooldown = cooldown if cooldown is not None else Config.LLM_CIRCUIT_COOLDOWN
+        # (延迟毫秒, 是否成功)
+        self._calls: deque = deque(maxlen=window or Config.LLM_STATS_WINDOW)
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_inflight = False
+
+    def _set_state(self, state: str) -> None:
+        if state != self.state:
+            logger.info(f"服务商 {self.name} 熔断状态: {self.state} -> {state}")
+        self.state = state
+        LLM_CIRCUIT_OPEN.set(1 if state == "open" else 0, provider=self.name)
+
+    def is_available(self) -> bool:
+        """是否可以参与选择（不改变状态）"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open":
+                return time.monotonic() - self.opened_at >= self.cooldown
+            return not self._trial_inflight
+
+    def allow_request(self) -> bool:
+        """发送请求前调用：熔断冷却结束后只放行一个试探请求"""
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at < self.cooldown:
+                return False
+            if self._trial_inflight:
+                return False
+            self._set_state("half_open")
+            self._trial_inflight = True
+            return True
+
+    def record(self, latency_ms: float, ok: bool) -> None:
+        with self._lock:
+            self._calls.append((latency_ms, ok))
+            if self.state == "half_open":
+                self._trial_inflight = False
+                if ok:
+                    self.consecutive_failures = 0
+                    self._set_state("closed")
+                else:
+                    self.opened_at = time.monotonic()
+                    self._set_state("open")
+                return
+            if ok:
+                self.consecutive_failures = 0
+                return
+            self.consecutive_failures += 1
+            if self.state == "closed" and self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state("open")
+
+    def release_trial(self) -> None:
+        """试探请求因限流未能得出结果时调用：不改变熔断状态，下一个请求可以重新试探"""
+        with self._lock:
+            self._trial_inflight = False
+
+    def latency_percentile(self, q: float) -> Optional[float]:
+        """最近成功调用的延迟分位数（毫秒），样本不足时返回 None"""
+        with self._lock:
+            latencies = [latency for latency, ok in self._calls if ok]
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return _percentile(latencies, q)
+
+    def error_rate(self) -> float:
+        with self._lock:
+            if not self._calls:
+                return 0.0
+            return sum(1 for _, ok in self._calls if not ok) / len(self._calls)
+
+    def score(self) -> float:
+        """选择用的得分，越小越优先；还没有足够样本的服务商得分为 0，会被优先试用"""
+        p50 = self.latency_percentile(50)
+        if p50 is None:
+            return 0.0
+        return p50 * (1 + 2 * self.error_rate())
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = len(self._calls)
+        return {
+            "provider": self.name,
+            "state": self.state,
+            "calls": calls,
+            "error_rate": round(self.error_rate(), 3),
+            "p50_ms": self.latency_percentile(50),
+            "p95_ms": self.latency_percentile(95),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class LLMProvider:
+    """服务商客户端及其统计"""
+
+    def __init__(self, config: ProviderConfig):
+        self.config = config
+        self.name = config.name
+        self.stats = ProviderStats(config.name)
+        self.limiter = get_limiter(config.name, config.api_key)
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            from openai import OpenAI
+            # 失败切换由路由负责、429 重试由限流器负责，客户端自身不重试
+            self._client = OpenAI(api_key=self.config.api_key, base_url=self.config.base_url,
+                                  timeout=self.config.timeout or Config.LLM_REQUEST_TIMEOUT, max_retries=0)
+        return self._client
+
+    def complete(self, messages: List[Dict[str, str]], **params) -> LLMResponse:
+        start = time.perf_counter()
+        response = self.client.chat.completions.create(
+            model=self.config.model,
+            messages=messages,
+            **{key: value for key, value in params.items() if value is not None}
+        )
+        usage = getattr(response, "usage", None)
+        return LLMResponse(
+            content=response.choices[0].message.content or "",
+            provider=self.name,
+            model=getattr(response, "model", None) or self.config.model,
+            prompt_tokens=getattr(usage, "prompt_tokens", None),
+            completion_tokens=getattr(usage, "completion_tokens", None),
+            latency_ms=(time.perf_counter() - start) * 1000
+        )
+
+
+class LLMRouter:
+    """在多个服务商之间按延迟和健康状况路由，支持失败切换和对冲请求"""
+
+    def __init__(self, providers: List[ProviderConfig], hedging: bool = None, max_workers: int = 16):
+        if not providers:
+            raise ValueError("至少需要配置一个大模型服务")
+        self.providers = [LLMProvider(config) for config in providers]
+        self.hedging = Config.LLM_HEDGING if hedging is None else hedging
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-router")
+
+    @classmethod
+    def from_config(cls) -> "LLMRouter":
+        """从 LLM_PROVIDERS（JSON 列表）创建；未配置时只使用 OPENAI_* 对应的服务"""
+        if Config.LLM_PROVIDERS:
+            items = json.loads(Config.LLM_PROVIDERS)
+            providers = [ProviderConfig(name=item["name"], base_url=item.get("base_url"),
+                                        api_key=item["api_key"], model=item["model"],
+                                        timeout=item.get("timeout")) for item in items]
+        else:
+            providers = [ProviderConfig(name="openai", base_url=Config.OPENAI_API_BASE or None,
+                                        api_key=Config.OPENAI_API_KEY, model=Config.OPENAI_MODEL)]
+        return cls(providers)
+
+    @property
+    def provider_names(self) -> List[str]:
+        return [provider.name for provider in self.providers]
+
+    def candidates(self, prefer: Optional[str] = None) -> List[LLMProvider]:
+        """可用的服务商，按得分排序；prefer 指定的服务商可用时排在首位"""
+        if prefer and prefer not in self.provider_names:
+            raise ValueError(f"未知的大模型服务: {prefer}，可选: {', '.join(self.provider_names)}")
+        # 并发已满需要排队的服务商排在后面
+        available = sorted((provider for provider in self.providers if provider.stats.is_available()),
+                           key=lambda provider: (provider.limiter.saturated(), provider.stats.score()))
+        if prefer:
+            available.sort(key=lambda provider: provider.name != prefer)
+        return available
+
+    def hedge_delay(self, provider: LLMProvider) -> float:
+        """发送对冲请求前的等待时间（秒）：该服务商的 p95 延迟，不低于 LLM_HEDGE_MIN_MS"""
+        p95 = provider.stats.latency_percentile(95)
+        delay_ms = p95 if p95 is not None else Config.LLM_HEDGE_DEFAULT_MS
+        return max(delay_ms, Config.LLM_HEDGE_MIN_MS) / 1000
+
+    def _attempt(self, provider: LLMProvider, messages: List[Dict[str, str]], params: Dict[str, Any],
+                 hedged: bool, retries: Optional[int]) -> LLMResponse:
+        with span("llm.provider", kind="client", **{"llm.provider": provider.name,
+                                                    "llm.model": provider.config.model,
+                                                    "llm.hedged": hedged}):
+            estimated = (sum(estimate_tokens(message.get("content") or "") for message in messages)
+                         + (params.get("max_tokens") or Config.LLM_EXPECTED_COMPLETION_TOKENS))
+            start = time.perf_counter()
+            try:
+                response = provider.limiter.call(lambda: provider.complete(messages, **params),
+                                                 estimated_tokens=estimated, retries=retries)
+            except Exception as e:
+                if isinstance(e, LimiterTimeoutError) or is_rate_limit_error(e):
+                    # 本地排队超时或服务商返回 429 都是限流，不计入熔断和错误率统计，由调用方切换到其他服务商
+                    provider.stats.release_trial()
+                    LLM_PROVIDER_CALLS.inc(provider=provider.name, outcome="throttled")
+                    raise
+                provider.stats.record((time.perf_counter() - start) * 1000, ok=False)
+                LLM_PROVIDER_CALLS.inc(provider=provider.name, outcome="error")
+                raise
+            provider.stats.record(response.latency_ms, ok=True)
+            if response.prompt_tokens is not None:
+                provider.limiter.record_usage(estimated, response.prompt_tokens + (response.completion_tokens or 0))
+            LLM_PROVIDER_CALLS.inc(provider=provider.name, outcome="ok")
+            response.hedged = hedged
+            return response
+
+    def chat(self, messages: List[Dict[str, str]], prefer: Optional[str] = None, **params) -> LLMResponse:
+        """
+        发送一次对话请求
+
+        Args:
+            messages: OpenAI 格式的消息列表
+            prefer: 优先使用的服务商名称，不可用时自动切换
+            params: temperature / max_tokens / stop 等请求参数
+
+        Raises:
+            LLMRouterError: 所有候选服务商都失败或处于熔断状态
+        """
+        candidates = self.candidates(prefer)
+        errors: List[Tuple[str, BaseException]] = []
+        pending: Dict[Any, LLMProvider] = {}
+        remaining = list(candidates)
+
+        def launch(hedged: bool) -> Optional[LLMProvider]:
+            while remaining:
+                provider = remaining.pop(0)
+                if not provider.stats.allow_request():
+                    continue
+                # 还有其他服务商可切换时遇到 429 不在原地重试；在当前上下文的副本中执行，保留 trace 和用量上下文
+                retries = 0 if remaining else None
+                future = self._executor.submit(contextvars.copy_context().run,
+                                               self._attempt, provider, messages, params, hedged, retries)
+                pending[future] = provider
+                return provider
+            return None
+
+        primary = launch(hedged=False)
+        hedge_at = time.monotonic() + self.hedge_delay(primary) if primary and self.hedging else None
+        while pending:
+            timeout = max(0.0, hedge_at - time.monotonic()) if hedge_at and remaining else None
+            done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                # 超过 p95 仍未返回：向下一个服务商发送对冲请求，先返回者胜出
+                hedge = launch(hedged=True)
+                hedge_at = None
+                if hedge is not None:
+                    LLM_HEDGES.inc(provider=hedge.name)
+                    logger.info(f"服务商 {primary.name} 超过 {self.hedge_delay(primary):.2f}s 未返回，"
+                                f"已向 {hedge.name} 发送对冲请求")
+                continue
+            for future in done:
+                provider = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(f"服务商 {provider.name} 调用失败: {e}")
+                    errors.append((provider.name, e))
+                    continue
+                # 其余仍在进行的请求在后台完成并照常计费：结束时记录其用量，统计由 _attempt 更新
+                context = contextvars.copy_context()
+                for loser in pending:
+                    loser.add_done_callback(lambda f: context.run(self._record_hedge_usage, f, messages))
+                return result
+            if not pending:
+                # 失败切换：立即尝试下一个服务商
+                primary = launch(hedged=False)
+                if primary is not None and self.hedging:
+                    hedge_at = time.monotonic() + self.hedge_delay(primary)
+        raise LLMRouterError(errors)
+
+    @staticmethod
+    def _record_hedge_usage(future, messages: List[Dict[str, str]]) -> None:
+        """记录落败的对冲/主请求的 token 用量（stage=hedge）；失败的请求不计费，不记录"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        response = future.result()
+        prompt_tokens, completion_tokens, estimated = response.prompt_tokens, response.completion_tokens, False
+        if prompt_tokens is None or completion_tokens is None:
+            prompt_tokens = estimate_tokens("".join(message.get("content") or "" for message in messages))
+            completion_tokens, estimated = estimate_tokens(response.content), True
+        record_llm_usage("hedge", response.model, prompt_tokens, completion_tokens, estimated=estimated,
+                         latency_ms=response.latency_ms, provider=response.provider)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """各服务商的统计与熔断状态"""
+        return [{**provider.stats.snapshot(), **provider.limiter.status(), "model": provider.config.model}
+                for provider in self.providers]
+
+
+_router: Optional[LLMRouter] = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> LLMRouter:
+    """进程内共享的路由实例（按配置创建）"""
+    global _router
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = LLMRouter.from_config()
+    return _router
@@ -0,0 +1,271 @@
+"""
+运行指标模块
+进程内的计数器、仪表和直方图，按 Prometheus 文本格式导出（/metrics 接口）。
+各处理阶段用 timed(stage) 记录耗时，阶段名取自 STAGES：
+parse / split / embed / persist / retrieve / rerank / llm_condense / llm_answer / ocr
+"""
+
+import math
+import time
+import threading
+from abc import ABC, abstractmethod
+from contextlib import ContextDecorator, contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+STAGES = ("parse", "split", "embed", "persist", "retrieve", "rerank", "llm_condense", "llm_answer", "ocr")
+
+# 秒；覆盖从毫秒级检索到数十秒的大模型调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class _Metric(ABC):
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签应为 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _label_text(self, key: LabelValues, extra: Optional[Dict[str, str]] = None) -> str:
+        pairs = list(zip(self.labelnames, key)) + list((extra or {}).items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    @abstractmethod
+    def samples(self) -> Iterator[str]:
+        """按 Prometheus 文本格式逐行输出样本"""
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}", *self.samples()]
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{self._label_text(key)} {_format_value(value)}"
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值（队列深度、进行中的调用数等）"""
+
+    type_name = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels) -> None:
+        self.inc(-amount, **labels)
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        """进入时加一，退出时减一"""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{self._label_text(key)} {_format_value(value)}"
+
+
+class Histogram(_Metric):
+    """累积分桶直方图"""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # 标签值 -> [各桶计数, 总和, 总数]
+        self._values: Dict[LabelValues, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def snapshot(self, **labels) -> Dict[str, float]:
+        """某组标签的计数与总和"""
+        state = self._values.get(self._key(labels))
+        if state is None:
+            return {"count": 0, "sum": 0.0}
+        return {"count": state[2], "sum": state[1]}
+
+    def samples(self) -> Iterator[str]:
+        with self._lock:
+            items = sorted((key, ([*state[0]], state[1], state[2])) for key, state in self._values.items())
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{self._label_text(key, {'le': _format_value(bound)})} {cumulative}"
+            yield f"{self.name}_sum{self._label_text(key)} {_format_value(total)}"
+            yield f"{self.name}_count{self._label_text(key)} {count}"
+
+
+class MetricsRegistry:
+    """指标注册表，同名指标只创建一次"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, cls, name: str, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"指标 {name} 已注册为 {metric.type_name}")
+            return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._get_or_create(Counter, name, documentation, labelnames)
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._get_or_create(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get_or_create(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self) -> str:
+        """Prometheus 文本格式（0.0.4）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+STAGE_SECONDS = REGISTRY.histogram("kb_stage_duration_seconds", "各处理阶段耗时", ("stage",))
+STAGE_ERRORS = REGISTRY.counter("kb_stage_errors_total", "各处理阶段失败次数", ("stage",))
+STAGE_ITEMS = REGISTRY.counter("kb_stage_items_total", "各处理阶段处理的条目数（文档块、查询、图片等）", ("stage",))
+CACHE_EVENTS = REGISTRY.counter("kb_cache_events_total", "缓存命中与未命中次数", ("cache", "result"))
+QUEUE_DEPTH = REGISTRY.gauge("kb_queue_depth", "等待处理的任务数", ("queue",))
+LLM_INFLIGHT = REGISTRY.gauge("kb_llm_inflight_calls", "进行中的大模型调用数", ("stage",))
+LLM_TOKENS = REGISTRY.counter("kb_llm_tokens_total", "大模型调用的token数（kind 为 prompt / completion）",
+                              ("model", "kind", "endpoint"))
+LLM_COST = REGISTRY.counter("kb_llm_cost_usd_total", "按价格表估算的大模型调用费用（美元）", ("model", "endpoint"))
+LLM_PROVIDER_CALLS = REGISTRY.counter("kb_llm_provider_calls_total", "路由到各服务商的调用次数（outcome 为 ok / error / throttled）",
+                                      ("provider", "outcome"))
+LLM_HEDGES = REGISTRY.counter("kb_llm_hedged_requests_total", "发送到各服务商的对冲请求数", ("provider",))
+LLM_CIRCUIT_OPEN = REGISTRY.gauge("kb_llm_circuit_open", "服务商是否处于熔断状态（1 为熔断）", ("provider",))
+LLM_CONCURRENCY_LIMIT = REGISTRY.gauge("kb_llm_concurrency_limit", "各服务商当前的自适应并发上限", ("provider",))
+LLM_THROTTLED = REGISTRY.counter("kb_llm_rate_limited_total", "服务商返回 429 的次数", ("provider",))
+LLM_LIMITER_WAIT = REGISTRY.histogram("kb_llm_limiter_wait_seconds", "调用在限流器中排队等待的时间", ("provider",))
+HTTP_SECONDS = REGISTRY.histogram("kb_http_request_duration_seconds", "HTTP请求耗时", ("method", "route", "status"))
+
+
+class timed(ContextDecorator):
+    """
+    记录一个阶段的耗时，可用作上下文管理器或装饰器
+
+        with timed("embed", items=len(texts)):
+            ...
+
+    阶段内抛出异常时同时计入 kb_stage_errors_total
+    """
+
+    def __init__(self, stage: str, items: int = 0):
+        self.stage = stage
+        self.items = items
+        self.elapsed = 0.0
+
+    def _recreate_cm(self):
+        # 作为装饰器时每次调用使用新实例，支持并发和递归调用
+        return type(self)(self.stage, self.items)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self._start
+        STAGE_SECONDS.observe(self.elapsed, stage=self.stage)
+        if self.items:
+            STAGE_ITEMS.inc(self.items, stage=self.stage)
+        if exc_type is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+        return False
+
+
+def observe_stage(stage: str, seconds: float, items: int = 0) -> None:
+    """记录在别处（如工作进程中）测得的阶段耗时"""
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    if items:
+        STAGE_ITEMS.inc(items, stage=stage)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    """记录一次缓存查询结果"""
+    CACHE_EVENTS.inc(cache=cache, result="hit" if hit else "miss")
@@ -0,0 +1,54 @@
+"""
+批量OCR进程池的工作进程入口
+进程池以 spawn 方式启动工作进程（不从可能已有多个线程的父进程 fork，避免继承被其他线程持有的锁而死锁）。
+spawn 默认会在子进程中以 __mp_main__ 重新执行父进程的主模块：python api.py 时会再加载一遍嵌入模型、
+打开索引并创建问答引擎，Streamlit 下则会重跑整个页面脚本。本模块提供的进程上下文启动工作进程时
+不重新导入主模块，工作进程只导入本模块（不依赖 OpenCV / Tesseract）和 enhanced_ocr；
+初始化函数在导入 enhanced_ocr 之前设置线程数，OpenMP 只在库加载时读取这些环境变量
+"""
+
+import os
+import threading
+from multiprocessing import spawn
+from multiprocessing.context import SpawnContext, SpawnProcess
+
+_local = threading.local()
+_get_preparation_data = spawn.get_preparation_data
+
+
+def _preparation_data(name):
+    """子进程准备数据；由本模块的进程类启动时去掉重新导入主模块的信息，其他进程不受影响"""
+    data = _get_preparation_data(name)
+    if getattr(_local, "skip_main", False):
+        data.pop("init_main_from_path", None)
+        data.pop("init_main_from_name", None)
+    return data
+
+
+spawn.get_preparation_data = _preparation_data
+
+
+class OCRWorkerProcess(SpawnProcess):
+    """不重新导入父进程主模块的 spawn 进程"""
+
+    def start(self):
+        _local.skip_main = True
+        try:
+            super().start()
+        finally:
+            _local.skip_main = False
+
+
+class OCRWorkerContext(SpawnContext):
+    """批量OCR进程池使用的进程上下文"""
+
+    Process = OCRWorkerProcess
+
+
+def init_worker():
+    """进程池工作进程初始化：每个进程只用一个线程跑OpenCV/Tesseract，避免进程间争抢CPU"""
+    os.environ['OMP_THREAD_LIMIT'] = '1'
+    os.environ['OMP_NUM_THREADS'] = '1'
+
+    import enhanced_ocr
+    enhanced_ocr._init_ocr_worker()
@@ -0,0 +1,304 @@
+"""
+PDF文本提取模块
+项目中所有PDF文本提取的统一入口：默认用 PyMuPDF 逐页提取，表格较多的页面改用
+pdfplumber 按表格结构提取，也可整体切换到 pdfplumber 或 PyPDF2；没有文本层的扫描页
+按指定DPI栅格化后提交到增强OCR进程池并行识别。页面以生成器逐页产出，调用方无需
+等待整本PDF处理完毕
+"""
+
+import io
+import os
+import time
+import logging
+from concurrent.futures import wait, FIRST_COMPLETED
+from typing import Dict, Any, Iterator, List, Sequence, Union, IO
+
+import fitz
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+PDF_BACKENDS = ("pymupdf", "pdfplumber", "pypdf2")
+
+PdfSource = Union[str, bytes, IO[bytes]]
+
+
+def _normalize_source(source: PdfSource) -> Union[str, bytes]:
+    """把文件对象读成字节串，以便多个后端重复打开同一份PDF"""
+    if isinstance(source, str):
+        return source
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    if hasattr(source, "seek"):
+        source.seek(0)
+    return source.read()
+
+
+def open_pdf(source: PdfSource) -> "fitz.Document":
+    """打开PDF，支持文件路径、字节串和文件对象（如 Streamlit 上传文件）"""
+    source = _normalize_source(source)
+    if isinstance(source, str):
+        return fitz.open(source)
+    return fitz.open(stream=source, filetype="pdf")
+
+
+def is_table_heavy(page: "fitz.Page", min_lines: int = None, textpage: "fitz.TextPage" = None) -> bool:
+    """
+    根据页面矢量图形中的水平/竖直线段数判断是否为表格页
+
+    get_drawings 需要解析页面全部矢量图形，开销较大；先用文本块数量排除普通正文页，
+    传入已解析的 textpage 时不再重复解析文本
+    """
+    if len(page.get_text("blocks", textpage=textpage)) < Config.PDF_TABLE_MIN_BLOCKS:
+        return False
+
+    min_lines = min_lines or Config.PDF_TABLE_RULING_LINES
+    rulings = 0
+    for drawing in page.get_drawings():
+        for item in drawing["items"]:
+            if item[0] == "l":
+                start, end = item[1], item[2]
+                if abs(start.x - end.x) < 1 or abs(start.y - end.y) < 1:
+                    rulings += 1
+            elif item[0] == "re":
+                # 细长矩形常被用来画表格线
+                rect = item[1]
+                if min(rect.width, rect.height) < 2:
+                    rulings += 1
+        if rulings >= min_lines:
+            return True
+    return False
+
+
+class _LazyReaders:
+    """按需打开 pdfplumber / PyPDF2，只在确实用到时才付出解析开销"""
+
+    def __init__(self, source: Union[str, bytes]):
+        self.source = source
+        self._plumber = None
+        self._pypdf = None
+
+    def _stream(self):
+        return self.source if isinstance(self.source, str) else io.BytesIO(self.source)
+
+    def plumber_page(self, index: int):
+        if self._plumber is None:
+            import pdfplumber
+            self._plumber = pdfplumber.open(self._stream())
+        return self._plumber.pages[index]
+
+    def pypdf_page(self, index: int):
+        if self._pypdf is None:
+            import PyPDF2
+            self._pypdf = PyPDF2.PdfReader(self._stream())
+        return self._pypdf.pages[index]
+
+    def close(self) -> None:
+        if self._plumber is not None:
+            self._plumber.close()
+
+
+def _plumber_page_text(page) -> str:
+    """用 pdfplumber 提取页面：表格外的文字按版面提取，表格按行输出，单元格以 | 分隔"""
+    tables = page.find_tables()
+    if not tables:
+        return page.extract_text() or ""
+
+    bboxes = [table.bbox for table in tables]
+
+    def outside_tables(obj) -> bool:
+        if obj.get("object_type") != "char":
+            return True
+        return not any(x0 <= obj["x0"] and obj["x1"] <= x1 and top <= obj["top"] and obj["bottom"] <= bottom
+                       for x0, top, x1, bottom in bboxes)
+
+    parts = [page.filter(outside_tables).extract_text() or ""]
+    for table in tables:
+        rows = table.extract()
+        parts.append("\n".join(
+            " | ".join((cell or "").replace("\n", " ") for cell in row) for row in rows
+        ))
+    return "\n".join(part for part in parts if part.strip())
+
+
+def needs_ocr(page: "fitz.Page", text: str) -> bool:
+    """判断页面是否缺少可用文本层（文字过少且页面上有图片）"""
+    return len(text.strip()) < Config.PDF_MIN_TEXT_CHARS and bool(page.get_images(full=False))
+
+
+def rasterize_page(page: "fitz.Page", dpi: int = None) -> bytes:
+    """把页面渲染为灰度PNG字节串，便于跨进程传递"""
+    pixmap = page.get_pixmap(dpi=dpi or Config.PDF_OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+    return pixmap.tobytes("png")
+
+
+def iter_pdf_pages(source: PdfSource, backend: str = None, ocr: bool = True, dpi: int = None,
+                   max_workers: int = None, method: str = 'text',
+                   detect_tables: bool = True) -> Iterator[Dict[str, Any]]:
+    """
+    逐页提取PDF文本
+
+    Args:
+        source: PDF文件路径、字节串或文件对象
+        backend: 提取后端 pymupdf / pdfplumber / pypdf2，默认取 Config.PDF_BACKEND
+        ocr: 是否对扫描页做OCR，为False时扫描页返回空文本
+        dpi: 扫描页栅格化分辨率，默认取 Config.PDF_OCR_DPI
+        max_workers: 同时在OCR进程池中识别的页数上限，默认不限制（由进程池大小决定并行度）
+        method: 扫描页的图像增强方法
+        detect_tables: pymupdf 后端下是否把表格页交给 pdfplumber
+
+    Yields:
+        {"page": 页码（从1开始）, "text": 文本, "source": "text"/"ocr",
+         "backend": 实际使用的提取器, "elapsed_ms": 耗时}；
+        文本层页面按顺序立即产出，OCR页面在识别完成时产出，因此整体不保证页码顺序
+    """
+    backend = backend or Config.PDF_BACKEND
+    if backend not in PDF_BACKENDS:
+        raise ValueError(f"不支持的PDF提取后端: {backend}")
+
+    pending = {}
+    image_processor = None
+
+    source = _normalize_source(source)
+    readers = _LazyReaders(source)
+    doc = open_pdf(source)
+    try:
+        for page in doc:
+            start = time.perf_counter()
+            page_backend = backend
+            if backend == "pypdf2":
+                text = readers.pypdf_page(page.number).extract_text() or ""
+            else:
+                # 文本只解析一次，表格判断和文本提取共用
+                textpage = page.get_textpage() if backend == "pymupdf" else None
+                if backend == "pdfplumber" or (detect_tables and is_table_heavy(page, textpage=textpage)):
+                    page_backend = "pdfplumber"
+                    text = _plumber_page_text(readers.plumber_page(page.number))
+                else:
+                    text = page.get_text("text", textpage=textpage)
+
+            if not ocr or not needs_ocr(page, text):
+                yield {
+                    "page": page.number + 1,
+                    "text": text,
+                    "source": "text",
+                    "backend": page_backend,
+                    "elapsed_ms": (time.perf_counter() - start) * 1000
+                }
+            else:
+                if image_processor is None:
+                    # 延迟导入：只有遇到扫描页时才加载OCR依赖
+                    from enhanced_ocr import image_processor
+                # 达到本次调用的并发上限时先等待已提交的页面完成
+                while max_workers and len(pending) >= max_workers:
+                    done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield _ocr_page_result(future, *pending.pop(future))
+                future = image_processor.submit_analyze(rasterize_page(page, dpi), method=method)
+                pending[future] = (page.number + 1, start)
+
+            # 顺带产出已经完成的OCR页面，不必等到全部页面提交完
+            for future in [f for f in pending if f.done()]:
+                yield _ocr_page_result(future, *pending.pop(future))
+    finally:
+        doc.close()
+        readers.close()
+
+    while pending:
+        done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+        for future in done:
+            yield _ocr_page_result(future, *pending.pop(future))
+
+
+def _ocr_page_result(future, page_number: int, start: float) -> Dict[str, Any]:
+    """把OCR任务结果转换为页面结果"""
+    try:
+        result = future.result()
+        if result.get("error"):
+            logger.warning(f"第 {page_number} 页OCR失败: {result['error']}")
+        text = result.get("text", "")
+    except Exception as e:
+        logger.warning(f"第 {page_number} 页OCR失败: {e}")
+        text = ""
+    return {
+        "page": page_number,
+        "text": text,
+        "source": "ocr",
+        "backend": "ocr",
+        "elapsed_ms": (time.perf_counter() - start) * 1000
+    }
+
+
+def extract_pdf_text(source: PdfSource, backend: str = None, ocr: bool = True, dpi: int = None,
+                     max_workers: int = None) -> str:
+    """提取整本PDF的文本，页面按页码顺序拼接"""
+    pages: List[Dict[str, Any]] = sorted(
+        iter_pdf_pages(source, backend=backend, ocr=ocr, dpi=dpi, max_workers=max_workers),
+        key=lambda p: p["page"]
+    )
+    ocr_pages = sum(1 for p in pages if p["source"] == "ocr")
+    if ocr_pages:
+        logger.info(f"PDF共 {len(pages)} 页，其中 {ocr_pages} 页为扫描页，已通过OCR识别")
+    return "\n".join(p["text"].strip() for p in pages if p["text"].strip())
+
+
+def benchmark_backends(paths: Sequence[str], backends: Sequence[str] = PDF_BACKENDS,
+                       repeat: int = 1, detect_tables: bool = True) -> Dict[str, Dict[str, Any]]:
+    """
+    在给定PDF语料上对比各提取后端的耗时（不做OCR，只比较文本层提取）
+
+    Returns:
+        {后端: {"pages", "chars", "total_ms", "ms_per_page", "errors"}}
+    """
+    results = {}
+    for backend in backends:
+        pages = chars = errors = 0
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for path in paths:
+                try:
+                    for page in iter_pdf_pages(path, backend=backend, ocr=False, detect_tables=detect_tables):
+                        pages += 1
+                        chars += len(page["text"])
+                except Exception as e:
+                    errors += 1
+                    logger.warning(f"{backend} 提取 {path} 失败: {e}")
+        total_ms = (time.perf_counter() - start) * 1000
+        results[backend] = {
+            "pages": pages // repeat,
+            "chars": chars // repeat,
+            "total_ms": total_ms / repeat,
+            "ms_per_page": total_ms / pages if pages else 0.0,
+            "errors": errors
+        }
+    return results
+
+
+def _collect_pdfs(paths: Sequence[str]) -> List[str]:
+    """展开目录参数，收集其中所有PDF文件"""
+    collected = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                collected.extend(os.path.join(root, name) for name in sorted(files) if name.lower().endswith(".pdf"))
+        else:
+            collected.append(path)
+    return collected
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="PDF提取后端耗时对比")
+    parser.add_argument("paths", nargs="*", default=[Config.UPLOAD_DIR], help="PDF文件或目录（默认上传目录）")
+    parser.add_argument("--repeat", type=int, default=1, help="重复次数")
+    parser.add_argument("--backends", nargs="+", default=list(PDF_BACKENDS), choices=PDF_BACKENDS)
+    parser.add_argument("--no-table-detect", action="store_true", help="pymupdf 后端不切换表格页")
+    args = parser.parse_args()
+
+    pdf_paths = _collect_pdfs(args.paths)
+    print(f"共 {len(pdf_paths)} 个PDF文件")
+    for backend_name, stats in benchmark_backends(pdf_paths, args.backends, args.repeat,
+                                                  not args.no_table_detect).items():
+        print(f"{backend_name:10s} {stats['pages']:5d} 页  {stats['chars']:8d} 字符  "
+              f"总计 {stats['total_ms']:.0f} ms  {stats['ms_per_page']:.2f} ms/页  失败 {stats['errors']}")
@@ -0,0 +1,297 @@
+"""
+按需性能剖析模块
+- 采样剖析：后台线程定时读取所有线程的调用栈（sys._current_frames），按 flamegraph.pl / speedscope
+  可直接读取的折叠栈格式（每行 "线程;函数 (文件);... 次数"）写入 PROFILE_DIR。
+  可通过环境变量 PROFILE_SAMPLING 在启动时开启，或运行中通过管理接口开关，无需重启服务
+- 单请求剖析：请求携带 PROFILE_HEADER 头（并通过管理令牌校验）时用 cProfile 记录该请求，
+  包括交给线程池执行的部分，结果合并保存为 .prof 文件（可用 snakeviz、flameprof 等工具查看）
+"""
+
+import os
+import re
+import sys
+import hmac
+import time
+import pstats
+import cProfile
+import logging
+import functools
+import threading
+import contextvars
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Any
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 被判定为空闲等待的栈顶函数，默认不计入采样（事件循环、线程池和条件变量上的等待）
+_IDLE_LEAVES = {
+    ("wait", "threading.py"),
+    ("_wait_for_tstate_lock", "threading.py"),
+    ("select", "selectors.py"),
+    ("poll", "selectors.py"),
+    ("_worker", "thread.py"),
+    ("accept", "socket.py"),
+}
+
+
+def _profile_path(prefix: str, suffix: str, label: str = "") -> str:
+    os.makedirs(Config.PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r"[^0-9A-Za-z_.-]+", "_", label).strip("_")[:60]
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    name = "-".join(part for part in (prefix, stamp, str(os.getpid()), slug) if part)
+    return os.path.join(Config.PROFILE_DIR, f"{name}{suffix}")
+
+
+class SamplingProfiler:
+    """基于定时采样的低开销剖析器，可在运行中反复开启和停止"""
+
+    def __init__(self, name: str = "api", interval: float = None, flush_interval: float = 30.0,
+                 include_idle: bool = False):
+        self.name = name
+        self.interval = interval if interval is not None else Config.PROFILE_SAMPLE_INTERVAL_MS / 1000
+        self.flush_interval = flush_interval
+        self.include_idle = include_idle
+        self.samples = 0
+        self.path: Optional[str] = None
+        self.started_at: Optional[float] = None
+        self._counts: Counter = Counter()
+        self._labels: Dict[Any, str] = {}
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._timer: Optional[threading.Timer] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, interval: float = None, duration: float = None) -> bool:
+        """开始采样；duration 秒后自动停止。已在运行时返回 False"""
+        with self._lock:
+            if self.running:
+                return False
+            if interval:
+                self.interval = interval
+            self._counts = Counter()
+            self.samples = 0
+            self.started_at = time.time()
+            self.path = _profile_path("sample", ".folded", self.name)
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+            self._thread.start()
+            if duration:
+                self._timer = threading.Timer(duration, self.stop)
+                self._timer.daemon = True
+                self._timer.start()
+        logger.info(f"采样剖析已开始，间隔 {self.interval * 1000:.1f} ms，输出 {self.path}")
+        return True
+
+    def stop(self) -> Optional[str]:
+        """停止采样并写出折叠栈文件，返回文件路径；未在运行时返回 None"""
+        with self._lock:
+            thread = self._thread
+            if thread is None:
+                return None
+            self._stop_event.set()
+            self._thread = None
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        if thread is not threading.current_thread():
+            thread.join()
+        self.write()
+        logger.info(f"采样剖析已停止，共 {self.samples} 次采样，结果已写入 {self.path}")
+        return self.path
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "running": self.running,
+            "interval_ms": self.interval * 1000,
+            "samples": self.samples,
+            "started_at": self.started_at,
+            "path": self.path,
+        }
+
+    def write(self) -> None:
+        """把目前累计的采样写入文件（覆盖写，内容为累计值）"""
+        if not self.path:
+            return
+        with self._lock:
+            lines = [f"{stack} {count}\n" for stack, count in self._counts.most_common()]
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.writelines(lines)
+        os.replace(temp_path, self.path)
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)})"
+        return label
+
+    def _run(self) -> None:
+        own_ident = threading.get_ident()
+        next_flush = time.monotonic() + self.flush_interval
+        while not self._stop_event.wait(self.interval):
+            thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own_ident:
+                    continue
+                code = frame.f_code
+                if not self.include_idle and (code.co_name, os.path.basename(code.co_filename)) in _IDLE_LEAVES:
+                    continue
+                labels = []
+                while frame is not None:
+                    labels.append(self._label(frame.f_code))
+                    frame = frame.f_back
+                labels.append(thread_names.get(ident, f"thread-{ident}"))
+                stacks.append(";".join(reversed(labels)))
+            with self._lock:
+                self._counts.update(stacks)
+                self.samples += 1
+            # 长时间采样时定期落盘，运行中也能查看结果
+            if time.monotonic() >= next_flush:
+                self.write()
+                next_flush = time.monotonic() + self.flush_interval
+
+
+sampler = SamplingProfiler()
+
+
+def start_from_env(name: str = None) -> bool:
+    """PROFILE_SAMPLING 开启时启动采样剖析（供服务和工作进程启动时调用）"""
+    if not Config.PROFILE_SAMPLING:
+        return False
+    if name:
+        sampler.name = name
+    return sampler.start()
+
+
+def start_worker_sampling(name: str) -> Optional[SamplingProfiler]:
+    """
+    工作进程（如OCR进程池）初始化时调用：PROFILE_SAMPLING 开启时在本进程内单独采样，
+    进程正常退出时写出结果，运行中按 flush_interval 定期落盘
+    """
+    if not Config.PROFILE_SAMPLING:
+        return None
+    import multiprocessing.util
+    # 新建实例而不是沿用 fork 继承来的全局实例，避免继承到父进程中被采样线程持有的锁
+    profiler = SamplingProfiler(name=name)
+    profiler.start()
+    multiprocessing.util.Finalize(None, profiler.stop, exitpriority=10)
+    return profiler
+
+
+def check_admin_token(token: Optional[str]) -> bool:
+    """校验管理令牌；未配置 ADMIN_TOKEN 时管理功能全部关闭"""
+    if not Config.ADMIN_TOKEN or not token:
+        return False
+    return hmac.compare_digest(token.encode("utf-8"), Config.ADMIN_TOKEN.encode("utf-8"))
+
+
+def wants_request_profile(headers) -> bool:
+    """请求是否要求单独剖析：携带 PROFILE_HEADER 头且管理令牌正确"""
+    value = headers.get(Config.PROFILE_HEADER)
+    if not value or value.lower() in ("0", "false", "no"):
+        return False
+    return check_admin_token(headers.get("X-Admin-Token"))
+
+
+# 当前请求的剖析器，随请求上下文传入 run_in_threadpool 执行的函数
+_current_request_profiler: contextvars.ContextVar[Optional["RequestProfiler"]] = \
+    contextvars.ContextVar("request_profiler", default=None)
+
+
+class RequestProfiler:
+    """
+    单请求 cProfile 剖析
+
+    cProfile 只记录开启它的线程：事件循环线程上的部分（中间件、异步等待）由 start 开启的剖析记录，
+    问答、向量化、解析、OCR 等交给线程池执行的部分须经 profiled 包装，在执行线程中另行记录，
+    停止时合并写入同一个 .prof 文件。同一时间只剖析一个请求，但事件循环里并发处理的其他请求仍会混入
+    事件循环线程的记录；线程池内再分出的线程（如批量问答的并发调用）不在记录范围内
+    """
+
+    _active_lock = threading.Lock()
+
+    def __init__(self, label: str):
+        self.label = label
+        self.path: Optional[str] = None
+        self._profile: Optional[cProfile.Profile] = None
+        self._worker_profiles: List[cProfile.Profile] = []
+        self._workers_lock = threading.Lock()
+        self._token = None
+
+    def start(self) -> bool:
+        """开始剖析；已有请求在剖析时返回 False"""
+        if not self._active_lock.acquire(blocking=False):
+            return False
+        try:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        except ValueError:
+            # 其他剖析工具（如调试器）已占用
+            self._profile = None
+            self._active_lock.release()
+            return False
+        self._token = _current_request_profiler.set(self)
+        return True
+
+    def record(self, func: Callable, *args, **kwargs):
+        """在当前（线程池）线程中记录 func 的执行"""
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # 剖析器已对所有线程生效（Python 3.12 起 cProfile 基于 sys.monitoring），无需另行记录
+            return func(*args, **kwargs)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._workers_lock:
+                self._worker_profiles.append(profile)
+
+    def stop(self) -> Optional[str]:
+        """停止剖析并把各线程的记录合并保存为 .prof 文件，返回文件路径"""
+        if self._profile is None:
+            return None
+        try:
+            self._profile.disable()
+            _current_request_profiler.reset(self._token)
+            stats = pstats.Stats(self._profile)
+            with self._workers_lock:
+                for profile in self._worker_profiles:
+                    stats.add(profile)
+            self.path = _profile_path("request", ".prof", self.label)
+            stats.dump_stats(self.path)
+        finally:
+            self._profile = None
+            self._worker_profiles = []
+            self._active_lock.release()
+        logger.info(f"请求 {self.label} 的剖析结果已写入 {self.path}")
+        return self.path
+
+
+def profiled(func: Callable) -> Callable:
+    """包装交给线程池执行的函数：所在请求开启了单请求剖析时，在执行线程中记录该函数"""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _current_request_profiler.get()
+        if profiler is None:
+            return func(*args, **kwargs)
+        return profiler.record(func, *args, **kwargs)
+    return wrapper
+
+
+def list_profiles() -> Dict[str, Any]:
+    """PROFILE_DIR 中已有的剖析结果文件"""
+    if not os.path.isdir(Config.PROFILE_DIR):
+        return {"directory": Config.PROFILE_DIR, "files": []}
+    files = []
+    for entry in sorted(os.scandir(Config.PROFILE_DIR), key=lambda e: e.stat().st_mtime, reverse=True):
+        if entry.is_file() and entry.name.endswith((".folded", ".prof")):
+            files.append({"name": entry.name, "size": entry.stat().st_size, "modified": entry.stat().st_mtime})
+    return {"directory": Config.PROFILE_DIR, "files": files}
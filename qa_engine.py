@@ -1,33 +1,156 @@
 from langchain.chat_models import ChatOpenAI
+from langchain.chat_models.base import BaseChatModel
+from langchain.adapters.openai import convert_message_to_dict
+from langchain.schema import AIMessage, ChatGeneration, ChatResult
 from langchain.chains import ConversationalRetrievalChain
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import PromptTemplate
+from langchain.callbacks.base import BaseCallbackHandler
 from typing import List, Dict, Any, Optional
+from concurrent.futures import ThreadPoolExecutor
+from uuid import UUID
+import contextvars
+import threading
+import time
 import logging
 from config import Config
-from vector_store import VectorStore
+from metrics import LLM_INFLIGHT, QUEUE_DEPTH, STAGE_ERRORS, observe_stage
+from tracing import span, start_span
+from token_usage import record_llm_usage, usage_from_llm_result, usage_scope
+from llm_router import get_router
+from rate_limiter import get_limiter
+from shared_state import SharedChatMessageHistory
+from vector_store import CollectionNotFoundError, VectorStore
+from retrieval import KnowledgeRetriever, distance_to_relevance, estimate_tokens, trim_to_token_budget
 
 logger = logging.getLogger(__name__)
 
+class LLMStageCallback(BaseCallbackHandler):
+    """
+    记录大模型调用（llm_condense / llm_answer 阶段）的耗时指标、进行中的调用数和 token 用量，
+    并为每次调用生成一个 span
+    """
+    
+    def __init__(self, stage: str):
+        self.stage = stage
+        self._runs: Dict[UUID, tuple] = {}
+        self._lock = threading.Lock()
+    
+    def _start(self, run_id: UUID, prompt_text: str, invocation_params: Optional[Dict[str, Any]]) -> None:
+        params = invocation_params or {}
+        model = params.get("model_name") or params.get("model")
+        llm_span = start_span(self.stage, kind="client", **{
+            "llm.model": model,
+            "llm.prompt_chars": len(prompt_text),
+        })
+        with self._lock:
+            self._runs[run_id] = (time.perf_counter(), llm_span, prompt_text, model)
+        LLM_INFLIGHT.inc(stage=self.stage)
+    
+    def _finish(self, run_id: UUID, response=None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        start, llm_span, prompt_text, model = run
+        elapsed = time.perf_counter() - start
+        LLM_INFLIGHT.dec(stage=self.stage)
+        observe_stage(self.stage, elapsed, items=1)
+        if error is not None:
+            STAGE_ERRORS.inc(stage=self.stage)
+            llm_span.record_error(error)
+        elif response is not None:
+            prompt_tokens, completion_tokens, estimated = usage_from_llm_result(response, prompt_text)
+            # 经路由调用时，实际的服务商和模型由返回结果给出
+            output = response.llm_output or {}
+            model = output.get("model_name") or model
+            record_llm_usage(self.stage, model, prompt_tokens, completion_tokens, estimated=estimated,
+                             latency_ms=elapsed * 1000, provider=output.get("provider"))
+            llm_span.set_attributes({
+                "llm.model": model,
+                "llm.provider": output.get("provider"),
+                "llm.prompt_tokens": prompt_tokens,
+                "llm.completion_tokens": completion_tokens,
+                "llm.tokens_estimated": estimated or None,
+            })
+        llm_span.end()
+    
+    def on_chat_model_start(self, serialized, messages, *, run_id: UUID, **kwargs) -> None:
+        prompt_text = "".join(str(message.content) for batch in messages for message in batch)
+        self._start(run_id, prompt_text, kwargs.get("invocation_params"))
+    
+    def on_llm_start(self, serialized, prompts, *, run_id: UUID, **kwargs) -> None:
+        self._start(run_id, "".join(prompts), kwargs.get("invocation_params"))
+    
+    def on_llm_end(self, response, *, run_id: UUID, **kwargs) -> None:
+        self._finish(run_id, response=response)
+    
+    def on_llm_error(self, error, *, run_id: UUID, **kwargs) -> None:
+        self._finish(run_id, error=error)
+
+class RateLimitedChatOpenAI(ChatOpenAI):
+    """经过共用限流器调用的 ChatOpenAI：429 由限流器退避重试并降低并发，客户端自身不重试"""
+    
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        limiter = get_limiter("openai", self.openai_api_key)
+        estimated = (sum(estimate_tokens(str(message.content)) for message in messages)
+                     + (self.max_tokens or Config.LLM_EXPECTED_COMPLETION_TOKENS))
+        result = limiter.call(
+            lambda: ChatOpenAI._generate(self, messages, stop=stop, run_manager=run_manager, **kwargs),
+            estimated_tokens=estimated
+        )
+        usage = (result.llm_output or {}).get("token_usage") or {}
+        limiter.record_usage(estimated, usage.get("total_tokens"))
+        return result
+
+class RoutedChatModel(BaseChatModel):
+    """通过 LLMRouter 在多个服务商之间路由的聊天模型，接口与 ChatOpenAI 相同，可直接用于问答链"""
+    
+    router: Any
+    model_name: str = "router"
+    temperature: float = 0.7
+    max_tokens: Optional[int] = None
+    prefer: Optional[str] = None
+    
+    @property
+    def _llm_type(self) -> str:
+        return "routed-chat"
+    
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        response = self.router.chat(
+            [convert_message_to_dict(message) for message in messages],
+            prefer=self.prefer,
+            temperature=self.temperature,
+            max_tokens=self.max_tokens,
+            stop=stop
+        )
+        llm_output = {"model_name": response.model, "provider": response.provider, "hedged": response.hedged}
+        if response.prompt_tokens is not None:
+            llm_output["token_usage"] = {
+                "prompt_tokens": response.prompt_tokens,
+                "completion_tokens": response.completion_tokens or 0,
+                "total_tokens": response.prompt_tokens + (response.completion_tokens or 0)
+            }
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=response.content))],
+                          llm_output=llm_output)
+
 class QAEngine:
     def __init__(self, vector_store: VectorStore):
         self.vector_store = vector_store
         
         # 初始化大语言模型
-        if not Config.OPENAI_API_KEY:
-            raise ValueError("请设置 OPENAI_API_KEY 环境变量")
+        if Config.LLM_ROUTING:
+            # 在 LLM_PROVIDERS 配置的多个服务商之间按延迟与健康状况路由
+            router = get_router()
+            self.llm = RoutedChatModel(router=router, temperature=0.7,
+                                       callbacks=[LLMStageCallback("llm_answer")])
+            self.condense_llm = RoutedChatModel(router=router, temperature=0,
+                                                callbacks=[LLMStageCallback("llm_condense")])
+        else:
+            self._init_openai_llms()
         
-        self.llm = ChatOpenAI(
-            model_name=Config.OPENAI_MODEL,
-            temperature=0.7,
-            openai_api_key=Config.OPENAI_API_KEY
-        )
-        
-        # 初始化对话记忆
-        self.memory = ConversationBufferMemory(
-            memory_key="chat_history",
-            return_messages=True
-        )
+        # 初始化对话记忆（不指定会话时使用）；多进程部署时保存在共享存储中，各工作进程读到同一段历史
+        self.memory = self._create_memory("default" if Config.API_WORKERS > 1 else None)
         
         # 自定义提示模板
         self.qa_prompt_template = """你是一个专业的AI助手，基于以下上下文信息来回答问题。
@@ -46,58 +169,246 @@ class QAEngine:
             input_variables=["context", "question"]
         )
         
-        # 初始化检索问答链
-        self.qa_chain = ConversationalRetrievalChain.from_llm(
+        # 初始化检索问答链（默认集合、无过滤条件，检索参数取自 Config）
+        self.qa_chain = self._build_chain(KnowledgeRetriever.from_config(self.vector_store))
+        
+        logger.info("问答引擎初始化完成")
+    
+    def _init_openai_llms(self):
+        """使用单个 OpenAI 兼容服务（未开启多服务商路由时）"""
+        if not Config.OPENAI_API_KEY:
+            raise ValueError("请设置 OPENAI_API_KEY 环境变量")
+        
+        self.llm = RateLimitedChatOpenAI(
+            model_name=Config.OPENAI_MODEL,
+            temperature=0.7,
+            openai_api_key=Config.OPENAI_API_KEY,
+            openai_api_base=Config.OPENAI_API_BASE or None,
+            max_retries=0,
+            callbacks=[LLMStageCallback("llm_answer")]
+        )
+        
+        # 问题改写（condense）模型，只在有对话历史时调用；
+        # 未单独配置时复用回答模型的参数，但使用独立实例以便分别统计两类调用的耗时
+        if Config.CONDENSE_MODEL and Config.CONDENSE_MODEL != Config.OPENAI_MODEL:
+            self.condense_llm = RateLimitedChatOpenAI(
+                model_name=Config.CONDENSE_MODEL,
+                temperature=0,
+                openai_api_key=Config.OPENAI_API_KEY,
+                openai_api_base=Config.OPENAI_API_BASE or None,
+                max_retries=0,
+                callbacks=[LLMStageCallback("llm_condense")]
+            )
+        else:
+            self.condense_llm = self.llm.copy(update={"callbacks": [LLMStageCallback("llm_condense")]})
+    
+    @staticmethod
+    def _create_memory(session_id: Optional[str] = None) -> ConversationBufferMemory:
+        """创建对话记忆（链同时返回源文档，需指定记忆保存的输出键）；指定会话时历史保存在共享存储中"""
+        kwargs = {"chat_memory": SharedChatMessageHistory(session_id)} if session_id else {}
+        return ConversationBufferMemory(
+            memory_key="chat_history",
+            output_key="answer",
+            return_messages=True,
+            **kwargs
+        )
+    
+    def _memory_for(self, session_id: Optional[str] = None) -> ConversationBufferMemory:
+        """会话对应的对话记忆，未指定会话时使用默认记忆"""
+        return self._create_memory(session_id) if session_id else self.memory
+    
+    def _build_chain(self, retriever,
+                     memory: Optional[ConversationBufferMemory] = None) -> ConversationalRetrievalChain:
+        """基于指定检索器构建检索问答链，未指定记忆时使用默认对话记忆"""
+        return ConversationalRetrievalChain.from_llm(
             llm=self.llm,
-            retriever=self.vector_store.vectorstore.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 4}
-            ),
-            memory=self.memory,
+            condense_question_llm=self.condense_llm,
+            retriever=retriever,
+            memory=memory or self.memory,
             combine_docs_chain_kwargs={"prompt": self.qa_prompt},
             return_source_documents=True,
             verbose=True
         )
+    
+    def _get_chain(self, collection_name: Optional[str] = None,
+                   metadata_filter: Optional[Dict[str, Any]] = None,
+                   retrieval_options: Optional[Dict[str, Any]] = None,
+                   memory: Optional[ConversationBufferMemory] = None) -> ConversationalRetrievalChain:
+        """获取限定集合/过滤条件/检索参数/会话记忆的问答链，无限定时复用默认链"""
+        retrieval_options = {key: value for key, value in (retrieval_options or {}).items() if value is not None}
+        default_memory = memory is None or memory is self.memory
+        if not collection_name and not metadata_filter and not retrieval_options and default_memory:
+            return self.qa_chain
+        retriever = KnowledgeRetriever.from_config(
+            self.vector_store,
+            collection_name=collection_name,
+            metadata_filter=metadata_filter,
+            **retrieval_options
+        )
+        return self._build_chain(retriever, memory)
+    
+    def ask_question(self, question: str, collection_name: Optional[str] = None,
+                     metadata_filter: Optional[Dict[str, Any]] = None,
+                     retrieval_options: Optional[Dict[str, Any]] = None,
+                     use_history: bool = True, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        提问并获取回答
         
-        logger.info("问答引擎初始化完成")
+        没有对话历史或调用方不使用历史时，跳过问题改写这一次额外的LLM调用，
+        直接检索并生成回答
+        
+        Args:
+            question: 问题
+            collection_name: 检索的集合（课程/租户），默认使用默认集合
+            metadata_filter: 元数据过滤条件，如 {"file_type": ".pdf"}
+            retrieval_options: 覆盖默认检索参数，可含 strategy / k / fetch_k / lambda_mult /
+                               score_threshold / max_context_tokens / rerank / rerank_top_n
+            use_history: 是否结合对话历史；为 False 时既不读取也不写入对话记忆
+            session_id: 会话标识，指定时使用该会话在共享存储中的对话历史
+        """
+        with span("qa.ask", **{"qa.collection": collection_name, "qa.question_chars": len(question),
+                               "qa.use_history": use_history}) as current, \
+                usage_scope(collection=collection_name or Config.DEFAULT_COLLECTION):
+            try:
+                # 执行问答
+                memory = self._memory_for(session_id)
+                qa_chain = self._get_chain(collection_name, metadata_filter, retrieval_options, memory)
+                condense = use_history and bool(memory.chat_memory.messages)
+                current.set_attribute("qa.condensed", condense)
+                if condense:
+                    result = qa_chain({"question": question})
+                else:
+                    result = self._answer_without_condense(qa_chain, question,
+                                                           memory=memory if use_history else None)
+                
+                response = {
+                    "answer": result.get("answer", "抱歉，我无法回答这个问题。"),
+                    "sources": self._format_sources(result.get("source_documents")),
+                    "question": question
+                }
+                
+                current.set_attributes({"qa.sources": len(response["sources"]),
+                                        "qa.answer_chars": len(response["answer"])})
+                logger.info(f"问题回答完成: {question}")
+                return response
+                
+            except CollectionNotFoundError:
+                raise
+            except Exception as e:
+                current.record_error(e)
+                logger.error(f"问答过程中出现错误: {e}")
+                return {
+                    "answer": f"抱歉，处理您的问题时出现了错误: {str(e)}",
+                    "sources": [],
+                    "question": question
+                }
     
-    def ask_question(self, question: str) -> Dict[str, Any]:
-        """提问并获取回答"""
-        try:
-            # 执行问答
-            result = self.qa_chain({"question": question})
-            
-            # 提取源文档信息
-            source_documents = []
-            if result.get("source_documents"):
-                for doc in result["source_documents"]:
-                    source_documents.append({
-                        "content": doc.page_content[:200] + "...",
-                        "source": doc.metadata.get("source", "未知"),
-                        "file_name": doc.metadata.get("file_name", "未知")
-                    })
-            
-            response = {
-                "answer": result.get("answer", "抱歉，我无法回答这个问题。"),
-                "sources": source_documents,
-                "question": question
-            }
-            
-            logger.info(f"问题回答完成: {question}")
-            return response
-            
-        except Exception as e:
-            logger.error(f"问答过程中出现错误: {e}")
-            return {
-                "answer": f"抱歉，处理您的问题时出现了错误: {str(e)}",
-                "sources": [],
-                "question": question
-            }
+    def ask_batch(self, questions: List[str], collection_name: Optional[str] = None,
+                  metadata_filter: Optional[Dict[str, Any]] = None,
+                  retrieval_options: Optional[Dict[str, Any]] = None,
+                  max_concurrency: Optional[int] = None) -> List[Dict[str, Any]]:
+        """
+        批量问答（无状态，不读写对话记忆）
+        
+        所有问题一次编码、一次多查询检索，随后以有限并发调用LLM生成回答。
+        返回结果与输入顺序一致，单个问题失败时在该项的 error 字段中说明
+        """
+        retriever = KnowledgeRetriever.from_config(
+            self.vector_store,
+            collection_name=collection_name,
+            metadata_filter=metadata_filter,
+            **{key: value for key, value in (retrieval_options or {}).items() if value is not None}
+        )
+        
+        results: List[Optional[Dict[str, Any]]] = [None] * len(questions)
+        pending = []
+        for i, question in enumerate(questions):
+            if question and question.strip():
+                pending.append(i)
+            else:
+                results[i] = {"question": question, "answer": None, "sources": [], "error": "问题不能为空"}
+        
+        batch_docs = self.vector_store.batch_retrieve(
+            [questions[i] for i in pending],
+            k=retriever.k,
+            strategy=retriever.strategy,
+            fetch_k=retriever.fetch_k,
+            lambda_mult=retriever.lambda_mult,
+            score_threshold=retriever.score_threshold,
+            collection_name=collection_name,
+            metadata_filter=metadata_filter,
+            rerank=retriever.rerank,
+            rerank_top_n=retriever.rerank_top_n
+        )
+        
+        combine_docs_chain = self.qa_chain.combine_docs_chain
+        
+        def answer(item):
+            i, scored_docs = item
+            docs = trim_to_token_budget([doc for doc, _ in scored_docs], retriever.max_context_tokens)
+            try:
+                with usage_scope(collection=collection_name or Config.DEFAULT_COLLECTION, k=retriever.k,
+                                 context_docs=len(docs),
+                                 context_tokens=sum(estimate_tokens(doc.page_content) for doc in docs)):
+                    text = combine_docs_chain.run(input_documents=docs, question=questions[i])
+                return i, {"question": questions[i], "answer": text,
+                           "sources": self._format_sources(docs), "error": None}
+            except Exception as e:
+                logger.error(f"批量问答第 {i + 1} 题失败: {e}")
+                return i, {"question": questions[i], "answer": None,
+                           "sources": self._format_sources(docs), "error": str(e)}
+            finally:
+                QUEUE_DEPTH.dec(queue="llm_batch")
+        
+        QUEUE_DEPTH.inc(len(pending), queue="llm_batch")
+        max_workers = max(1, min(max_concurrency or Config.BATCH_MAX_CONCURRENCY, len(pending) or 1))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # 每个任务在当前上下文的副本中运行，大模型调用的 span 仍挂在本次请求的 trace 下
+            futures = [executor.submit(contextvars.copy_context().run, answer, item)
+                       for item in zip(pending, batch_docs)]
+            for future in futures:
+                i, item = future.result()
+                results[i] = item
+        
+        failed = sum(1 for item in results if item["error"])
+        logger.info(f"批量问答完成: 共 {len(questions)} 题，失败 {failed} 题")
+        return results
+    
+    def _format_sources(self, documents) -> List[Dict[str, Any]]:
+        """
+        提取源文档信息
+        
+        除内容预览外附带 chunk_id、页码和字符偏移，前端可通过 /sources/{chunk_id} 取回完整原文片段
+        """
+        source_documents = []
+        for doc in documents or []:
+            source_documents.append({
+                "content": doc.page_content[:200] + "...",
+                "source": doc.metadata.get("source", "未知"),
+                "file_name": doc.metadata.get("file_name", "未知"),
+                "chunk_id": doc.metadata.get("chunk_id"),
+                "page": doc.metadata.get("page"),
+                "section": doc.metadata.get("section"),
+                "char_start": doc.metadata.get("char_start"),
+                "char_end": doc.metadata.get("char_end")
+            })
+        return source_documents
     
-    def get_chat_history(self) -> List[Dict[str, str]]:
-        """获取对话历史"""
+    def _answer_without_condense(self, qa_chain: ConversationalRetrievalChain, question: str,
+                                 memory: Optional[ConversationBufferMemory] = None) -> Dict[str, Any]:
+        """直接用原问题检索并回答，只调用一次LLM；指定 memory 时把这一轮问答写入记忆"""
+        docs = qa_chain.retriever.get_relevant_documents(question)
+        answer = qa_chain.combine_docs_chain.run(input_documents=docs, question=question)
+        
+        if memory is not None:
+            memory.save_context({"question": question}, {"answer": answer})
+        
+        return {"answer": answer, "source_documents": docs}
+    
+    def get_chat_history(self, session_id: Optional[str] = None) -> List[Dict[str, str]]:
+        """获取对话历史（未指定会话时为默认对话）"""
         try:
-            chat_history = self.memory.chat_memory.messages
+            chat_history = self._memory_for(session_id).chat_memory.messages
             history = []
             
             for i in range(0, len(chat_history), 2):
@@ -112,31 +423,62 @@ class QAEngine:
             logger.error(f"获取对话历史失败: {e}")
             return []
     
-    def clear_memory(self) -> bool:
-        """清除对话记忆"""
+    def clear_memory(self, session_id: Optional[str] = None) -> bool:
+        """清除对话记忆（未指定会话时为默认对话）"""
         try:
-            self.memory.clear()
+            self._memory_for(session_id).clear()
             logger.info("对话记忆已清除")
             return True
         except Exception as e:
             logger.error(f"清除对话记忆失败: {e}")
             return False
     
-    def search_documents(self, query: str, k: int = 4) -> List[Dict[str, Any]]:
-        """搜索相关文档"""
+    def search_documents(self, query: str, k: int = 4, collection_name: Optional[str] = None,
+                         metadata_filter: Optional[Dict[str, Any]] = None, strategy: str = "similarity",
+                         fetch_k: Optional[int] = None, lambda_mult: Optional[float] = None,
+                         score_threshold: Optional[float] = None,
+                         max_context_tokens: Optional[int] = None, rerank: Optional[bool] = None,
+                         rerank_top_n: Optional[int] = None) -> List[Dict[str, Any]]:
+        """搜索相关文档（score 为距离，越小越相似；relevance 为余弦相似度，越大越相关）"""
         try:
-            results = self.vector_store.similarity_search_with_score(query, k=k)
+            results = self.vector_store.retrieve(
+                query,
+                k=k,
+                strategy=strategy,
+                fetch_k=fetch_k or Config.RETRIEVAL_FETCH_K,
+                lambda_mult=Config.MMR_LAMBDA if lambda_mult is None else lambda_mult,
+                score_threshold=score_threshold,
+                collection_name=collection_name,
+                metadata_filter=metadata_filter,
+                rerank=Config.RERANK_ENABLED if rerank is None else rerank,
+                rerank_top_n=rerank_top_n
+            )
+            
+            scores = {id(doc): score for doc, score in results}
+            kept = trim_to_token_budget([doc for doc, _ in results], max_context_tokens)
             
             documents = []
-            for doc, score in results:
-                documents.append({
+            for doc in kept:
+                score = scores[id(doc)]
+                item = {
                     "content": doc.page_content,
                     "source": doc.metadata.get("source", "未知"),
                     "file_name": doc.metadata.get("file_name", "未知"),
-                    "score": float(score)
-                })
+                    "chunk_id": doc.metadata.get("chunk_id"),
+                    "page": doc.metadata.get("page"),
+                    "section": doc.metadata.get("section"),
+                    "char_start": doc.metadata.get("char_start"),
+                    "char_end": doc.metadata.get("char_end"),
+                    "score": float(score),
+                    "relevance": distance_to_relevance(score)
+                }
+                if "rerank_score" in doc.metadata:
+                    item["rerank_score"] = doc.metadata["rerank_score"]
+                documents.append(item)
             
             return documents
+        except ValueError:
+            raise
         except Exception as e:
             logger.error(f"搜索文档失败: {e}")
             return [] 
\ No newline at end of file
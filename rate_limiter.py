@@ -0,0 +1,261 @@
+"""
+大模型调用限流模块
+每个服务商（按名称和 API Key 区分）共用一个限流器：
+- 令牌桶分别限制每分钟请求数（RPM）和每分钟 token 数（TPM），请求前按估算的 token 数预扣，返回后按实际用量校正；
+  令牌桶保存在共享状态存储（SHARED_STATE_PATH）中，按服务商和 API Key 哈希区分，
+  API 工作进程、入库进程和 Streamlit 应用共用同一份配额
+- 并发上限按 AIMD 自适应：调用成功且延迟正常时缓慢增加，遇到 429 或延迟超过目标时减半；
+  并发是进程内的状态，多进程部署时上限按 API_WORKERS 均分
+- 429 按 Retry-After（缺省时指数退避）重试
+排队等待的调用数计入 kb_queue_depth{queue="llm:<服务商>"}
+"""
+
+import json
+import time
+import random
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Optional
+import logging
+from config import Config
+from metrics import LLM_CONCURRENCY_LIMIT, LLM_LIMITER_WAIT, LLM_THROTTLED, QUEUE_DEPTH
+
+logger = logging.getLogger(__name__)
+
+# Retry-After 的最长等待时间（秒）
+MAX_RETRY_AFTER = 60.0
+
+
+class LimiterTimeoutError(Exception):
+    """排队等待超过上限仍未获得调用许可"""
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """是否为服务商返回的 429（兼容 openai 客户端异常和 requests 的 HTTPError）"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    response = getattr(error, "response", None)
+    return getattr(response, "status_code", None) == 429 or type(error).__name__ == "RateLimitError"
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """从 429 响应的 Retry-After 头中取出等待秒数"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return min(float(headers.get("retry-after")), MAX_RETRY_AFTER)
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """
+    令牌桶：按固定速率补充，容量即允许的突发量；rate 为 0 表示不限制
+
+    余量保存在共享状态存储中，相同 key 的令牌桶（不论在哪个进程）共用一份配额
+    """
+
+    def __init__(self, key: str, per_minute: float, store=None):
+        self.key = key
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._store = store
+
+    @property
+    def store(self):
+        if self._store is None:
+            from shared_state import get_shared_store
+            self._store = get_shared_store()
+        return self._store
+
+    def acquire(self, amount: float, deadline: float) -> None:
+        """取出 amount 个令牌，不足时等待；超过 deadline（monotonic 时间）仍不足时抛出 LimiterTimeoutError"""
+        if self.rate <= 0:
+            return
+        # 单次需求超过容量时按容量计，避免永远等不到
+        amount = min(amount, self.capacity)
+        while True:
+            wait = self.store.take_tokens(self.key, amount, self.capacity, self.rate)
+            if wait <= 0:
+                return
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LimiterTimeoutError("等待限流令牌超时")
+            time.sleep(min(wait, remaining))
+
+    def adjust(self, amount: float) -> None:
+        """按实际用量校正：amount 为正时补扣，为负时退还"""
+        if self.rate <= 0:
+            return
+        self.store.adjust_tokens(self.key, amount, self.capacity, self.rate)
+
+
+class RateLimiter:
+    """单个服务商的限流器，线程安全"""
+
+    def __init__(self, name: str, rpm: float = 0, tpm: float = 0, max_concurrency: int = None,
+                 min_concurrency: int = 1, latency_target: float = None, key: str = None, store=None):
+        """
+        Args:
+            key: 共享令牌桶的键（服务商名和 API Key 哈希），默认为服务商名
+            store: 保存令牌桶的共享状态存储，默认为进程内共享的连接
+        """
+        self.name = name
+        key = key or name
+        self.requests = TokenBucket(f"llm:{key}:rpm", rpm, store)
+        self.tokens = TokenBucket(f"llm:{key}:tpm", tpm, store)
+        self.max_concurrency = max(1, max_concurrency or Config.LLM_MAX_CONCURRENCY)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.latency_target = Config.LLM_LATENCY_TARGET if latency_target is None else latency_target
+        # 从一半开始，由成功调用逐步放开
+        self.limit = float(max(self.min_concurrency, self.max_concurrency // 2))
+        self._inflight = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        LLM_CONCURRENCY_LIMIT.set(int(self.limit), provider=name)
+
+    @property
+    def inflight(self) -> int:
+        return self._inflight
+
+    def saturated(self) -> bool:
+        """并发已达当前上限，新的调用需要排队"""
+        return self._inflight >= int(self.limit)
+
+    def acquire(self, estimated_tokens: int = 0, timeout: float = None) -> None:
+        """获取一次调用许可：并发名额、请求令牌和 token 令牌"""
+        deadline = time.monotonic() + (Config.LLM_QUEUE_TIMEOUT if timeout is None else timeout)
+        start = time.perf_counter()
+        QUEUE_DEPTH.inc(queue=f"llm:{self.name}")
+        try:
+            with self._cond:
+                while self._inflight >= int(self.limit):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise LimiterTimeoutError(f"服务商 {self.name} 并发已满，排队超时")
+                    self._cond.wait(remaining)
+                self._inflight += 1
+            try:
+                self.requests.acquire(1, deadline)
+                self.tokens.acquire(estimated_tokens, deadline)
+            except LimiterTimeoutError:
+                self._release()
+                raise
+        finally:
+            QUEUE_DEPTH.dec(queue=f"llm:{self.name}")
+            LLM_LIMITER_WAIT.observe(time.perf_counter() - start, provider=self.name)
+
+    def _release(self) -> None:
+        with self._cond:
+            self._inflight -= 1
+            self._cond.notify()
+
+    def release(self, latency: float, throttled: bool = False, failed: bool = False) -> None:
+        """
+        归还调用许可并调整并发上限（AIMD）
+
+        429 或延迟超过目标时上限减半（同一延迟窗口内只减一次），
+        成功时每个"上限轮次"增加 1；其他失败不调整
+        """
+        with self._cond:
+            self._inflight -= 1
+            now = time.monotonic()
+            if throttled or (not failed and self.latency_target and latency > self.latency_target):
+                if now - self._last_decrease >= max(latency, 1.0):
+                    self.limit = max(float(self.min_concurrency), self.limit / 2)
+                    self._last_decrease = now
+                    logger.info(f"服务商 {self.name} 并发上限降为 {int(self.limit)}")
+            elif not failed:
+                self.limit = min(float(self.max_concurrency), self.limit + 1 / self.limit)
+            LLM_CONCURRENCY_LIMIT.set(int(self.limit), provider=self.name)
+            self._cond.notify_all()
+
+    def call(self, fn: Callable[[], Any], estimated_tokens: int = 0, retries: int = None,
+             timeout: float = None) -> Any:
+        """
+        在限流下执行一次调用，遇到 429 时按 Retry-After 或指数退避重试
+
+        Args:
+            fn: 实际发起请求的函数
+            estimated_tokens: 预估的 token 数（提示 + 生成），用于 TPM 限流
+            retries: 429 的最多重试次数，默认 LLM_MAX_RETRIES
+            timeout: 每次排队的最长等待秒数，默认 LLM_QUEUE_TIMEOUT
+
+        Raises:
+            LimiterTimeoutError: 排队超时
+        """
+        retries = Config.LLM_MAX_RETRIES if retries is None else retries
+        for attempt in range(retries + 1):
+            self.acquire(estimated_tokens, timeout)
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except Exception as e:
+                throttled = is_rate_limit_error(e)
+                self.release(time.perf_counter() - start, throttled=throttled, failed=True)
+                if not throttled:
+                    raise
+                LLM_THROTTLED.inc(provider=self.name)
+                if attempt >= retries:
+                    raise
+                delay = retry_after_seconds(e) or min(2 ** attempt, 30) * (0.5 + random.random())
+                logger.warning(f"服务商 {self.name} 返回 429，{delay:.1f}s 后第 {attempt + 1} 次重试")
+                time.sleep(delay)
+                continue
+            self.release(time.perf_counter() - start)
+            return result
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: Optional[int]) -> None:
+        """返回后按实际 token 数校正 TPM 令牌桶"""
+        if actual_tokens is not None:
+            self.tokens.adjust(actual_tokens - estimated_tokens)
+
+    def status(self) -> Dict[str, Any]:
+        return {"provider": self.name, "concurrency_limit": int(self.limit), "inflight": self._inflight,
+                "max_concurrency": self.max_concurrency}
+
+
+def _load_limits() -> Dict[str, Dict[str, Any]]:
+    if not Config.LLM_RATE_LIMITS:
+        return {}
+    try:
+        return json.loads(Config.LLM_RATE_LIMITS)
+    except ValueError as e:
+        logger.warning(f"LLM_RATE_LIMITS 配置无效，使用默认限流参数: {e}")
+        return {}
+
+
+_LIMITS = _load_limits()
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(name: str, api_key: Optional[str] = None) -> RateLimiter:
+    """
+    服务商共用的限流器，同一名称和 API Key 在进程内只创建一个
+
+    参数取自 LLM_RATE_LIMITS（JSON，{"服务商": {"rpm", "tpm", "max_concurrency", "latency_target"}}），
+    未配置的服务商使用 LLM_DEFAULT_RPM / LLM_DEFAULT_TPM / LLM_MAX_CONCURRENCY；
+    以上均为整个服务的配额：RPM / TPM 令牌桶在共享状态存储中跨进程共用，
+    并发上限为进程内状态，API_WORKERS 大于 1 时按进程数均分
+    """
+    key = f"{name}:{hashlib.sha256((api_key or '').encode('utf-8')).hexdigest()[:12]}"
+    limiter = _limiters.get(key)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.get(key)
+            if limiter is None:
+                limits = _LIMITS.get(name, {})
+                # 多进程部署时每个工作进程各有一个限流器，并发上限按进程数均分
+                workers = max(1, Config.API_WORKERS)
+                max_concurrency = limits.get("max_concurrency") or Config.LLM_MAX_CONCURRENCY
+                limiter = _limiters[key] = RateLimiter(
+                    name,
+                    rpm=limits.get("rpm", Config.LLM_DEFAULT_RPM),
+                    tpm=limits.get("tpm", Config.LLM_DEFAULT_TPM),
+                    max_concurrency=max(1, max_concurrency // workers),
+                    latency_target=limits.get("latency_target"),
+                    key=key
+                )
+    return limiter
@@ -0,0 +1,147 @@
+"""
+交叉编码器重排序模块
+对第一阶段向量检索召回的候选进行批量打分，只保留最相关的 top-k 个文档块
+"""
+
+import time
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+from langchain.schema import Document
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 按模型名缓存已加载的交叉编码器，进程内只加载一次
+_model_cache: Dict[str, Any] = {}
+_model_lock = threading.Lock()
+
+
+def load_cross_encoder(model_name: str):
+    """加载（或从缓存获取）CPU上的交叉编码器模型"""
+    model = _model_cache.get(model_name)
+    if model is not None:
+        return model
+
+    with _model_lock:
+        if model_name not in _model_cache:
+            from sentence_transformers import CrossEncoder
+
+            start = time.perf_counter()
+            _model_cache[model_name] = CrossEncoder(
+                model_name,
+                device='cpu',
+                automodel_args={'cache_dir': "./models"},
+                tokenizer_args={'cache_dir': "./models"}
+            )
+            logger.info(f"交叉编码器 {model_name} 加载完成，耗时 {(time.perf_counter() - start) * 1000:.0f} ms")
+    return _model_cache[model_name]
+
+
+class CrossEncoderReranker:
+    """交叉编码器重排序器，带独立的延迟预算和耗时统计"""
+
+    def __init__(self, model_name: str = None, batch_size: int = None, budget_ms: float = None):
+        self.model_name = model_name or Config.RERANK_MODEL
+        self.batch_size = batch_size or Config.RERANK_BATCH_SIZE
+        self.budget_ms = Config.RERANK_BUDGET_MS if budget_ms is None else budget_ms
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "calls": 0,
+            "pairs_scored": 0,
+            "total_ms": 0.0,
+            "max_ms": 0.0,
+            "last_ms": 0.0,
+            "budget_exceeded": 0,
+            "failures": 0
+        }
+
+    def warmup(self) -> bool:
+        """预加载模型，避免首个请求承担加载耗时"""
+        try:
+            load_cross_encoder(self.model_name)
+            return True
+        except Exception as e:
+            logger.warning(f"交叉编码器预加载失败: {e}")
+            return False
+
+    def rerank(self, query: str, documents: List[Document], top_k: int = 4,
+               budget_ms: Optional[float] = None) -> List[Tuple[Document, Optional[float]]]:
+        """
+        对候选文档重排序
+
+        Args:
+            query: 查询文本
+            documents: 第一阶段召回的候选文档（按相似度排序）
+            top_k: 保留数量
+            budget_ms: 本次重排序的延迟预算（毫秒），0 表示不限制
+
+        Returns:
+            (文档, 交叉编码器分数) 列表；超出预算未被打分的候选分数为 None，
+            按第一阶段顺序排在已打分候选之后
+        """
+        if not documents:
+            return []
+
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        start = time.perf_counter()
+
+        try:
+            model = load_cross_encoder(self.model_name)
+        except Exception as e:
+            logger.warning(f"交叉编码器不可用，保持第一阶段排序: {e}")
+            self._record(0, time.perf_counter() - start, failed=True)
+            return [(doc, None) for doc in documents[:top_k]]
+
+        pairs = [[query, doc.page_content] for doc in documents]
+        scores: List[float] = []
+        exceeded = False
+        for i in range(0, len(pairs), self.batch_size):
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            if budget_ms and scores and elapsed_ms > budget_ms:
+                exceeded = True
+                break
+            batch = pairs[i:i + self.batch_size]
+            scores.extend(float(s) for s in model.predict(batch, batch_size=len(batch), show_progress_bar=False))
+
+        scored = sorted(zip(documents[:len(scores)], scores), key=lambda item: item[1], reverse=True)
+        unscored = [(doc, None) for doc in documents[len(scores):]]
+
+        elapsed = time.perf_counter() - start
+        self._record(len(scores), elapsed, exceeded=exceeded or (budget_ms and elapsed * 1000 > budget_ms))
+        logger.info(f"重排序完成：{len(scores)}/{len(documents)} 个候选已打分，耗时 {elapsed * 1000:.1f} ms")
+
+        return (scored + unscored)[:top_k]
+
+    def _record(self, pairs: int, elapsed: float, exceeded: bool = False, failed: bool = False) -> None:
+        elapsed_ms = elapsed * 1000
+        with self._stats_lock:
+            self._stats["calls"] += 1
+            self._stats["pairs_scored"] += pairs
+            self._stats["total_ms"] += elapsed_ms
+            self._stats["last_ms"] = elapsed_ms
+            self._stats["max_ms"] = max(self._stats["max_ms"], elapsed_ms)
+            if exceeded:
+                self._stats["budget_exceeded"] += 1
+            if failed:
+                self._stats["failures"] += 1
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取重排序耗时统计"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["avg_ms"] = stats["total_ms"] / stats["calls"] if stats["calls"] else 0.0
+        stats["model"] = self.model_name
+        stats["budget_ms"] = self.budget_ms
+        return stats
+
+
+_reranker: Optional[CrossEncoderReranker] = None
+
+
+def get_reranker() -> CrossEncoderReranker:
+    """获取进程内共享的重排序器实例"""
+    global _reranker
+    if _reranker is None:
+        _reranker = CrossEncoderReranker()
+    return _reranker
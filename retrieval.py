@@ -0,0 +1,197 @@
+"""
+检索策略模块
+支持相似度检索、最大边际相关性（MMR）检索、最低分数阈值过滤，以及按token预算裁剪上下文
+"""
+
+import re
+import math
+import numpy as np
+from typing import List, Dict, Any, Optional, Tuple
+from langchain.schema import Document, BaseRetriever
+from langchain.callbacks.manager import CallbackManagerForRetrieverRun
+import logging
+from config import Config
+from tracing import span
+from token_usage import annotate_usage
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_STRATEGIES = ("similarity", "mmr", "threshold")
+
+_CJK_PATTERN = re.compile(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算文本的token数：中日韩字符按1个token计，其余字符约4个字符1个token"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + math.ceil(other_count / 4)
+
+
+def distance_to_relevance(distance: float) -> float:
+    """
+    将Chroma返回的L2距离转换为相关度分数（余弦相似度）
+
+    嵌入向量已归一化，Chroma的l2空间返回平方欧氏距离 d，余弦相似度 = 1 - d / 2
+    """
+    return 1.0 - float(distance) / 2.0
+
+
+def maximal_marginal_relevance(query_embedding: np.ndarray, candidate_embeddings: np.ndarray,
+                               k: int = 4, lambda_mult: float = 0.5) -> List[int]:
+    """
+    向量化的最大边际相关性选择
+
+    候选之间的相似度矩阵只计算一次，每选中一个文档后用一次向量运算
+    更新"与已选集合的最大相似度"，整体复杂度 O(n^2 + k*n)
+
+    Args:
+        query_embedding: 查询向量，形状 (d,)
+        candidate_embeddings: 候选向量，形状 (n, d)
+        k: 选择数量
+        lambda_mult: 相关性与多样性的权衡，1为只看相关性，0为只看多样性
+
+    Returns:
+        选中候选的下标列表（按选择顺序）
+    """
+    candidates = np.asarray(candidate_embeddings, dtype=np.float32)
+    if candidates.ndim != 2 or candidates.shape[0] == 0 or k <= 0:
+        return []
+
+    query = np.asarray(query_embedding, dtype=np.float32)
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    relevance = candidates @ query
+    pairwise = candidates @ candidates.T
+
+    k = min(k, candidates.shape[0])
+    selected = [int(np.argmax(relevance))]
+    max_similarity = pairwise[selected[0]].copy()
+    available = np.ones(candidates.shape[0], dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        idx = int(np.argmax(scores))
+        selected.append(idx)
+        available[idx] = False
+        np.maximum(max_similarity, pairwise[idx], out=max_similarity)
+
+    return selected
+
+
+def select_candidates(query_embedding: List[float], candidates: List[Tuple[Document, float, Any]],
+                      strategy: str = "similarity", k: int = 4, lambda_mult: float = 0.5,
+                      score_threshold: Optional[float] = None) -> List[Tuple[Document, float]]:
+    """
+    从第一阶段召回的候选中按策略选出最终文档
+
+    Args:
+        query_embedding: 查询向量
+        candidates: (文档, 距离, 嵌入向量) 列表，按距离升序
+        strategy: similarity / mmr / threshold
+        k: 返回数量
+        lambda_mult: MMR多样性参数
+        score_threshold: 最低相关度（余弦相似度），低于该值的候选被丢弃
+
+    Returns:
+        (文档, 距离) 列表
+    """
+    if strategy not in RETRIEVAL_STRATEGIES:
+        raise ValueError(f"不支持的检索策略: {strategy}")
+
+    if strategy == "threshold" and score_threshold is None:
+        score_threshold = Config.SCORE_THRESHOLD
+    if score_threshold is not None:
+        candidates = [c for c in candidates if distance_to_relevance(c[1]) >= score_threshold]
+
+    if strategy == "mmr" and len(candidates) > 1:
+        embeddings = np.array([c[2] for c in candidates], dtype=np.float32)
+        indices = maximal_marginal_relevance(np.array(query_embedding), embeddings, k, lambda_mult)
+        return [(candidates[i][0], candidates[i][1]) for i in indices]
+
+    return [(doc, distance) for doc, distance, _ in candidates[:k]]
+
+
+def trim_to_token_budget(documents: List[Document], max_tokens: Optional[int]) -> List[Document]:
+    """
+    按相关度顺序保留文档，直到累计token数达到预算
+
+    至少保留第一篇文档，避免预算过小时上下文为空
+    """
+    if not max_tokens or max_tokens <= 0:
+        return documents
+
+    kept = []
+    used = 0
+    for doc in documents:
+        tokens = estimate_tokens(doc.page_content)
+        if kept and used + tokens > max_tokens:
+            break
+        kept.append(doc)
+        used += tokens
+
+    if len(kept) < len(documents):
+        logger.info(f"上下文token预算 {max_tokens}：保留 {len(kept)}/{len(documents)} 个文档块，约 {used} tokens")
+    return kept
+
+
+class KnowledgeRetriever(BaseRetriever):
+    """基于 VectorStore.retrieve 的可配置检索器，供问答链使用"""
+
+    vector_store: Any
+    strategy: str = "similarity"
+    k: int = 4
+    fetch_k: int = 20
+    lambda_mult: float = 0.5
+    score_threshold: Optional[float] = None
+    max_context_tokens: Optional[int] = None
+    collection_name: Optional[str] = None
+    metadata_filter: Optional[Dict[str, Any]] = None
+    rerank: bool = False
+    rerank_top_n: Optional[int] = None
+
+    @classmethod
+    def from_config(cls, vector_store, **overrides) -> "KnowledgeRetriever":
+        """以 Config 中的默认检索参数创建检索器，overrides 中值为 None 的项被忽略"""
+        params = {
+            "strategy": Config.RETRIEVAL_STRATEGY,
+            "k": Config.RETRIEVAL_K,
+            "fetch_k": Config.RETRIEVAL_FETCH_K,
+            "lambda_mult": Config.MMR_LAMBDA,
+            "score_threshold": Config.SCORE_THRESHOLD,
+            "max_context_tokens": Config.CONTEXT_TOKEN_BUDGET,
+            "rerank": Config.RERANK_ENABLED,
+            "rerank_top_n": Config.RERANK_TOP_N,
+        }
+        params.update({key: value for key, value in overrides.items() if value is not None})
+        return cls(vector_store=vector_store, **params)
+
+    def _get_relevant_documents(self, query: str, *,
+                                run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        with span("retriever", **{"retrieval.k": self.k, "retrieval.strategy": self.strategy,
+                                  "retrieval.rerank": self.rerank}) as current:
+            results = self.vector_store.retrieve(
+                query,
+                k=self.k,
+                strategy=self.strategy,
+                fetch_k=self.fetch_k,
+                lambda_mult=self.lambda_mult,
+                score_threshold=self.score_threshold,
+                collection_name=self.collection_name,
+                metadata_filter=self.metadata_filter,
+                rerank=self.rerank,
+                rerank_top_n=self.rerank_top_n
+            )
+            documents = trim_to_token_budget([doc for doc, _ in results], self.max_context_tokens)
+            context_tokens = sum(estimate_tokens(doc.page_content) for doc in documents)
+            current.set_attributes({"retrieval.documents": len(documents), "retrieval.context_tokens": context_tokens})
+            # 后续回答调用的用量记录带上本次检索的 k、上下文大小和这些块建索引时的分块大小（不同时取最大值）
+            chunk_sizes = [doc.metadata.get("chunk_size") for doc in documents if doc.metadata.get("chunk_size")]
+            annotate_usage(k=self.k, context_docs=len(documents), context_tokens=context_tokens,
+                           chunk_size=max(chunk_sizes) if chunk_sizes else None)
+            return documents
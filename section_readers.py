@@ -0,0 +1,182 @@
+"""
+结构化文档读取模块
+流式遍历 Word 文档正文（段落与表格按原顺序）和逐行解析 Markdown（不经过HTML转换），
+按标题产出章节，分割器在章节内切块，检索块不会跨越章节边界
+"""
+
+import re
+from typing import Iterator, List, Optional, Tuple
+
+# (标题路径, 章节文本)；标题路径为从一级标题到当前标题的列表，文档开头无标题部分为空列表
+Section = Tuple[List[str], str]
+
+_HEADING_STYLE = re.compile(r'^(?:heading|标题)\s*(\d)$', re.IGNORECASE)
+
+_MD_ATX_HEADING = re.compile(r'^ {0,3}(#{1,6})\s+(.*?)(?:\s+#+)?\s*$')
+_MD_SETEXT_UNDERLINE = re.compile(r'^ {0,3}(=+|-+)\s*$')
+_MD_FENCE = re.compile(r'^ {0,3}(`{3,}|~{3,})')
+_MD_RULE = re.compile(r'^ {0,3}([-*_])(\s*\1){2,}\s*$')
+_MD_TABLE_SEPARATOR = re.compile(r'^\s*\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?\s*$')
+_MD_BLOCK_PREFIX = re.compile(r'^\s*(?:>\s?)*(?:[-*+]\s+(?:\[[ xX]\]\s+)?|\d+[.)]\s+)?')
+_MD_IMAGE = re.compile(r'!\[([^\]]*)\]\([^)]*\)')
+_MD_LINK = re.compile(r'\[([^\]]+)\]\([^)]*\)')
+_MD_EMPHASIS = re.compile(r'(\*{1,3}|_{2,3}|~~)(\S(?:.*?\S)?)\1')
+_MD_INLINE_CODE = re.compile(r'`+([^`]*)`+')
+_HTML_TAG = re.compile(r'<[^>\n]+>')
+
+
+class _SectionBuilder:
+    """按标题层级累积章节内容"""
+
+    def __init__(self):
+        self.path: List[str] = []
+        self.lines: List[str] = []
+
+    def heading(self, level: int, title: str) -> Optional[Section]:
+        """遇到新标题：结束当前章节并返回它，然后进入新章节"""
+        section = self.flush()
+        self.path = self.path[:level - 1] + [title]
+        self.lines = [title]
+        return section
+
+    def add(self, line: str) -> None:
+        self.lines.append(line)
+
+    def flush(self) -> Optional[Section]:
+        text = "\n".join(self.lines).strip()
+        self.lines = []
+        # 只有标题、没有正文的章节不单独产出
+        if not text or (self.path and text == self.path[-1]):
+            return None
+        return list(self.path), text
+
+
+def _docx_heading_level(paragraph) -> Optional[int]:
+    """根据段落样式判断标题级别，非标题返回 None"""
+    style = paragraph.style
+    name = style.name if style is not None else ""
+    if name == "Title":
+        return 1
+    match = _HEADING_STYLE.match(name or "")
+    return int(match.group(1)) if match else None
+
+
+def _docx_table_lines(table) -> Iterator[str]:
+    """表格逐行输出，单元格以 | 分隔；合并单元格只保留一次"""
+    for row in table.rows:
+        cells = []
+        previous = None
+        for cell in row.cells:
+            if previous is not None and cell._tc is previous:
+                continue
+            previous = cell._tc
+            cells.append(cell.text.strip().replace("\n", " "))
+        if any(cells):
+            yield " | ".join(cells)
+
+
+def iter_docx_sections(file_path: str) -> Iterator[Section]:
+    """按原文顺序遍历 Word 文档的段落和表格，按标题产出章节"""
+    from docx import Document
+    from docx.table import Table
+
+    builder = _SectionBuilder()
+    for block in Document(file_path).iter_inner_content():
+        if isinstance(block, Table):
+            for line in _docx_table_lines(block):
+                builder.add(line)
+            continue
+
+        text = block.text.strip()
+        if not text:
+            continue
+        level = _docx_heading_level(block)
+        if level:
+            section = builder.heading(level, text)
+            if section:
+                yield section
+        else:
+            builder.add(text)
+
+    section = builder.flush()
+    if section:
+        yield section
+
+
+def markdown_inline_text(line: str) -> str:
+    """去除一行 Markdown 的行内标记，保留可读文本"""
+    line = _MD_IMAGE.sub(r'\1', line)
+    line = _MD_LINK.sub(r'\1', line)
+    line = _MD_INLINE_CODE.sub(r'\1', line)
+    line = _MD_EMPHASIS.sub(r'\2', line)
+    line = _HTML_TAG.sub('', line)
+    return line.strip()
+
+
+def iter_markdown_sections(file_path: str, encoding: str = 'utf-8') -> Iterator[Section]:
+    """逐行解析 Markdown 文件，按标题产出章节，代码块原样保留"""
+    builder = _SectionBuilder()
+    fence = None
+    previous: Optional[str] = None  # 尚未确定是否为 Setext 标题的上一行
+
+    def emit(line: str) -> None:
+        # 表格行去掉首尾竖线，单元格以 | 分隔
+        if line.lstrip().startswith('|'):
+            cells = [markdown_inline_text(cell) for cell in line.strip().strip('|').split('|')]
+            builder.add(" | ".join(cells))
+        else:
+            text = markdown_inline_text(_MD_BLOCK_PREFIX.sub('', line, count=1))
+            if text:
+                builder.add(text)
+
+    with open(file_path, 'r', encoding=encoding) as file:
+        for raw in file:
+            line = raw.rstrip('\n').rstrip('\r')
+
+            if fence:
+                if line.strip().startswith(fence):
+                    fence = None
+                else:
+                    builder.add(line)
+                continue
+
+            # Setext 标题：上一行文字 + 下一行 === 或 ---
+            if previous is not None:
+                underline = _MD_SETEXT_UNDERLINE.match(line)
+                if underline:
+                    section = builder.heading(1 if underline.group(1)[0] == '=' else 2,
+                                              markdown_inline_text(previous))
+                    previous = None
+                    if section:
+                        yield section
+                    continue
+                emit(previous)
+                previous = None
+
+            fence_match = _MD_FENCE.match(line)
+            if fence_match:
+                fence = fence_match.group(1)[:3]
+                continue
+
+            heading = _MD_ATX_HEADING.match(line)
+            if heading:
+                section = builder.heading(len(heading.group(1)), markdown_inline_text(heading.group(2)))
+                if section:
+                    yield section
+                continue
+
+            if not line.strip() or _MD_RULE.match(line) or _MD_TABLE_SEPARATOR.match(line) and '-' in line:
+                continue
+
+            previous = line
+
+    if previous is not None:
+        emit(previous)
+    section = builder.flush()
+    if section:
+        yield section
+
+
+def sections_to_text(sections: Iterator[Section]) -> str:
+    """把章节拼接为纯文本"""
+    return "\n\n".join(text for _, text in sections)
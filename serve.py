@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+"""
+生产环境多进程启动脚本
+同一端口下启动 N 个 API 工作进程和一个入库进程：
+- API 工作进程只读索引，各自加载嵌入模型，入库进程更新索引后自动重新加载
+- 上传、导入目录、删除集合和重置由 API 进程提交到共享任务队列，唯一的入库进程依次执行
+- 会话对话历史、索引版本和任务队列保存在共享的本地 SQLite（SHARED_STATE_PATH）中
+
+用法: python serve.py --workers 4 [--host 0.0.0.0] [--port 8000]
+"""
+
+import os
+import sys
+import signal
+import argparse
+import subprocess
+import logging
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="多进程启动知识库 API 服务")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("API_WORKERS", "0")) or os.cpu_count() or 1,
+                        help="API 工作进程数，默认取 API_WORKERS 环境变量或 CPU 核数")
+    parser.add_argument("--host", default=None, help="监听地址，默认取 HOST")
+    parser.add_argument("--port", type=int, default=None, help="监听端口，默认取 PORT")
+    parser.add_argument("--no-ingest", action="store_true",
+                        help="不启动入库进程（入库进程单独部署时使用）")
+    return parser.parse_args()
+
+
+def configure_worker_env(workers: int) -> None:
+    """
+    设置工作进程继承的环境变量（须在导入 config 之前）
+
+    各进程的 PyTorch / BLAS 线程数按核数均分，避免 N 个进程各自占满所有核心互相争抢
+    """
+    os.environ["API_WORKERS"] = str(workers)
+    # 入库进程也算一个
+    threads = str(max(1, (os.cpu_count() or 1) // (workers + 1)))
+    os.environ.setdefault("OMP_NUM_THREADS", threads)
+    os.environ.setdefault("MKL_NUM_THREADS", threads)
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+
+def main():
+    args = parse_args()
+    workers = max(1, args.workers)
+    configure_worker_env(workers)
+
+    import uvicorn
+    from config import Config
+
+    ingest = None
+    if workers > 1 and not args.no_ingest:
+        script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ingest_worker.py")
+        ingest = subprocess.Popen([sys.executable, script])
+        logger.info(f"入库进程已启动，PID {ingest.pid}")
+
+    logger.info(f"启动 {workers} 个 API 工作进程")
+    try:
+        uvicorn.run(
+            "api:app",
+            host=args.host or Config.HOST,
+            port=args.port or Config.PORT,
+            workers=workers
+        )
+    finally:
+        if ingest is not None and ingest.poll() is None:
+            ingest.send_signal(signal.SIGTERM)
+            try:
+                ingest.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                ingest.kill()
+
+
+if __name__ == "__main__":
+    main()
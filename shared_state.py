@@ -0,0 +1,322 @@
+"""
+多进程共享状态模块
+多个 API 工作进程与入库进程通过同一个本地 SQLite 文件（WAL 模式）共享状态：
+- 键值存储（带过期时间，相当于本地的 Redis 替代）：索引版本号、入库进程租约等
+- 入库任务队列：API 进程只读索引，上传、删除等写操作排队交给唯一的入库进程执行
+- 会话对话历史：按 session_id 保存，任一工作进程处理的请求都能读到同一段历史
+- 令牌桶：大模型服务商的 RPM / TPM 配额，API 进程、入库进程和 Streamlit 应用共用
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional
+from langchain.schema import BaseChatMessageHistory
+from langchain.schema.messages import BaseMessage, messages_from_dict, messages_to_dict
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 索引版本号的键，入库进程每完成一个写任务加 1，API 进程据此重新加载索引
+INDEX_VERSION_KEY = "index:version"
+
+# 入库任务类型
+JOB_KINDS = ("file", "directory", "delete_collection", "reset")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key        TEXT PRIMARY KEY,
+    value      TEXT NOT NULL,
+    expires_at REAL
+);
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id         TEXT PRIMARY KEY,
+    seq        INTEGER NOT NULL,
+    kind       TEXT NOT NULL,
+    payload    TEXT NOT NULL,
+    status     TEXT NOT NULL DEFAULT 'queued',
+    result     TEXT,
+    error      TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON ingest_jobs (status, seq);
+CREATE TABLE IF NOT EXISTS chat_messages (
+    id         INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    message    TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_messages_session ON chat_messages (session_id, id);
+CREATE TABLE IF NOT EXISTS token_buckets (
+    key        TEXT PRIMARY KEY,
+    tokens     REAL NOT NULL,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SharedStore:
+    """跨进程共享的本地状态存储，线程安全；每个进程各自持有连接"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or Config.SHARED_STATE_PATH
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        # 多个进程同时写入时等待对方提交，而不是立即报 database is locked
+        self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False,
+                                     isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def _transaction(self, immediate: bool = False):
+        return _Transaction(self._conn, immediate)
+
+    # ---------- 键值存储 ----------
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is None or (row["expires_at"] is not None and row["expires_at"] <= time.time()):
+            return default
+        return json.loads(row["value"])
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        """写入键值，ttl 秒后过期；为空时不过期"""
+        expires_at = time.time() + ttl if ttl else None
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                               (key, json.dumps(value, ensure_ascii=False), expires_at))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def incr(self, key: str, amount: int = 1) -> int:
+        """原子地加上 amount 并返回新值（键不存在或已过期时从 0 开始）"""
+        with self._lock, self._transaction(immediate=True):
+            row = self._conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            current = 0
+            if row is not None and (row["expires_at"] is None or row["expires_at"] > time.time()):
+                current = int(json.loads(row["value"]))
+            value = current + amount
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, NULL)",
+                               (key, json.dumps(value)))
+        return value
+
+    def acquire_lease(self, name: str, owner: str, ttl: float) -> bool:
+        """
+        获取或续期租约：租约空闲、已过期或本来就属于 owner 时成功
+
+        用于保证同一时间只有一个入库进程写索引，持有者需在 ttl 内不断续期
+        """
+        key = f"lease:{name}"
+        now = time.time()
+        with self._lock, self._transaction(immediate=True):
+            row = self._conn.execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is not None and json.loads(row["value"]) != owner and \
+                    row["expires_at"] is not None and row["expires_at"] > now:
+                return False
+            self._conn.execute("INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                               (key, json.dumps(owner), now + ttl))
+        return True
+
+    def release_lease(self, name: str, owner: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM kv WHERE key = ? AND value = ?",
+                               (f"lease:{name}", json.dumps(owner)))
+
+    def purge_expired(self) -> int:
+        """删除已过期的键，返回删除数量"""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                                        (time.time(),))
+        return cursor.rowcount
+
+    # ---------- 索引版本 ----------
+
+    def index_version(self) -> int:
+        return int(self.get(INDEX_VERSION_KEY, 0))
+
+    def bump_index_version(self) -> int:
+        return self.incr(INDEX_VERSION_KEY)
+
+    # ---------- 入库任务队列 ----------
+
+    def enqueue_job(self, kind: str, payload: Dict[str, Any]) -> str:
+        """提交入库任务，返回任务ID；同一队列内按提交顺序执行"""
+        if kind not in JOB_KINDS:
+            raise ValueError(f"不支持的任务类型: {kind}")
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._transaction(immediate=True):
+            seq = self._conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM ingest_jobs").fetchone()[0]
+            self._conn.execute(
+                "INSERT INTO ingest_jobs (id, seq, kind, payload, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, seq, kind, json.dumps(payload, ensure_ascii=False), now, now)
+            )
+        return job_id
+
+    def claim_job(self) -> Optional[Dict[str, Any]]:
+        """取出最早的排队任务并标记为执行中，没有任务时返回 None"""
+        with self._lock, self._transaction(immediate=True):
+            row = self._conn.execute(
+                "SELECT * FROM ingest_jobs WHERE status = 'queued' ORDER BY seq LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute("UPDATE ingest_jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                               (time.time(), row["id"]))
+        job = self._job_dict(row)
+        job["status"] = "running"
+        return job
+
+    def finish_job(self, job_id: str, result: Optional[Dict[str, Any]] = None,
+                   error: Optional[str] = None) -> None:
+        with self._lock:
+            self._conn.execute(
+                "UPDATE ingest_jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                ("failed" if error else "done", json.dumps(result, ensure_ascii=False) if result else None,
+                 error, time.time(), job_id)
+            )
+
+    def requeue_running_jobs(self) -> int:
+        """入库进程启动时把上次异常退出遗留的执行中任务放回队列，返回数量"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "UPDATE ingest_jobs SET status = 'queued', updated_at = ? WHERE status = 'running'", (time.time(),)
+            )
+        return cursor.rowcount
+
+    def get_job(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM ingest_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_dict(row) if row else None
+
+    def pending_jobs(self) -> int:
+        """排队和执行中的任务数"""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM ingest_jobs WHERE status IN ('queued', 'running')"
+            ).fetchone()[0]
+
+    @staticmethod
+    def _job_dict(row: sqlite3.Row) -> Dict[str, Any]:
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "payload": json.loads(row["payload"]),
+            "status": row["status"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+        }
+
+    # ---------- 令牌桶 ----------
+
+    def _bucket_tokens(self, key: str, capacity: float, rate: float, now: float) -> float:
+        """按上次更新后经过的时间补充令牌后的余量（须在事务内调用）"""
+        row = self._conn.execute("SELECT tokens, updated_at FROM token_buckets WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return capacity
+        return min(capacity, row["tokens"] + max(0.0, now - row["updated_at"]) * rate)
+
+    def _save_bucket(self, key: str, tokens: float, now: float) -> None:
+        self._conn.execute("INSERT OR REPLACE INTO token_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+                           (key, tokens, now))
+
+    def take_tokens(self, key: str, amount: float, capacity: float, rate: float) -> float:
+        """
+        从令牌桶中原子地取出 amount 个令牌（rate 为每秒补充量）：成功返回 0，
+        余量不足时不扣减，返回还需等待的秒数
+        """
+        now = time.time()
+        with self._lock, self._transaction(immediate=True):
+            tokens = self._bucket_tokens(key, capacity, rate, now)
+            if tokens >= amount:
+                self._save_bucket(key, tokens - amount, now)
+                return 0.0
+            self._save_bucket(key, tokens, now)
+        return (amount - tokens) / rate
+
+    def adjust_tokens(self, key: str, amount: float, capacity: float, rate: float) -> None:
+        """校正令牌桶：amount 为正时补扣（余量可为负），为负时退还"""
+        now = time.time()
+        with self._lock, self._transaction(immediate=True):
+            self._save_bucket(key, min(capacity, self._bucket_tokens(key, capacity, rate, now) - amount), now)
+
+    # ---------- 会话对话历史 ----------
+
+    def get_messages(self, session_id: str) -> List[BaseMessage]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT message FROM chat_messages WHERE session_id = ? ORDER BY id", (session_id,)
+            ).fetchall()
+        return messages_from_dict([json.loads(row["message"]) for row in rows])
+
+    def add_message(self, session_id: str, message: BaseMessage) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO chat_messages (session_id, message, created_at) VALUES (?, ?, ?)",
+                (session_id, json.dumps(messages_to_dict([message])[0], ensure_ascii=False), time.time())
+            )
+
+    def clear_messages(self, session_id: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
+
+
+class _Transaction:
+    """显式事务；immediate 时开始即获取写锁，避免读后写在多进程间冲突"""
+
+    def __init__(self, conn: sqlite3.Connection, immediate: bool):
+        self._conn = conn
+        self._immediate = immediate
+
+    def __enter__(self):
+        self._conn.execute("BEGIN IMMEDIATE" if self._immediate else "BEGIN")
+        return self._conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self._conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+class SharedChatMessageHistory(BaseChatMessageHistory):
+    """保存在共享存储中的会话对话历史，可直接作为 ConversationBufferMemory 的 chat_memory"""
+
+    def __init__(self, session_id: str, store: Optional[SharedStore] = None):
+        self.session_id = session_id
+        self.store = store or get_shared_store()
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return self.store.get_messages(self.session_id)
+
+    def add_message(self, message: BaseMessage) -> None:
+        self.store.add_message(self.session_id, message)
+
+    def clear(self) -> None:
+        self.store.clear_messages(self.session_id)
+
+
+_shared_store: Optional[SharedStore] = None
+_store_lock = threading.Lock()
+
+
+def get_shared_store() -> SharedStore:
+    """进程内共享的状态存储连接"""
+    global _shared_store
+    if _shared_store is None:
+        with _store_lock:
+            if _shared_store is None:
+                _shared_store = SharedStore()
+    return _shared_store
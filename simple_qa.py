@@ -4,18 +4,28 @@ import logging
 from pathlib import Path
 from typing import List, Dict, Any
 import re
-from openai import OpenAI
 import requests
 import streamlit as st
+from token_usage import estimate_tokens, record_llm_usage, usage_scope
+from llm_router import LLMRouter, ProviderConfig
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# 阶跃API配置
-STEPFUN_API_KEY = "5LHfDtyA4XFX5ObOqZtIrz0UlOMcYEn2hvy0FQdhT113enLNiLySnSWndOzz75ir4"
-STEPFUN_BASE_URL = "https://api.stepfun.com/v1"
-DEEPSEEK_API_KEY = "sk-4b2302a7e26541ac8513325953e61317"
-DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+# 阶跃 / DeepSeek API配置：API Key 只从环境变量读取（接口地址可指向本地模拟服务 stub_llm_server.py）
+STEPFUN_API_KEY = os.getenv("STEPFUN_API_KEY")
+STEPFUN_BASE_URL = os.getenv("STEPFUN_BASE_URL", "https://api.stepfun.com/v1")
+DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
+DEEPSEEK_BASE_URL = os.getenv("DEEPSEEK_BASE_URL", "https://api.deepseek.com")
+
+# 出题使用的大模型路由：按延迟和可用性在已配置 API Key 的服务之间选择，一方失败或变慢时自动切换
+PROVIDER_API_KEY_ENV = {"deepseek": "DEEPSEEK_API_KEY", "stepfun": "STEPFUN_API_KEY"}
+LLM_PROVIDERS = [provider for provider in (
+    ProviderConfig(name="deepseek", base_url=DEEPSEEK_BASE_URL, api_key=DEEPSEEK_API_KEY, model="deepseek-chat"),
+    ProviderConfig(name="stepfun", base_url=STEPFUN_BASE_URL, api_key=STEPFUN_API_KEY, model="step-1-8k"),
+) if provider.api_key]
+LLM_PROVIDER_NAMES = [provider.name for provider in LLM_PROVIDERS]
+exam_router = LLMRouter(LLM_PROVIDERS) if LLM_PROVIDERS else None
 
 def simple_sentence_split(text: str) -> List[str]:
     """简单的中文分句"""
@@ -109,19 +119,37 @@ class SimpleQAEngine:
                 })
         return qa_list
 
-def call_llm_api(content, model_type="deepseek", max_questions=5):
-    if model_type == "deepseek":
-        client = OpenAI(
-            api_key="sk-4b2302a7e26541ac8513325953e61317",
-            base_url="https://api.deepseek.com"
-        )
-        model = "deepseek-chat"
+def _streamlit_session_id():
+    """当前 Streamlit 会话ID，不在 Streamlit 中运行时返回 None"""
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        ctx = get_script_run_ctx()
+    except Exception:
+        return None
+    return ctx.session_id if ctx else None
+
+def _record_generation_usage(response, messages):
+    """记录出题调用的用量（在调用方的用量上下文中）：优先使用接口返回的 usage，缺失时本地估算"""
+    if response.prompt_tokens is not None:
+        prompt_tokens, completion_tokens, estimated = response.prompt_tokens, response.completion_tokens or 0, False
     else:
-        client = OpenAI(
-            api_key="5LHfDtyA4XFX5ObOqZtIrz0UlOMcYEn2hvy0FQdhT113enLNiLySnSWndOzz75ir4",
-            base_url="https://api.stepfun.com/v1"
-        )
-        model = "step-1-8k"
+        prompt_tokens = estimate_tokens("".join(message["content"] for message in messages))
+        completion_tokens, estimated = estimate_tokens(response.content), True
+    record_llm_usage("generate", response.model, prompt_tokens, completion_tokens, estimated=estimated,
+                     latency_ms=response.latency_ms, provider=response.provider)
+
+def call_llm_api(content, model_type="deepseek", max_questions=5, session_id=None):
+    """
+    调用大模型生成问答对
+    
+    model_type 为 deepseek / stepfun 时优先使用该服务（不可用或失败时自动切换到另一家），
+    为 auto 时由路由按最近的延迟和错误率选择
+    """
+    prefer = None if model_type == "auto" else model_type
+    if exam_router is None:
+        raise RuntimeError("未配置出题使用的大模型：请设置环境变量 DEEPSEEK_API_KEY 或 STEPFUN_API_KEY")
+    if prefer in PROVIDER_API_KEY_ENV and prefer not in LLM_PROVIDER_NAMES:
+        raise RuntimeError(f"未配置 {prefer} 的 API Key：请设置环境变量 {PROVIDER_API_KEY_ENV[prefer]}")
     prompt = (
         f"你是一个专业的知识问答生成专家。请根据以下文档内容，生成{max_questions}个高质量的问答对，要求如下：\n"
         "1. 问题需覆盖理解、应用、分析等不同层次，避免表面化和机械式提问。\n"
@@ -132,15 +160,15 @@ def call_llm_api(content, model_type="deepseek", max_questions=5):
         "文档内容如下：\n"
         + content
     )
-    response = client.chat.completions.create(
-        model=model,
-        messages=[
-            {"role": "system", "content": "你是一个专业的知识问答生成专家。"},
-            {"role": "user", "content": prompt},
-        ],
-        stream=False
-    )
-    raw = response.choices[0].message.content
+    messages = [
+        {"role": "system", "content": "你是一个专业的知识问答生成专家。"},
+        {"role": "user", "content": prompt},
+    ]
+    # 在用量上下文中调用：落败的对冲请求结束后也按本次出题的会话记录用量
+    with usage_scope(endpoint="exam_generator", session_id=session_id or _streamlit_session_id()):
+        response = exam_router.chat(messages, prefer=prefer)
+        _record_generation_usage(response, messages)
+    raw = response.content
     # 尝试直接解析
     try:
         return json.loads(raw)
@@ -163,5 +191,6 @@ if __name__ == "__main__":
     content = "请介绍一下人工智能的发展历程"
     print("DeepSeek结果：", call_llm_api(content, model_type="deepseek"))
     print("StepFun结果：", call_llm_api(content, model_type="stepfun"))
+    print("自动选择结果：", call_llm_api(content, model_type="auto"))
 
 __all__ = ["SimpleQAEngine", "generate_qa_pairs_with_stepfun", "generate_qa_pairs_with_deepseek", "generate_qa_pairs"] 
\ No newline at end of file
@@ -9,10 +9,11 @@ import json
 import os
 from pathlib import Path
 from simple_qa import call_llm_api
-import pdfplumber
+from pdf_extractor import extract_pdf_text
 import re
 from PIL import Image, ImageFilter
 import pytesseract
+from enhanced_ocr import image_processor
 
 # 指定 tesseract 主程序路径
 pytesseract.pytesseract.tesseract_cmd = r'E:\p\tesseract.exe'
@@ -22,12 +23,15 @@ os.environ['TESSDATA_PREFIX'] = r'E:\p\tessdata'
 # 页面配置
 st.set_page_config(page_title="逢考必过·AI考试复习助手", page_icon="🎓", layout="wide")
 
-# 阶跃API配置
-STEP_API_KEY = "5LHfDtyA4XFX5ObOqZtIrz0UlOMcYEn2hvy0FQdhT113enLNiLySnSWndOzz75ir4"
-BASE_URL = "https://api.stepfun.com/v1"
+# 阶跃API配置：API Key 只从环境变量读取
+STEP_API_KEY = os.getenv("STEPFUN_API_KEY")
+BASE_URL = os.getenv("STEPFUN_BASE_URL", "https://api.stepfun.com/v1")
 
 def upload_file_to_step(file, purpose="file-extract"):
     """上传文件到阶跃API"""
+    if not STEP_API_KEY:
+        st.error("未设置环境变量 STEPFUN_API_KEY，无法上传文件到阶跃API")
+        return None
     headers = {
         "Authorization": f"Bearer {STEP_API_KEY}"
     }
@@ -52,15 +56,9 @@ def upload_file_to_step(file, purpose="file-extract"):
         return None
 
 def extract_text_from_pdf(file):
-    """从PDF文件提取文本"""
+    """从PDF文件提取文本（扫描页自动OCR）"""
     try:
-        with pdfplumber.open(file) as pdf:
-            text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text.strip()
+        return extract_pdf_text(file)
     except Exception as e:
         st.error(f"PDF解析失败: {str(e)}")
         return ""
@@ -81,8 +79,9 @@ st.markdown("""
 st.sidebar.header("🛠️ 功能区")
 model_type = st.sidebar.selectbox(
     "请选择大模型API（推荐DeepSeek）",
-    ["deepseek", "stepfun"],
-    format_func=lambda x: "DeepSeek（更强）" if x=="deepseek" else "阶跃 StepFun"
+    ["deepseek", "stepfun", "auto"],
+    format_func=lambda x: {"deepseek": "DeepSeek（更强）", "stepfun": "阶跃 StepFun", "auto": "自动（选择响应最快的服务）"}[x],
+    help="所选服务不可用或响应过慢时会自动切换到另一家"
 )
 st.sidebar.info("支持PDF/文本上传，自动提取内容，调用大模型API生成高质量考题与答案。无需本地模型依赖！")
 
@@ -97,16 +96,14 @@ if st.button("🚀 一键生成智能考题"):
             text = ""
             file_name = uploaded_file.name
             if uploaded_file.type == "application/pdf":
-                with pdfplumber.open(uploaded_file) as pdf:
-                    for page in pdf.pages:
-                        text += page.extract_text() or ""
+                text = extract_text_from_pdf(uploaded_file)
             elif uploaded_file.type.startswith("image/"):
                 # 灰度化、二值化、锐化增强
                 image = Image.open(uploaded_file)
                 image = image.convert('L')
                 image = image.point(lambda x: 0 if x < 140 else 255, '1')
                 image = image.filter(ImageFilter.SHARPEN)
-                text = pytesseract.image_to_string(image, lang='chi_sim+eng')
+                text = image_processor.ocr_engine.image_to_string(image, lang='chi_sim+eng')
             else:
                 text += uploaded_file.read().decode("utf-8", errors="ignore")
             # 判断是否快处理
@@ -9,7 +9,7 @@ import json
 import os
 from pathlib import Path
 from simple_qa import call_llm_api
-import pdfplumber
+from pdf_extractor import iter_pdf_pages
 import re
 from PIL import Image, ImageFilter
 import pytesseract
@@ -23,12 +23,15 @@ os.environ['TESSDATA_PREFIX'] = r'E:\p\tessdata'
 # 页面配置
 st.set_page_config(page_title="逢考必过·AI考试复习助手", page_icon="🎓", layout="wide")
 
-# 阶跃API配置
-STEP_API_KEY = "5LHfDtyA4XFX5ObOqZtIrz0UlOMcYEn2hvy0FQdhT113enLNiLySnSWndOzz75ir4"
-BASE_URL = "https://api.stepfun.com/v1"
+# 阶跃API配置：API Key 只从环境变量读取
+STEP_API_KEY = os.getenv("STEPFUN_API_KEY")
+BASE_URL = os.getenv("STEPFUN_BASE_URL", "https://api.stepfun.com/v1")
 
 def upload_file_to_step(file, purpose="file-extract"):
     """上传文件到阶跃API"""
+    if not STEP_API_KEY:
+        st.error("未设置环境变量 STEPFUN_API_KEY，无法上传文件到阶跃API")
+        return None
     headers = {
         "Authorization": f"Bearer {STEP_API_KEY}"
     }
@@ -53,52 +56,84 @@ def upload_file_to_step(file, purpose="file-extract"):
         return None
 
 def extract_text_from_pdf(file):
-    """从PDF文件提取文本"""
+    """从PDF文件提取文本，扫描页在进程池中并行OCR，识别进度逐页显示"""
     try:
-        with pdfplumber.open(file) as pdf:
-            text = ""
-            for page in pdf.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
-        return text.strip()
+        pages = {}
+        progress = st.empty()
+        for page in iter_pdf_pages(file):
+            pages[page["page"]] = page["text"].strip()
+            if page["source"] == "ocr":
+                progress.caption(f"📄 {file.name}：第 {page['page']} 页为扫描页，已OCR识别（{page['elapsed_ms']:.0f} ms）")
+        progress.empty()
+        return "\n".join(pages[number] for number in sorted(pages) if pages[number])
     except Exception as e:
         st.error(f"PDF解析失败: {str(e)}")
         return ""
 
-def extract_text_from_image(file):
-    """从图片文件提取文本 - 使用增强OCR"""
+def image_cache_key(file, method):
+    """上传图片在当前会话中的缓存键"""
+    return (file.name, file.size, method)
+
+def extract_text_from_images(files, method="auto", use_layout=False):
+    """批量从图片文件提取文本 - 使用增强OCR，多张图片在进程池中并行处理"""
+    texts = {}
+    if not files:
+        return texts
+    
+    # 增强后的图像保存在会话中，供"图片处理演示"区域直接复用
+    enhanced_images = st.session_state.setdefault("enhanced_images", {})
+    
     try:
-        image = Image.open(file)
+        analysis_results = image_processor.batch_analyze(
+            [file.getvalue() for file in files],
+            method=method,
+            return_enhanced=True,
+            use_layout=use_layout
+        )
+    except Exception as e:
+        st.error(f"批量图片处理失败: {str(e)}")
+        analysis_results = [{'error': str(e)} for _ in files]
+    
+    for file, analysis_result in zip(files, analysis_results):
+        if analysis_result.get('error'):
+            st.error(f"图片处理失败: {analysis_result['error']}")
+            texts[file.name] = extract_text_from_image_basic(file)
+            continue
         
-        # 使用增强图片处理器分析图片
-        analysis_result = image_processor.analyze_image(image)
+        enhanced_images[image_cache_key(file, method)] = analysis_result.pop('enhanced_image', None)
         
         # 显示分析结果
         with st.expander(f"📊 图片分析结果 - {file.name}", expanded=False):
-            col1, col2, col3 = st.columns(3)
+            col1, col2, col3, col4 = st.columns(4)
             with col1:
                 st.metric("图片类型", analysis_result['image_type'])
             with col2:
                 st.metric("置信度", f"{analysis_result['confidence']:.2f}")
             with col3:
                 st.metric("文字长度", len(analysis_result['text']))
+            with col4:
+                st.metric("处理耗时", f"{analysis_result['elapsed_ms']:.0f} ms")
+            
+            for table_idx, table in enumerate(analysis_result.get('tables', []), 1):
+                st.write(f"表格 {table_idx}:")
+                st.dataframe(table, use_container_width=True)
         
-        return analysis_result['text']
-        
-    except Exception as e:
-        st.error(f"图片处理失败: {str(e)}")
-        # 回退到基础OCR
-        try:
-            image = Image.open(file)
-            image = image.convert('L')
-            image = image.point(lambda x: 0 if x < 140 else 255, '1')
-            image = image.filter(ImageFilter.SHARPEN)
-            text = pytesseract.image_to_string(image, lang='chi_sim+eng')
-            return text.strip()
-        except Exception as e2:
-            st.error(f"基础OCR也失败: {str(e2)}")
-            return ""
+        texts[file.name] = analysis_result['text']
+    
+    return texts
+
+def extract_text_from_image_basic(file):
+    """基础OCR（增强OCR失败时的回退方案）"""
+    try:
+        image = Image.open(file)
+        image = image.convert('L')
+        image = image.point(lambda x: 0 if x < 140 else 255, '1')
+        image = image.filter(ImageFilter.SHARPEN)
+        text = image_processor.ocr_engine.image_to_string(image, lang='chi_sim+eng')
+        return text.strip()
+    except Exception as e2:
+        st.error(f"基础OCR也失败: {str(e2)}")
+        return ""
 
 def split_text(text, max_chars=6000):
     """将文本按max_chars分段"""
@@ -116,8 +151,9 @@ st.markdown("""
 st.sidebar.header("🛠️ 功能区")
 model_type = st.sidebar.selectbox(
     "请选择大模型API（推荐DeepSeek）",
-    ["deepseek", "stepfun"],
-    format_func=lambda x: "DeepSeek（更强）" if x=="deepseek" else "阶跃 StepFun"
+    ["deepseek", "stepfun", "auto"],
+    format_func=lambda x: {"deepseek": "DeepSeek（更强）", "stepfun": "阶跃 StepFun", "auto": "自动（选择响应最快的服务）"}[x],
+    help="所选服务不可用或响应过慢时会自动切换到另一家"
 )
 
 # 图片处理选项
@@ -134,6 +170,7 @@ image_enhancement = st.sidebar.selectbox(
 )
 
 show_image_analysis = st.sidebar.checkbox("显示图片分析详情", value=True)
+use_layout_analysis = st.sidebar.checkbox("版面分析（按区域识别，提取表格结构）", value=False)
 
 st.sidebar.info("支持PDF/文本/图片上传，智能识别文字、表格、公式，调用大模型API生成高质量考题与答案。")
 
@@ -144,6 +181,13 @@ doc_content = st.text_area("或直接粘贴重点内容：", height=200, placeho
 if st.button("🚀 一键生成智能考题"):
     results = []
     if uploaded_files:
+        # 所有图片先一次性并行OCR
+        image_files = [f for f in uploaded_files if f.type.startswith("image/")]
+        image_texts = {}
+        if image_files:
+            with st.spinner(f"正在识别 {len(image_files)} 张图片..."):
+                image_texts = extract_text_from_images(image_files, image_enhancement, use_layout_analysis)
+        
         for uploaded_file in uploaded_files:
             text = ""
             file_name = uploaded_file.name
@@ -152,7 +196,7 @@ if st.button("🚀 一键生成智能考题"):
                 if uploaded_file.type == "application/pdf":
                     text = extract_text_from_pdf(uploaded_file)
                 elif uploaded_file.type.startswith("image/"):
-                    text = extract_text_from_image(uploaded_file)
+                    text = image_texts.get(file_name, "")
                 else:
                     text += uploaded_file.read().decode("utf-8", errors="ignore")
             
@@ -241,8 +285,13 @@ if uploaded_files and show_image_analysis:
             with col2:
                 st.subheader("处理后")
                 try:
-                    image = Image.open(uploaded_file)
-                    processed_image = image_processor.enhance_image(image, image_enhancement)
+                    # 优先复用OCR阶段已经增强过的图像
+                    processed_image = st.session_state.get("enhanced_images", {}).get(
+                        image_cache_key(uploaded_file, image_enhancement)
+                    )
+                    if processed_image is None:
+                        image = Image.open(uploaded_file)
+                        processed_image = image_processor.enhance_image(image, image_enhancement)
                     st.image(processed_image, caption=f"增强模式: {image_enhancement}", use_column_width=True)
                 except Exception as e:
                     st.error(f"图片处理失败: {str(e)}")
@@ -0,0 +1,136 @@
+"""
+来源片段存储模块
+按文档块ID在本地SQLite中保存块的原文和出处（文件、页码、字符偏移、内容哈希），
+前端展示引用时直接按ID取回原文片段，无需重新解析源文件
+"""
+
+import os
+import sqlite3
+import threading
+from typing import List, Dict, Any, Optional
+from langchain.schema import Document
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    chunk_id     TEXT NOT NULL,
+    collection   TEXT NOT NULL,
+    source       TEXT,
+    file_name    TEXT,
+    page         INTEGER,
+    section      TEXT,
+    char_start   INTEGER,
+    char_end     INTEGER,
+    content_hash TEXT,
+    content      TEXT NOT NULL,
+    PRIMARY KEY (chunk_id, collection)
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_position ON chunks (collection, source, page, char_start);
+"""
+
+_COLUMNS = ("chunk_id", "collection", "source", "file_name", "page", "section", "char_start", "char_end",
+            "content_hash", "content")
+
+
+class SourceStore:
+    """文档块原文存储，线程安全"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or Config.SOURCE_STORE_PATH
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        """为旧版本创建的数据库补充新增列"""
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+        if "section" not in columns:
+            with self._conn:
+                self._conn.execute("ALTER TABLE chunks ADD COLUMN section TEXT")
+
+    def add_chunks(self, documents: List[Document], collection: str) -> int:
+        """保存带 chunk_id 的文档块，同一集合内重复的块会被覆盖，返回写入数量"""
+        rows = []
+        for doc in documents:
+            metadata = doc.metadata
+            if not metadata.get("chunk_id"):
+                continue
+            rows.append((
+                metadata["chunk_id"], collection, metadata.get("source"), metadata.get("file_name"),
+                metadata.get("page"), metadata.get("section"), metadata.get("char_start"), metadata.get("char_end"),
+                metadata.get("content_hash"), doc.page_content
+            ))
+        if not rows:
+            return 0
+
+        with self._lock, self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO chunks ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                rows
+            )
+        return len(rows)
+
+    def get_chunk(self, chunk_id: str, collection: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """按ID获取文档块原文及出处，未指定集合时返回任意一个集合中的记录"""
+        query = "SELECT * FROM chunks WHERE chunk_id = ?"
+        params: List[Any] = [chunk_id]
+        if collection:
+            query += " AND collection = ?"
+            params.append(collection)
+        with self._lock:
+            row = self._conn.execute(query + " LIMIT 1", params).fetchone()
+        return dict(row) if row else None
+
+    def get_neighbors(self, chunk: Dict[str, Any], before: int = 1, after: int = 1) -> Dict[str, List[Dict[str, Any]]]:
+        """获取同一文件同一页（章节）内位于该块前后的相邻块，用于展示上下文"""
+        if chunk.get("char_start") is None:
+            return {"before": [], "after": []}
+
+        base = "SELECT * FROM chunks WHERE collection = ? AND source IS ? AND page IS ? AND section IS ? AND "
+        params = [chunk["collection"], chunk["source"], chunk["page"], chunk.get("section"), chunk["char_start"]]
+        with self._lock:
+            previous = self._conn.execute(
+                base + "char_start < ? ORDER BY char_start DESC LIMIT ?", params + [before]
+            ).fetchall()
+            following = self._conn.execute(
+                base + "char_start > ? ORDER BY char_start LIMIT ?", params + [after]
+            ).fetchall()
+        return {
+            "before": [dict(row) for row in reversed(previous)],
+            "after": [dict(row) for row in following]
+        }
+
+    def delete_chunks(self, chunk_ids: List[str], collection: str) -> None:
+        """删除集合中指定ID的块"""
+        if not chunk_ids:
+            return
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM chunks WHERE chunk_id = ? AND collection = ?",
+                                   [(chunk_id, collection) for chunk_id in chunk_ids])
+
+    def delete_collection(self, collection: str) -> None:
+        """删除某个集合的全部记录"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks WHERE collection = ?", (collection,))
+
+    def reset(self) -> None:
+        """清空存储"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM chunks")
+
+    def count(self, collection: Optional[str] = None) -> int:
+        """记录数"""
+        with self._lock:
+            if collection:
+                return self._conn.execute("SELECT COUNT(*) FROM chunks WHERE collection = ?",
+                                          (collection,)).fetchone()[0]
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+本地 OpenAI 兼容桩服务
+实现 /v1/chat/completions（含 SSE 流式输出）和 /v1/models，用于离线测试和压测时代替
+DeepSeek / StepFun / OpenAI 接口。支持可配置的延迟分布、输出token速率、错误注入，
+以及出题场景下的固定格式JSON问答输出；随机数使用固定种子，压测结果可复现。
+
+只依赖标准库。使用方式：
+    python stub_llm_server.py --port 8808 --latency lognormal:200,0.4 --tokens-per-s 60 --error-rate 0.02
+然后设置 OPENAI_API_BASE / DEEPSEEK_BASE_URL / STEPFUN_BASE_URL 为 http://127.0.0.1:8808/v1
+"""
+
+import re
+import json
+import math
+import time
+import uuid
+import random
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ANSWER = "根据提供的上下文，这是一个用于基准测试的模拟回答。"
+DEFAULT_MODELS = ("gpt-3.5-turbo", "deepseek-chat", "step-1-8k", "stub")
+
+_SENTENCE_SPLIT = re.compile(r'[。！？!?\n]+')
+_QUESTION_COUNT = re.compile(r'共\s*(\d+)\s*组|(\d+)\s*个(?:高质量的)?问答对')
+
+
+def _estimate_tokens(text: str) -> int:
+    """粗略估算token数（中文按字、其余按4字符计），避免依赖检索模块"""
+    cjk = sum(1 for ch in text if '\u4e00' <= ch <= '\u9fff')
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+class LatencyDistribution:
+    """
+    首token延迟分布（毫秒）
+
+    规格字符串格式：
+        fixed:100             固定 100ms
+        uniform:50,200        50-200ms 均匀分布
+        normal:150,30         均值150、标准差30（截断为非负）
+        lognormal:150,0.5     中位数150、对数标准差0.5，长尾更接近真实接口
+    """
+
+    KINDS = ("fixed", "uniform", "normal", "lognormal")
+
+    def __init__(self, kind: str = "fixed", params: Sequence[float] = (50.0,)):
+        if kind not in self.KINDS:
+            raise ValueError(f"不支持的延迟分布: {kind}")
+        self.kind = kind
+        self.params = tuple(float(p) for p in params)
+
+    @classmethod
+    def parse(cls, spec: str) -> "LatencyDistribution":
+        kind, _, args = spec.partition(":")
+        if not args:
+            # 只写数字时视为固定延迟
+            return cls("fixed", (float(kind),))
+        return cls(kind, [float(x) for x in args.split(",")])
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(self.params[0], self.params[1])
+        if self.kind == "normal":
+            return max(0.0, rng.gauss(self.params[0], self.params[1]))
+        return rng.lognormvariate(math.log(max(self.params[0], 1e-3)), self.params[1])
+
+    def __repr__(self) -> str:
+        return f"{self.kind}:{','.join(f'{p:g}' for p in self.params)}"
+
+
+def canned_qa_payload(prompt: str, count: int = 5) -> List[Dict[str, str]]:
+    """从提示中的文档内容生成固定格式的问答对，句子按出现顺序选取，结果可复现"""
+    content = prompt.split("文档内容如下：", 1)[-1]
+    sentences = [s.strip() for s in _SENTENCE_SPLIT.split(content) if len(s.strip()) >= 4]
+    if not sentences:
+        sentences = ["示例知识点"]
+    return [
+        {"question": f"请解释：{sentences[i % len(sentences)][:40]}？", "answer": sentences[i % len(sentences)]}
+        for i in range(count)
+    ]
+
+
+class StubLLMServer(ThreadingHTTPServer):
+    """多线程桩服务，每个请求独立线程处理"""
+
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int], latency_ms: float = 50.0,
+                 latency: Optional[LatencyDistribution] = None, tokens_per_s: float = 0.0,
+                 error_rate: float = 0.0, error_codes: Sequence[int] = (429, 500, 503),
+                 answer: str = DEFAULT_ANSWER, responses: Optional[List[Dict[str, str]]] = None,
+                 models: Sequence[str] = DEFAULT_MODELS, seed: int = 0):
+        """
+        Args:
+            latency_ms: 固定首token延迟（未指定 latency 分布时使用）
+            latency: 首token延迟分布
+            tokens_per_s: 输出token速率，0 表示瞬间输出；非流式响应同样按该速率计算总耗时
+            error_rate: 按概率返回错误
+            error_codes: 注入错误时随机选择的HTTP状态码（429 附带 Retry-After）
+            answer: 默认回答
+            responses: 固定回答列表 [{"match": 提示中包含的子串, "content": 回答}]，按顺序匹配
+            models: /v1/models 返回的模型列表
+            seed: 随机种子
+        """
+        super().__init__(address, StubLLMHandler)
+        self.latency = latency or LatencyDistribution("fixed", (latency_ms,))
+        self.tokens_per_s = tokens_per_s
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.answer = answer
+        self.responses = responses or []
+        self.models = tuple(models)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "streamed": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0}
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    @property
+    def request_count(self) -> int:
+        return self.stats["requests"]
+
+    def plan_request(self) -> Tuple[Optional[int], float]:
+        """为一个请求抽取（注入的错误码, 首token延迟），在锁内取随机数保证可复现"""
+        with self._lock:
+            self.stats["requests"] += 1
+            if self.error_rate and self._rng.random() < self.error_rate:
+                self.stats["errors"] += 1
+                return self._rng.choice(self.error_codes), self.latency.sample(self._rng)
+            return None, self.latency.sample(self._rng)
+
+    def record_usage(self, prompt_tokens: int, completion_tokens: int, streamed: bool) -> None:
+        with self._lock:
+            self.stats["prompt_tokens"] += prompt_tokens
+            self.stats["completion_tokens"] += completion_tokens
+            if streamed:
+                self.stats["streamed"] += 1
+
+    def reply_for(self, prompt: str) -> str:
+        """选择回答：固定回答 > 出题JSON > 默认回答"""
+        for item in self.responses:
+            if item.get("match", "") in prompt:
+                return item["content"]
+        if "JSON" in prompt and "question" in prompt:
+            match = _QUESTION_COUNT.search(prompt)
+            count = int(next(g for g in match.groups() if g)) if match else 5
+            return json.dumps(canned_qa_payload(prompt, count), ensure_ascii=False)
+        return self.answer
+
+
+class StubLLMHandler(BaseHTTPRequestHandler):
+    server: StubLLMServer
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logger.debug("stub llm: " + format, *args)
+
+    def _send_json(self, status: int, payload: dict, headers: Optional[Dict[str, str]] = None) -> None:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int) -> None:
+        kinds = {429: "rate_limit_exceeded", 500: "server_error", 503: "service_unavailable"}
+        headers = {"Retry-After": "1"} if status == 429 else None
+        self._send_json(status, {"error": {"message": f"模拟错误 {status}", "type": kinds.get(status, "error"),
+                                           "code": status}}, headers)
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0].rstrip("/")
+        if path.endswith("/models"):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": model, "object": "model", "created": 0, "owned_by": "stub"} for model in self.server.models
+            ]})
+        elif path.endswith("/stats"):
+            with self.server._lock:
+                stats = dict(self.server.stats)
+            stats["latency"] = repr(self.server.latency)
+            stats["tokens_per_s"] = self.server.tokens_per_s
+            stats["error_rate"] = self.server.error_rate
+            self._send_json(200, stats)
+        else:
+            self._send_json(404, {"error": {"message": f"未知接口: {self.path}", "type": "not_found"}})
+
+    def do_POST(self):
+        # 兼容带或不带 /v1 前缀的 base_url
+        if not self.path.split("?", 1)[0].rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"未知接口: {self.path}", "type": "not_found"}})
+            return
+
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self._send_json(400, {"error": {"message": "请求体不是合法JSON", "type": "invalid_request_error"}})
+            return
+
+        error, first_token_ms = self.server.plan_request()
+        time.sleep(first_token_ms / 1000)
+        if error:
+            self._send_error(error)
+            return
+
+        prompt = "".join(str(m.get("content", "")) for m in request.get("messages", []))
+        content = self.server.reply_for(prompt)
+        prompt_tokens = _estimate_tokens(prompt)
+        completion_tokens = _estimate_tokens(content)
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = request.get("model", "stub")
+
+        if request.get("stream"):
+            self._stream(completion_id, model, content)
+            self.server.record_usage(prompt_tokens, completion_tokens, streamed=True)
+            return
+
+        if self.server.tokens_per_s:
+            time.sleep(completion_tokens / self.server.tokens_per_s)
+        self.server.record_usage(prompt_tokens, completion_tokens, streamed=False)
+        self._send_json(200, {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        })
+
+    def _stream(self, completion_id: str, model: str, content: str) -> None:
+        """以 SSE 逐块输出回答（中文每字一块，西文每个单词一块），按token速率控制节奏"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+
+        def event(delta: Dict[str, Any], finish_reason: Optional[str] = None) -> None:
+            payload = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+
+        try:
+            event({"role": "assistant", "content": ""})
+            for piece in re.findall(r'[\u4e00-\u9fff]|[^\u4e00-\u9fff\s]+\s*|\s+', content):
+                if self.server.tokens_per_s:
+                    time.sleep(_estimate_tokens(piece) / self.server.tokens_per_s)
+                event({"content": piece})
+            event({}, finish_reason="stop")
+            self.wfile.write(b"data: [DONE]\n\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            logger.debug("客户端提前断开流式连接")
+
+
+def start_stub_server(host: str = "127.0.0.1", port: int = 0, **options) -> StubLLMServer:
+    """在后台线程中启动桩服务（port 为 0 时自动分配端口），返回服务对象，用 shutdown() 停止"""
+    server = StubLLMServer((host, port), **options)
+    thread = threading.Thread(target=server.serve_forever, name="stub-llm-server", daemon=True)
+    thread.start()
+    logger.info(f"模拟大模型服务已启动: {server.base_url}")
+    return server
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="本地 OpenAI 兼容桩服务")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8808)
+    parser.add_argument("--latency", default="fixed:50",
+                        help="首token延迟分布：fixed:MS / uniform:MIN,MAX / normal:MEAN,STD / lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--tokens-per-s", type=float, default=0.0, help="输出token速率，0 表示瞬间输出")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="错误注入概率")
+    parser.add_argument("--error-codes", type=int, nargs="+", default=[429, 500, 503])
+    parser.add_argument("--responses", default=None, help='固定回答JSON文件：[{"match": "...", "content": "..."}]')
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    canned = None
+    if args.responses:
+        with open(args.responses, "r", encoding="utf-8") as file:
+            canned = json.load(file)
+
+    logging.basicConfig(level=logging.INFO)
+    stub = StubLLMServer(
+        (args.host, args.port),
+        latency=LatencyDistribution.parse(args.latency),
+        tokens_per_s=args.tokens_per_s,
+        error_rate=args.error_rate,
+        error_codes=args.error_codes,
+        responses=canned,
+        seed=args.seed
+    )
+    print(f"模拟大模型服务: {stub.base_url}（延迟 {stub.latency}，{args.tokens_per_s or '不限'} tokens/s，"
+          f"错误率 {args.error_rate}）")
+    try:
+        stub.serve_forever()
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -3,15 +3,26 @@
 测试阶跃API连接
 """
 
+import os
+import sys
 import requests
 import json
 
-# 阶跃API配置
-STEP_API_KEY = "5LHfDtyA4XFX5ObOqZtIrz0UlOMcYEn2hvy0FQdhT113enLNiLySnSWndOzz75ir4"
-BASE_URL = "https://api.stepfun.com/v1"
+# 阶跃API配置：API Key 只从环境变量读取（STEPFUN_BASE_URL 可指向本地模拟服务 stub_llm_server.py 离线测试）
+STEP_API_KEY = os.getenv("STEPFUN_API_KEY")
+BASE_URL = os.getenv("STEPFUN_BASE_URL", "https://api.stepfun.com/v1")
+
+def _check_api_key():
+    """未设置 STEPFUN_API_KEY 时给出提示"""
+    if not STEP_API_KEY:
+        print("❌ 未设置环境变量 STEPFUN_API_KEY，请先配置阶跃API Key")
+        return False
+    return True
 
 def test_step_api():
     """测试阶跃API连接"""
+    if not _check_api_key():
+        return False
     headers = {
         "Authorization": f"Bearer {STEP_API_KEY}",
         "Content-Type": "application/json"
@@ -75,6 +86,8 @@ def test_step_api():
 def test_file_upload():
     """测试文件上传功能"""
     print("\n📁 测试文件上传功能...")
+    if not _check_api_key():
+        return False
     
     headers = {
         "Authorization": f"Bearer {STEP_API_KEY}"
@@ -110,6 +123,8 @@ def test_file_upload():
 if __name__ == "__main__":
     print("🤖 阶跃API测试工具")
     print("=" * 50)
+    if not _check_api_key():
+        sys.exit(1)
     
     # 测试聊天API
     chat_success = test_step_api()
@@ -4,6 +4,7 @@
 """
 
 import os
+import json
 import sys
 import tempfile
 import requests
@@ -35,9 +36,17 @@ def test_document_processor():
             f.write("这是一个测试文档。包含一些测试内容，用于验证文档处理功能是否正常工作。")
             test_file = f.name
         
-        processor = DocumentProcessor()
+        processor = DocumentProcessor(chunk_size=20, chunk_overlap=5)
         chunks = processor.process_file(test_file)
         
+        # 文档块应带有可直接定位原文的出处信息
+        with open(test_file, 'r', encoding='utf-8') as f:
+            content = f.read()
+        for chunk in chunks:
+            metadata = chunk.metadata
+            assert content[metadata["char_start"]:metadata["char_end"]] == chunk.page_content, "字符偏移与原文不一致"
+            assert metadata["chunk_id"] and metadata["content_hash"], "缺少 chunk_id 或内容哈希"
+        
         print(f"✅ 文档处理器测试成功")
         print(f"   - 生成了 {len(chunks)} 个文档块")
         
@@ -85,6 +94,212 @@ def test_vector_store():
         print(f"❌ 向量存储测试失败: {e}")
         return False
 
+def test_retrieval_strategies():
+    """测试检索策略（MMR、分数阈值、token预算）"""
+    print("\n🎯 测试检索策略...")
+    try:
+        import numpy as np
+        from langchain.schema import Document
+        from retrieval import maximal_marginal_relevance, select_candidates, trim_to_token_budget
+        
+        query = np.array([1.0, 0.0])
+        # 前两个候选几乎重复，MMR 应跳过第二个而选择更有差异的第三个
+        embeddings = np.array([[1.0, 0.0], [0.99, 0.01], [0.7, 0.7]])
+        selected = maximal_marginal_relevance(query, embeddings, k=2, lambda_mult=0.3)
+        assert selected == [0, 2], f"MMR选择结果异常: {selected}"
+        
+        docs = [Document(page_content=f"文档{i}" * 50) for i in range(3)]
+        candidates = [(docs[0], 0.1, None), (docs[1], 0.5, None), (docs[2], 1.5, None)]
+        kept = select_candidates(query, candidates, strategy="threshold", k=3, score_threshold=0.5)
+        assert len(kept) == 2, f"分数阈值过滤异常: {len(kept)}"
+        
+        trimmed = trim_to_token_budget(docs, max_tokens=200)
+        assert len(trimmed) == 1, f"token预算裁剪异常: {len(trimmed)}"
+        
+        print("✅ 检索策略测试成功")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 检索策略测试失败: {e}")
+        return False
+
+def test_stub_llm_server():
+    """测试本地模拟大模型服务（普通、流式与错误注入）"""
+    print("\n🧪 测试模拟大模型服务...")
+    try:
+        import urllib.request
+        import urllib.error
+        from stub_llm_server import start_stub_server
+        
+        def post(server, body):
+            request = urllib.request.Request(
+                server.base_url + "/chat/completions",
+                data=json.dumps(body).encode("utf-8"),
+                headers={"Content-Type": "application/json"}
+            )
+            return urllib.request.urlopen(request, timeout=5).read().decode("utf-8")
+        
+        server = start_stub_server(latency_ms=1)
+        try:
+            messages = [{"role": "user", "content": "你好"}]
+            reply = json.loads(post(server, {"model": "stub", "messages": messages}))
+            assert reply["choices"][0]["message"]["content"], "回答为空"
+            
+            stream = post(server, {"model": "stub", "messages": messages, "stream": True})
+            assert stream.rstrip().endswith("data: [DONE]"), "流式输出未正常结束"
+        finally:
+            server.shutdown()
+        
+        server = start_stub_server(latency_ms=1, error_rate=1.0, error_codes=[429])
+        try:
+            post(server, {"model": "stub", "messages": []})
+            raise AssertionError("错误注入未生效")
+        except urllib.error.HTTPError as e:
+            assert e.code == 429, f"错误码异常: {e.code}"
+        finally:
+            server.shutdown()
+        
+        print("✅ 模拟大模型服务测试成功")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 模拟大模型服务测试失败: {e}")
+        return False
+
+def test_rate_limiter():
+    """测试大模型限流：跨实例共用的令牌桶、429 退避重试与并发上限减半、排队超时"""
+    print("\n🚦 测试大模型限流...")
+    try:
+        from shared_state import SharedStore
+        from rate_limiter import RateLimiter, LimiterTimeoutError
+        from stub_llm_server import start_stub_server
+        
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SharedStore(os.path.join(temp_dir, "shared_state.db"))
+            
+            # 同一 key 的两个限流器（相当于两个进程）共用 RPM 配额
+            first = RateLimiter("stub", rpm=1, key="stub:test", store=store)
+            second = RateLimiter("stub", rpm=1, key="stub:test", store=store)
+            first.acquire(timeout=1)
+            first.release(0.01)
+            try:
+                second.acquire(timeout=0.2)
+                raise AssertionError("RPM 配额未在实例间共用")
+            except LimiterTimeoutError:
+                pass
+            
+            # 并发已满时排队超时
+            limiter = RateLimiter("stub", max_concurrency=2, key="stub:queue", store=store)
+            assert int(limiter.limit) == 1, f"初始并发上限异常: {limiter.limit}"
+            limiter.acquire(timeout=1)
+            start = time.monotonic()
+            try:
+                limiter.acquire(timeout=0.2)
+                raise AssertionError("并发已满时未排队超时")
+            except LimiterTimeoutError:
+                assert time.monotonic() - start >= 0.2, "排队未等待到超时时间"
+            limiter.release(0.01)
+            
+            # 429：按 Retry-After 退避重试，并发上限减半
+            server = start_stub_server(latency_ms=1, error_rate=1.0, error_codes=[429])
+            try:
+                def call():
+                    response = requests.post(server.base_url + "/chat/completions",
+                                             json={"model": "stub", "messages": []}, timeout=5)
+                    response.raise_for_status()
+                    return response.json()
+                
+                limiter = RateLimiter("stub", max_concurrency=8, key="stub:429", store=store)
+                assert int(limiter.limit) == 4, f"初始并发上限异常: {limiter.limit}"
+                start = time.monotonic()
+                try:
+                    limiter.call(call, retries=1)
+                    raise AssertionError("持续 429 时未抛出异常")
+                except requests.HTTPError as e:
+                    assert e.response.status_code == 429
+                assert server.stats["requests"] == 2, f"重试次数异常: {server.stats['requests']}"
+                assert time.monotonic() - start >= 1.0, "未按 Retry-After 退避"
+                # 两次 429 相隔一个退避时间，上限各减半一次：4 -> 2 -> 1
+                assert int(limiter.limit) == 1, f"429 后并发上限未减半: {limiter.limit}"
+                assert limiter.inflight == 0, "调用许可未归还"
+            finally:
+                server.shutdown()
+        
+        print("✅ 大模型限流测试成功")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 大模型限流测试失败: {e}")
+        return False
+
+def test_llm_router():
+    """测试大模型路由：熔断状态切换、失败切换到其他服务商、对冲请求及落败请求的用量记录"""
+    print("\n🔀 测试大模型路由...")
+    try:
+        from config import Config
+        from llm_router import LLMRouter, ProviderConfig, ProviderStats
+        from stub_llm_server import start_stub_server
+        from token_usage import usage_scope
+
+        # 熔断：连续失败达到阈值后熔断，冷却结束只放行一个试探请求，试探成功后恢复
+        stats = ProviderStats("stub", failure_threshold=2, cooldown=0.2)
+        stats.record(10, ok=False)
+        assert stats.state == "closed", "未达到失败阈值就熔断"
+        stats.record(10, ok=False)
+        assert stats.state == "open" and not stats.allow_request(), "连续失败后未熔断"
+        time.sleep(0.25)
+        assert stats.allow_request() and stats.state == "half_open", "冷却结束后未放行试探请求"
+        assert not stats.allow_request(), "半开状态放行了多个试探请求"
+        stats.record(10, ok=True)
+        assert stats.state == "closed" and stats.allow_request(), "试探成功后未恢复"
+
+        messages = [{"role": "user", "content": "什么是人工智能？"}]
+        broken = start_stub_server(latency_ms=1, error_rate=1.0, error_codes=[500])
+        slow = start_stub_server(latency_ms=1500)
+        fast = start_stub_server(latency_ms=1)
+        settings = (Config.LLM_HEDGE_DEFAULT_MS, Config.LLM_HEDGE_MIN_MS, Config.USAGE_TRACKING)
+        # 用量只检查请求内合计，不写入本地用量存储
+        Config.USAGE_TRACKING = False
+        try:
+            # 失败切换：优先的服务商返回 500 时改用下一个
+            router = LLMRouter([
+                ProviderConfig("broken", broken.base_url, "stub-key", "stub"),
+                ProviderConfig("healthy", fast.base_url, "stub-key", "stub"),
+            ], hedging=False)
+            response = router.chat(messages, prefer="broken")
+            assert response.provider == "healthy", f"未切换服务商: {response.provider}"
+            assert broken.stats["requests"] == 1, "失败的服务商被重试"
+            assert router.providers[0].stats.consecutive_failures == 1, "失败未计入熔断统计"
+
+            # 对冲：优先的服务商超过等待时间未返回时向下一个发送对冲请求，先返回者胜出
+            Config.LLM_HEDGE_DEFAULT_MS, Config.LLM_HEDGE_MIN_MS = 100, 10
+            router = LLMRouter([
+                ProviderConfig("slow", slow.base_url, "stub-key", "stub"),
+                ProviderConfig("fast", fast.base_url, "stub-key", "stub"),
+            ], hedging=True)
+            with usage_scope(endpoint="router_test") as scope:
+                start = time.monotonic()
+                response = router.chat(messages, prefer="slow")
+                assert response.provider == "fast" and response.hedged, f"对冲请求未胜出: {response}"
+                assert time.monotonic() - start < 1.0, "对冲后仍在等待慢服务返回"
+                # 落败的请求在后台完成后也记录用量
+                for _ in range(50):
+                    if scope.summary()["calls"]:
+                        break
+                    time.sleep(0.1)
+                assert scope.summary()["calls"] == 1, "落败的请求未记录用量"
+        finally:
+            Config.LLM_HEDGE_DEFAULT_MS, Config.LLM_HEDGE_MIN_MS, Config.USAGE_TRACKING = settings
+            for server in (broken, slow, fast):
+                server.shutdown()
+
+        print("✅ 大模型路由测试成功")
+        return True
+
+    except Exception as e:
+        print(f"❌ 大模型路由测试失败: {e}")
+        return False
+
 def test_qa_engine():
     """测试问答引擎"""
     print("\n🤖 测试问答引擎...")
@@ -146,6 +361,66 @@ def test_api_server():
         print(f"❌ API服务器测试失败: {e}")
         return False
 
+def test_request_profiling():
+    """测试单请求剖析：交给线程池执行的问答也应记录在 .prof 文件中"""
+    print("\n⏱️ 测试单请求剖析...")
+    try:
+        import socket
+        import pstats
+        import threading
+        import uvicorn
+        from config import Config
+        from stub_llm_server import start_stub_server
+        
+        stub = start_stub_server(latency_ms=1)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            # 导入 api 前改写配置：问答走模拟服务，索引和各类存储放在临时目录
+            Config.OPENAI_API_KEY = "stub-key"
+            Config.OPENAI_API_BASE = stub.base_url
+            Config.LLM_ROUTING = False
+            Config.ADMIN_TOKEN = "test-admin-token"
+            Config.PROFILE_DIR = os.path.join(temp_dir, "profiles")
+            Config.CHROMA_PERSIST_DIRECTORY = os.path.join(temp_dir, "chroma")
+            Config.UPLOAD_DIR = os.path.join(temp_dir, "uploads")
+            Config.SOURCE_STORE_PATH = os.path.join(temp_dir, "source_store.db")
+            Config.USAGE_DB_PATH = os.path.join(temp_dir, "usage.db")
+            Config.SHARED_STATE_PATH = os.path.join(temp_dir, "shared_state.db")
+            from api import app
+            
+            with socket.socket() as sock:
+                sock.bind(("127.0.0.1", 0))
+                port = sock.getsockname()[1]
+            server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+            thread = threading.Thread(target=server.run, daemon=True)
+            thread.start()
+            try:
+                for _ in range(100):
+                    if server.started:
+                        break
+                    time.sleep(0.1)
+                response = requests.post(
+                    f"http://127.0.0.1:{port}/ask",
+                    json={"question": "什么是人工智能？", "use_history": False},
+                    headers={Config.PROFILE_HEADER: "1", "X-Admin-Token": Config.ADMIN_TOKEN},
+                    timeout=60
+                )
+                profile_file = response.headers.get("X-Profile-File")
+                assert profile_file, "响应中缺少 X-Profile-File"
+                stats = pstats.Stats(os.path.join(Config.PROFILE_DIR, profile_file))
+                recorded = {(os.path.basename(filename), name) for filename, _, name in stats.stats}
+                assert ("qa_engine.py", "ask_question") in recorded, "剖析结果中没有 QAEngine.ask_question"
+            finally:
+                server.should_exit = True
+                thread.join(timeout=10)
+                stub.shutdown()
+        
+        print("✅ 单请求剖析测试成功")
+        return True
+        
+    except Exception as e:
+        print(f"❌ 单请求剖析测试失败: {e}")
+        return False
+
 def test_web_interface():
     """测试Web界面"""
     print("\n🎨 测试Web界面...")
@@ -286,8 +561,13 @@ def main():
         ("配置模块", test_config),
         ("文档处理器", test_document_processor),
         ("向量存储", test_vector_store),
+        ("检索策略", test_retrieval_strategies),
+        ("模拟大模型服务", test_stub_llm_server),
+        ("大模型限流", test_rate_limiter),
+        ("大模型路由", test_llm_router),
         ("问答引擎", test_qa_engine),
         ("API服务器", test_api_server),
+        ("单请求剖析", test_request_profiling),
         ("Web界面", test_web_interface),
     ]
     
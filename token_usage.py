@@ -0,0 +1,301 @@
+"""
+大模型用量统计模块
+记录每次大模型调用的提示 / 生成 token 数（优先使用接口返回的 usage，缺失时本地估算）和费用，
+连同会话、课程集合、接口以及本次检索的文档块数量、上下文长度一起保存在本地 SQLite 中，
+可按任意维度汇总（/usage 接口），同时计入 /metrics 指标，用于调整分块大小和 top-k
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import logging
+from config import Config
+from metrics import LLM_COST, LLM_TOKENS
+
+logger = logging.getLogger(__name__)
+
+# 每千 token 的参考价格（美元）：(提示, 生成)；可通过 LLM_PRICING 环境变量（JSON）覆盖或补充
+DEFAULT_PRICING = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4o-mini": (0.00015, 0.0006),
+    "gpt-4o": (0.0025, 0.01),
+    "deepseek-chat": (0.00027, 0.0011),
+    "step-1-8k": (0.0007, 0.0028),
+}
+
+# 可用于汇总分组的维度；day 为调用日期（本地时间）
+USAGE_DIMENSIONS = ("endpoint", "session_id", "collection", "provider", "model", "stage",
+                    "k", "context_docs", "chunk_size", "day")
+
+# 用量上下文中可设置的字段（k / context_docs / context_tokens / chunk_size 由检索器写入）
+_SCOPE_FIELDS = ("endpoint", "session_id", "collection", "k", "context_docs", "context_tokens",
+                 "chunk_size")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS llm_usage (
+    id                INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at        REAL NOT NULL,
+    endpoint          TEXT,
+    session_id        TEXT,
+    collection        TEXT,
+    provider          TEXT,
+    model             TEXT,
+    stage             TEXT,
+    prompt_tokens     INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    estimated         INTEGER NOT NULL DEFAULT 0,
+    cost              REAL,
+    latency_ms        REAL,
+    k                 INTEGER,
+    context_docs      INTEGER,
+    context_tokens    INTEGER,
+    chunk_size        INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_usage_created ON llm_usage (created_at);
+CREATE INDEX IF NOT EXISTS idx_usage_session ON llm_usage (session_id, created_at);
+"""
+
+_COLUMNS = ("created_at", "endpoint", "session_id", "collection", "provider", "model", "stage",
+            "prompt_tokens", "completion_tokens", "estimated", "cost", "latency_ms",
+            "k", "context_docs", "context_tokens", "chunk_size")
+
+
+def load_pricing() -> Dict[str, Tuple[float, float]]:
+    """默认价格表合并 LLM_PRICING 中的配置，格式 {"模型": [提示价格, 生成价格]}（每千 token）"""
+    pricing = dict(DEFAULT_PRICING)
+    if Config.LLM_PRICING:
+        try:
+            for model, prices in json.loads(Config.LLM_PRICING).items():
+                pricing[model] = (float(prices[0]), float(prices[1]))
+        except (ValueError, TypeError, IndexError, AttributeError) as e:
+            logger.warning(f"LLM_PRICING 配置无效，使用默认价格: {e}")
+    return pricing
+
+
+_PRICING = load_pricing()
+
+
+def estimate_cost(model: Optional[str], prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    """按价格表计算费用；带版本后缀的模型名（如 gpt-3.5-turbo-0125）按最长前缀匹配，未知模型返回 None"""
+    if not model:
+        return None
+    prices = _PRICING.get(model)
+    if prices is None:
+        matches = [name for name in _PRICING if model.startswith(name)]
+        if not matches:
+            return None
+        prices = _PRICING[max(matches, key=len)]
+    return (prompt_tokens * prices[0] + completion_tokens * prices[1]) / 1000
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 token 数（与检索裁剪上下文使用同一规则）"""
+    from retrieval import estimate_tokens as _estimate
+    return _estimate(text)
+
+
+def usage_from_llm_result(response, prompt_text: str) -> Tuple[int, int, bool]:
+    """
+    从 LangChain 的 LLMResult 中取出 (提示 token, 生成 token, 是否为估算值)
+
+    接口未返回用量（流式输出或部分兼容接口）时按文本估算
+    """
+    usage = (response.llm_output or {}).get("token_usage") or {}
+    if usage.get("prompt_tokens") is not None:
+        return int(usage["prompt_tokens"]), int(usage.get("completion_tokens") or 0), False
+    completion = "".join(gen.text for generations in response.generations for gen in generations)
+    return estimate_tokens(prompt_text), estimate_tokens(completion), True
+
+
+class UsageScope:
+    """一次请求的用量上下文：调用所属的接口、会话、集合等字段，以及请求内的用量合计"""
+
+    def __init__(self, fields: Dict[str, Any], totals: Optional[Dict[str, Any]] = None,
+                 lock: Optional[threading.Lock] = None):
+        self.fields = fields
+        self.totals = totals if totals is not None else {
+            "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "estimated": False
+        }
+        self._lock = lock or threading.Lock()
+
+    def add(self, prompt_tokens: int, completion_tokens: int, cost: Optional[float], estimated: bool) -> None:
+        with self._lock:
+            self.totals["calls"] += 1
+            self.totals["prompt_tokens"] += prompt_tokens
+            self.totals["completion_tokens"] += completion_tokens
+            self.totals["cost"] += cost or 0.0
+            self.totals["estimated"] = self.totals["estimated"] or estimated
+
+    def summary(self) -> Dict[str, Any]:
+        """请求内的用量合计，可直接放入接口响应"""
+        with self._lock:
+            totals = dict(self.totals)
+        totals["total_tokens"] = totals["prompt_tokens"] + totals["completion_tokens"]
+        totals["cost"] = round(totals["cost"], 6)
+        return totals
+
+
+_current_scope: ContextVar[Optional[UsageScope]] = ContextVar("usage_scope", default=None)
+
+
+@contextmanager
+def usage_scope(**fields):
+    """
+    设置用量上下文，范围内的大模型调用都记上这些字段
+
+    嵌套时继承外层字段并共用外层的用量合计（值为 None 的字段不覆盖外层）
+    """
+    unknown = set(fields) - set(_SCOPE_FIELDS)
+    if unknown:
+        raise ValueError(f"不支持的用量字段: {', '.join(sorted(unknown))}")
+    parent = _current_scope.get()
+    merged = dict(parent.fields) if parent else {}
+    merged.update({key: value for key, value in fields.items() if value is not None})
+    scope = UsageScope(merged, parent.totals, parent._lock) if parent else UsageScope(merged)
+    token = _current_scope.set(scope)
+    try:
+        yield scope
+    finally:
+        _current_scope.reset(token)
+
+
+def annotate_usage(**fields) -> None:
+    """向当前用量上下文补充字段（如检索器写入 k 和上下文大小），没有上下文时忽略"""
+    scope = _current_scope.get()
+    if scope is not None:
+        scope.fields.update({key: value for key, value in fields.items()
+                             if key in _SCOPE_FIELDS and value is not None})
+
+
+class UsageStore:
+    """大模型调用用量的本地存储，线程安全"""
+
+    def __init__(self, db_path: str = None):
+        self.db_path = db_path or Config.USAGE_DB_PATH
+        directory = os.path.dirname(os.path.abspath(self.db_path))
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(_SCHEMA)
+
+    def add(self, record: Dict[str, Any]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                f"INSERT INTO llm_usage ({', '.join(_COLUMNS)}) VALUES ({', '.join('?' * len(_COLUMNS))})",
+                [record.get(column) for column in _COLUMNS]
+            )
+
+    def summary(self, group_by: Sequence[str] = (), since: Optional[float] = None,
+                filters: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        汇总用量
+
+        Args:
+            group_by: 分组维度，取自 USAGE_DIMENSIONS；为空时返回总计
+            since: 只统计该时间戳（秒）之后的调用
+            filters: 按列精确过滤，如 {"session_id": "abc"}
+        """
+        unknown = [dimension for dimension in group_by if dimension not in USAGE_DIMENSIONS]
+        unknown += [column for column in (filters or {}) if column not in USAGE_DIMENSIONS or column == "day"]
+        if unknown:
+            raise ValueError(f"不支持的维度: {', '.join(unknown)}，可选: {', '.join(USAGE_DIMENSIONS)}")
+
+        expressions = ["date(created_at, 'unixepoch', 'localtime') AS day" if dimension == "day" else dimension
+                       for dimension in group_by]
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("created_at >= ?")
+            params.append(since)
+        for column, value in (filters or {}).items():
+            conditions.append(f"{column} IS ?")
+            params.append(value)
+
+        query = "SELECT " + ", ".join(expressions + [
+            "COUNT(*) AS calls",
+            "SUM(prompt_tokens) AS prompt_tokens",
+            "SUM(completion_tokens) AS completion_tokens",
+            "SUM(prompt_tokens + completion_tokens) AS total_tokens",
+            "ROUND(SUM(COALESCE(cost, 0)), 6) AS cost",
+            "ROUND(AVG(latency_ms), 1) AS avg_latency_ms",
+            "SUM(estimated) AS estimated_calls",
+        ]) + " FROM llm_usage"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        if group_by:
+            query += f" GROUP BY {', '.join(group_by)} ORDER BY total_tokens DESC"
+
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [dict(row) for row in rows if row["calls"]]
+
+    def reset(self) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM llm_usage")
+
+
+_usage_store: Optional[UsageStore] = None
+_store_lock = threading.Lock()
+
+
+def get_usage_store() -> UsageStore:
+    """进程内共享的用量存储"""
+    global _usage_store
+    if _usage_store is None:
+        with _store_lock:
+            if _usage_store is None:
+                _usage_store = UsageStore()
+    return _usage_store
+
+
+def record_llm_usage(stage: str, model: Optional[str], prompt_tokens: int, completion_tokens: int,
+                     estimated: bool = False, latency_ms: Optional[float] = None,
+                     provider: Optional[str] = None) -> Dict[str, Any]:
+    """
+    记录一次大模型调用的用量：写入本地存储、计入指标并累加到当前请求的用量合计
+
+    存储写入失败只记录日志，不影响调用方
+    """
+    scope = _current_scope.get()
+    fields = scope.fields if scope else {}
+    cost = estimate_cost(model, prompt_tokens, completion_tokens)
+    record = {
+        "created_at": time.time(),
+        "endpoint": fields.get("endpoint"),
+        "session_id": fields.get("session_id"),
+        "collection": fields.get("collection"),
+        "provider": provider,
+        "model": model,
+        "stage": stage,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "estimated": int(estimated),
+        "cost": cost,
+        "latency_ms": latency_ms,
+        "k": fields.get("k"),
+        "context_docs": fields.get("context_docs"),
+        "context_tokens": fields.get("context_tokens"),
+        "chunk_size": fields.get("chunk_size"),
+    }
+
+    endpoint = record["endpoint"] or ""
+    LLM_TOKENS.inc(prompt_tokens, model=model or "", kind="prompt", endpoint=endpoint)
+    LLM_TOKENS.inc(completion_tokens, model=model or "", kind="completion", endpoint=endpoint)
+    if cost:
+        LLM_COST.inc(cost, model=model or "", endpoint=endpoint)
+    if scope is not None:
+        scope.add(prompt_tokens, completion_tokens, cost, estimated)
+
+    if Config.USAGE_TRACKING:
+        try:
+            get_usage_store().add(record)
+        except sqlite3.Error as e:
+            logger.warning(f"记录大模型用量失败: {e}")
+    return record
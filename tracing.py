@@ -0,0 +1,441 @@
+"""
+请求链路追踪模块
+以 contextvars 维护当前 span，把一次请求从 API 中间件、问答引擎、检索器到大模型调用串成一棵调用树，
+span 上记录耗时、k、token 数等属性。结束的 span 由后台线程批量导出到 JSONL 文件或
+兼容 OTLP/HTTP（JSON 编码）的本地采集器；命令行可汇总最慢的请求：
+
+    python tracing.py summarize ./traces/traces.jsonl --top 10
+"""
+
+import os
+import json
+import time
+import queue
+import random
+import atexit
+import logging
+import threading
+import urllib.request
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+TRACE_EXPORTERS = ("jsonl", "otlp", "none")
+
+# OTLP 中 span 的类型编号
+_SPAN_KINDS = {"internal": 1, "server": 2, "client": 3}
+
+
+def _new_trace_id() -> str:
+    return f"{random.getrandbits(128) or 1:032x}"
+
+
+def _new_span_id() -> str:
+    return f"{random.getrandbits(64) or 1:016x}"
+
+
+class Span:
+    """一次计时的操作，结束后交给追踪器导出"""
+
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "kind", "attributes", "status", "error",
+                 "start_time", "_start", "duration_ms", "sampled", "_tracer")
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: Optional[str],
+                 sampled: bool, kind: str = "internal", attributes: Optional[Dict[str, Any]] = None):
+        self._tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_span_id()
+        self.parent_id = parent_id
+        self.sampled = sampled
+        self.kind = kind
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.error: Optional[str] = None
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def set_attributes(self, attributes: Dict[str, Any]) -> None:
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def record_error(self, error: BaseException) -> None:
+        self.status = "error"
+        self.error = f"{type(error).__name__}: {error}"
+
+    def end(self) -> None:
+        """结束 span，重复调用无效"""
+        if self.duration_ms is not None:
+            return
+        self.duration_ms = (time.perf_counter() - self._start) * 1000
+        self._tracer._finish(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "start_time": self.start_time,
+            "duration_ms": self.duration_ms,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+_current_span: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    """当前上下文中的 span"""
+    return _current_span.get()
+
+
+def parse_traceparent(header: Optional[str]) -> Optional[Tuple[str, str, bool]]:
+    """解析 W3C traceparent 请求头，返回 (trace_id, 上游 span_id, 是否采样)"""
+    if not header:
+        return None
+    parts = header.strip().split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None
+    try:
+        int(parts[1], 16), int(parts[2], 16)
+        flags = int(parts[3], 16)
+    except ValueError:
+        return None
+    if parts[1] == "0" * 32 or parts[2] == "0" * 16:
+        return None
+    return parts[1], parts[2], bool(flags & 1)
+
+
+def format_traceparent(span: Span) -> str:
+    """生成下游可继续使用的 traceparent 值"""
+    return f"00-{span.trace_id}-{span.span_id}-{'01' if span.sampled else '00'}"
+
+
+class JsonlSpanExporter:
+    """每个 span 一行 JSON，追加写入本地文件"""
+
+    def __init__(self, path: str = None):
+        self.path = path or Config.TRACE_FILE
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+
+    def export(self, spans: List[Span]) -> None:
+        lines = "".join(json.dumps(span.to_dict(), ensure_ascii=False, default=str) + "\n" for span in spans)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(lines)
+
+
+def _otlp_value(value: Any) -> Dict[str, Any]:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OtlpHttpSpanExporter:
+    """按 OTLP/HTTP JSON 编码发送到采集器（如本地 OpenTelemetry Collector / Jaeger 的 4318 端口）"""
+
+    def __init__(self, endpoint: str = None, service_name: str = None, timeout: float = 5.0):
+        self.endpoint = endpoint or Config.OTLP_ENDPOINT
+        self.service_name = service_name or Config.TRACE_SERVICE_NAME
+        self.timeout = timeout
+
+    def _encode(self, spans: List[Span]) -> Dict[str, Any]:
+        encoded = []
+        for span in spans:
+            start_ns = int(span.start_time * 1e9)
+            item = {
+                "traceId": span.trace_id,
+                "spanId": span.span_id,
+                "name": span.name,
+                "kind": _SPAN_KINDS.get(span.kind, 1),
+                "startTimeUnixNano": str(start_ns),
+                "endTimeUnixNano": str(start_ns + int((span.duration_ms or 0) * 1e6)),
+                "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in span.attributes.items()],
+                "status": {"code": 2, "message": span.error} if span.status == "error" else {"code": 1},
+            }
+            if span.parent_id:
+                item["parentSpanId"] = span.parent_id
+            encoded.append(item)
+        return {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": self.service_name}}]},
+                "scopeSpans": [{"scope": {"name": "tracing"}, "spans": encoded}],
+            }]
+        }
+
+    def export(self, spans: List[Span]) -> None:
+        body = json.dumps(self._encode(spans), ensure_ascii=False).encode("utf-8")
+        request = urllib.request.Request(self.endpoint, data=body, method="POST",
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            response.read()
+
+
+class BatchSpanProcessor:
+    """后台线程批量导出结束的 span，请求线程只做入队；队列满时丢弃并计数"""
+
+    def __init__(self, exporter, max_batch: int = 256, interval: float = 2.0, max_queue: int = 4096):
+        self.exporter = exporter
+        self.max_batch = max_batch
+        self.interval = interval
+        self.dropped = 0
+        self._queue: "queue.Queue[Span]" = queue.Queue(maxsize=max_queue)
+        self._flush_lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def on_end(self, span: Span) -> None:
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def _drain(self) -> List[Span]:
+        batch = []
+        while len(batch) < self.max_batch:
+            try:
+                batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self) -> None:
+        """导出队列中的全部 span"""
+        with self._flush_lock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    return
+                try:
+                    self.exporter.export(batch)
+                except Exception as e:
+                    logger.warning(f"导出 {len(batch)} 个span失败: {e}")
+
+    def _run(self) -> None:
+        while not self._stopped.wait(self.interval):
+            self.flush()
+
+    def shutdown(self) -> None:
+        self._stopped.set()
+        self.flush()
+
+
+class Tracer:
+    """创建 span 并把结束的 span 交给导出处理器；processor 为 None 时只计时不导出"""
+
+    def __init__(self, processor: Optional[BatchSpanProcessor] = None, sample_rate: float = 1.0):
+        self.processor = processor
+        self.sample_rate = sample_rate
+
+    @classmethod
+    def from_config(cls) -> "Tracer":
+        exporter_name = Config.TRACE_EXPORTER.lower()
+        if exporter_name not in TRACE_EXPORTERS:
+            raise ValueError(f"不支持的追踪导出方式: {Config.TRACE_EXPORTER}，可选: {', '.join(TRACE_EXPORTERS)}")
+        exporter = None
+        if exporter_name == "jsonl":
+            exporter = JsonlSpanExporter()
+        elif exporter_name == "otlp":
+            exporter = OtlpHttpSpanExporter()
+        processor = BatchSpanProcessor(exporter) if exporter else None
+        return cls(processor, sample_rate=Config.TRACE_SAMPLE_RATE)
+
+    def start_span(self, name: str, kind: str = "internal", parent: Optional[Span] = None,
+                   remote_parent: Optional[Tuple[str, str, bool]] = None, **attributes) -> Span:
+        """
+        创建并开始一个 span，但不设为当前 span（用于在回调中开始、在另一个回调中结束的操作）
+
+        parent 默认取当前上下文中的 span；remote_parent 为上游 traceparent 解析结果
+        """
+        parent = parent if parent is not None else current_span()
+        if parent is not None:
+            return Span(self, name, parent.trace_id, parent.span_id, parent.sampled, kind, attributes)
+        if remote_parent is not None:
+            trace_id, parent_id, sampled = remote_parent
+            return Span(self, name, trace_id, parent_id, sampled, kind, attributes)
+        sampled = self.sample_rate >= 1.0 or random.random() < self.sample_rate
+        return Span(self, name, _new_trace_id(), None, sampled, kind, attributes)
+
+    @contextmanager
+    def span(self, name: str, kind: str = "internal", remote_parent: Optional[Tuple[str, str, bool]] = None,
+             **attributes) -> Iterator[Span]:
+        """在上下文中开始一个 span 并设为当前 span，退出时结束；异常会记录在 span 上并继续抛出"""
+        span = self.start_span(name, kind=kind, remote_parent=remote_parent, **attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_error(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def _finish(self, span: Span) -> None:
+        if self.processor is not None and span.sampled:
+            self.processor.on_end(span)
+
+    def flush(self) -> None:
+        if self.processor is not None:
+            self.processor.flush()
+
+    def shutdown(self) -> None:
+        if self.processor is not None:
+            self.processor.shutdown()
+
+
+tracer = Tracer.from_config()
+atexit.register(tracer.shutdown)
+
+
+def span(name: str, kind: str = "internal", remote_parent: Optional[Tuple[str, str, bool]] = None, **attributes):
+    """全局追踪器的 span 上下文管理器"""
+    return tracer.span(name, kind=kind, remote_parent=remote_parent, **attributes)
+
+
+def start_span(name: str, kind: str = "internal", parent: Optional[Span] = None, **attributes) -> Span:
+    """用全局追踪器开始一个 span（需手动调用 end）"""
+    return tracer.start_span(name, kind=kind, parent=parent, **attributes)
+
+
+# ---------------------------------------------------------------------------
+# 命令行：汇总最慢的请求
+# ---------------------------------------------------------------------------
+
+def load_spans(path: str) -> List[Dict[str, Any]]:
+    """读取 JSONL 导出文件，跳过损坏的行（如进程退出时写了一半）"""
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                spans.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return spans
+
+
+def group_traces(spans: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """按 trace_id 分组，每个 trace 以最早开始的根 span 的耗时作为总耗时，按总耗时从高到低排序"""
+    by_trace: Dict[str, List[Dict[str, Any]]] = {}
+    for item in spans:
+        by_trace.setdefault(item["trace_id"], []).append(item)
+
+    traces = []
+    for trace_id, items in by_trace.items():
+        ids = {item["span_id"] for item in items}
+        roots = [item for item in items if item.get("parent_id") not in ids]
+        root = min(roots or items, key=lambda item: item["start_time"])
+        traces.append({"trace_id": trace_id, "root": root, "spans": items,
+                       "duration_ms": root.get("duration_ms") or 0.0})
+    traces.sort(key=lambda trace: trace["duration_ms"], reverse=True)
+    return traces
+
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def stage_breakdown(spans: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
+    """按 span 名称统计次数与 p50/p95/最大耗时"""
+    durations: Dict[str, List[float]] = {}
+    for item in spans:
+        if item.get("duration_ms") is not None:
+            durations.setdefault(item["name"], []).append(item["duration_ms"])
+    return {
+        name: {"count": len(values), "p50_ms": _percentile(values, 50),
+               "p95_ms": _percentile(values, 95), "max_ms": max(values)}
+        for name, values in durations.items()
+    }
+
+
+# 树形输出中展示的属性
+_SUMMARY_ATTRIBUTES = ("http.status_code", "retrieval.k", "retrieval.strategy", "retrieval.documents",
+                       "llm.model", "llm.prompt_tokens", "llm.completion_tokens", "qa.condensed")
+
+
+def format_trace(trace: Dict[str, Any]) -> List[str]:
+    """把一个 trace 格式化为缩进的调用树"""
+    children: Dict[Optional[str], List[Dict[str, Any]]] = {}
+    for item in trace["spans"]:
+        children.setdefault(item.get("parent_id"), []).append(item)
+    for items in children.values():
+        items.sort(key=lambda item: item["start_time"])
+
+    lines = []
+    root_start = trace["root"]["start_time"]
+
+    def walk(item, depth):
+        attributes = item.get("attributes") or {}
+        details = " ".join(f"{key.split('.', 1)[-1]}={attributes[key]}"
+                           for key in _SUMMARY_ATTRIBUTES if key in attributes)
+        error = f" ERROR {item['error']}" if item.get("status") == "error" else ""
+        offset = (item["start_time"] - root_start) * 1000
+        lines.append(f"{'  ' * depth}{item['name']:<{max(1, 32 - 2 * depth)}} "
+                     f"{item.get('duration_ms') or 0:9.1f} ms  (+{offset:.1f} ms) {details}{error}".rstrip())
+        for child in children.get(item["span_id"], []):
+            walk(child, depth + 1)
+
+    walk(trace["root"], 0)
+    return lines
+
+
+def summarize(path: str, top: int = 10, name: Optional[str] = None) -> None:
+    """打印最慢的 trace 调用树及各阶段耗时分布"""
+    spans = load_spans(path)
+    traces = group_traces(spans)
+    if name:
+        traces = [trace for trace in traces if trace["root"]["name"] == name]
+    if not traces:
+        print("没有找到 trace")
+        return
+
+    print(f"共 {len(traces)} 个 trace，{len(spans)} 个 span；最慢的 {min(top, len(traces))} 个：\n")
+    for trace in traces[:top]:
+        print(f"trace {trace['trace_id']}  {trace['duration_ms']:.1f} ms")
+        for line in format_trace(trace):
+            print("  " + line)
+        print()
+
+    trace_ids = {trace["trace_id"] for trace in traces}
+    breakdown = stage_breakdown([item for item in spans if item["trace_id"] in trace_ids])
+    print(f"{'span':<32} {'次数':>6} {'p50(ms)':>10} {'p95(ms)':>10} {'max(ms)':>10}")
+    for span_name, stats in sorted(breakdown.items(), key=lambda pair: pair[1]["p95_ms"], reverse=True):
+        print(f"{span_name:<32} {stats['count']:>6} {stats['p50_ms']:>10.1f} "
+              f"{stats['p95_ms']:>10.1f} {stats['max_ms']:>10.1f}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="链路追踪工具")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summarize", help="汇总 JSONL 导出文件中最慢的请求")
+    summary_parser.add_argument("path", nargs="?", default=Config.TRACE_FILE, help="JSONL 文件路径")
+    summary_parser.add_argument("--top", type=int, default=10, help="显示的 trace 数量")
+    summary_parser.add_argument("--name", help="只看根 span 为该名称的 trace，如 \"POST /ask\"")
+    args = parser.parse_args()
+
+    if args.command == "summarize":
+        summarize(args.path, top=args.top, name=args.name)
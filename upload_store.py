@@ -0,0 +1,105 @@
+"""
+上传文件存储模块
+把上传文件按块异步写入临时文件，同时计算 SHA-256 并检查大小上限，写完后按内容哈希
+原子地移动到上传目录。同名文件不会互相覆盖，相同内容只保存一份，后续处理只通过路径和哈希交接
+"""
+
+import os
+import uuid
+import hashlib
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+from fastapi import UploadFile
+from starlette.concurrency import run_in_threadpool
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# 每次从请求中读取并写盘的块大小
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class UploadTooLargeError(Exception):
+    """上传文件超过大小上限"""
+
+    def __init__(self, file_name: str, max_bytes: int):
+        super().__init__(f"文件 {file_name} 超过大小上限 {max_bytes // (1024 * 1024)} MB")
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+
+
+@dataclass
+class StoredUpload:
+    """已落盘的上传文件"""
+    path: str
+    sha256: str
+    size: int
+    file_name: str  # 客户端提供的原始文件名，只作为元数据使用
+
+
+class UploadStore:
+    """内容寻址的上传文件存储"""
+
+    def __init__(self, upload_dir: str = None, max_bytes: int = None):
+        self.upload_dir = upload_dir or Config.UPLOAD_DIR
+        self.max_bytes = max_bytes if max_bytes is not None else Config.MAX_FILE_SIZE * 1024 * 1024
+        self.incoming_dir = os.path.join(self.upload_dir, ".incoming")
+        os.makedirs(self.incoming_dir, exist_ok=True)
+
+    def path_for(self, sha256: str, suffix: str) -> str:
+        """内容哈希对应的存储路径，按哈希前两位分目录"""
+        return os.path.join(self.upload_dir, sha256[:2], f"{sha256}{suffix}")
+
+    async def save(self, upload: UploadFile) -> StoredUpload:
+        """
+        分块保存上传文件
+
+        Raises:
+            UploadTooLargeError: 文件超过大小上限，已写入的临时文件会被删除
+        """
+        file_name = Path(upload.filename or "upload").name
+        suffix = Path(file_name).suffix.lower()
+
+        # 已知大小（multipart 已解析）时直接拒绝，不再读取内容
+        if upload.size is not None and self.max_bytes and upload.size > self.max_bytes:
+            raise UploadTooLargeError(file_name, self.max_bytes)
+
+        temp_path = os.path.join(self.incoming_dir, f"{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(temp_path, "wb") as buffer:
+                while True:
+                    chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if self.max_bytes and size > self.max_bytes:
+                        raise UploadTooLargeError(file_name, self.max_bytes)
+                    digest.update(chunk)
+                    await run_in_threadpool(buffer.write, chunk)
+
+            sha256 = digest.hexdigest()
+            final_path = self.path_for(sha256, suffix)
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            if os.path.exists(final_path):
+                # 相同内容已经存在，丢弃临时文件
+                os.unlink(temp_path)
+            else:
+                os.replace(temp_path, final_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
+            raise
+        finally:
+            await upload.close()
+
+        logger.info(f"上传文件 {file_name} 已保存: {final_path} ({size} 字节)")
+        return StoredUpload(path=final_path, sha256=sha256, size=size, file_name=file_name)
+
+    def find(self, sha256: str, suffix: str) -> Optional[str]:
+        """按内容哈希查找已保存的文件"""
+        path = self.path_for(sha256, suffix)
+        return path if os.path.exists(path) else None
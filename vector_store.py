@@ -1,5 +1,11 @@
 import os
+import re
+import time
+import uuid
+import threading
+import hashlib
 import chromadb
+from contextlib import contextmanager
 from chromadb.config import Settings
 from langchain.vectorstores import Chroma
 from langchain.embeddings import HuggingFaceEmbeddings
@@ -7,13 +13,119 @@ from langchain.schema import Document
 from typing import List, Dict, Any, Optional
 import logging
 from config import Config
+from retrieval import select_candidates
+from reranker import get_reranker
+from source_store import SourceStore
+from metrics import timed
+from tracing import span
 
 logger = logging.getLogger(__name__)
 
+# Chroma 集合名要求：3-63 个字符，字母数字开头结尾，中间可含 . _ -
+_VALID_COLLECTION_NAME = re.compile(r'^[a-zA-Z0-9][a-zA-Z0-9._-]{1,61}[a-zA-Z0-9]$')
+
+
+class CollectionNotFoundError(ValueError):
+    """读取的集合不存在（读取路径不会自动创建集合）"""
+
+    def __init__(self, collection_name: str):
+        super().__init__(f"集合不存在: {collection_name}")
+        self.collection_name = collection_name
+
+
+class _ExistingChroma(Chroma):
+    """
+    包装已存在的 chromadb 集合
+
+    LangChain 的 Chroma 构造时总会执行 get-or-create，读取路径改用 client.get_collection 取得集合后
+    在此包装，不会创建集合或改写集合元数据
+    """
+
+    def __init__(self, client, collection, embedding_function, persist_directory: str):
+        self._client = client
+        self._client_settings = None
+        self._collection = collection
+        self._embedding_function = embedding_function
+        self._persist_directory = persist_directory
+        self.override_relevance_score_fn = None
+
+
+class _IndexGeneration:
+    """
+    一次打开的Chroma客户端及其集合缓存
+
+    只读模式下重新加载索引时换成新的一代，旧的一代在其上的读取全部结束后关闭（停止其 System，
+    释放 SQLite 连接和内存中的向量索引）
+    """
+
+    def __init__(self, client):
+        self.client = client
+        # 清除 System 缓存后无法再通过客户端取得 System，创建时先保存
+        self.system = client._system
+        # 按集合名缓存的Chroma实例，共享同一个客户端和嵌入模型
+        self.collections: Dict[str, Chroma] = {}
+        self.readers = 0
+        self.retired = False
+
+    def close(self) -> None:
+        try:
+            self.system.stop()
+        except Exception as e:
+            logger.warning(f"关闭旧的向量索引失败: {e}")
+
+
+def normalize_collection_name(name: str) -> str:
+    """将课程/租户名转换为合法的Chroma集合名（中文等非法名称使用哈希）"""
+    name = name.strip()
+    if _VALID_COLLECTION_NAME.match(name) and '..' not in name:
+        return name
+    return "c_" + hashlib.sha1(name.encode('utf-8')).hexdigest()[:16]
+
+
+def build_metadata_filter(filters: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    将简单的键值过滤条件转换为Chroma的where表达式
+
+    Args:
+        filters: 如 {"file_type": ".pdf", "file_name": ["a.pdf", "b.pdf"]}，
+                 列表值表示匹配其中任意一个；以 $ 开头的键视为原生Chroma表达式直接透传
+
+    Returns:
+        Chroma where 字典，没有有效条件时返回 None
+    """
+    if not filters:
+        return None
+    if any(key.startswith('$') for key in filters):
+        return filters
+
+    conditions = []
+    for key, value in filters.items():
+        if value is None or value == "" or value == []:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            conditions.append({key: {"$in": list(value)}})
+        else:
+            conditions.append({key: value})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
 class VectorStore:
-    def __init__(self, persist_directory: str = None, embedding_model: str = None):
+    def __init__(self, persist_directory: str = None, embedding_model: str = None,
+                 collection_name: str = None, source_store: SourceStore = None,
+                 read_only: bool = False):
+        """
+        Args:
+            read_only: 只读模式（多进程部署下的 API 工作进程）：不写入索引，
+                       入库进程更新索引版本后在下一次访问时重新加载
+        """
         self.persist_directory = persist_directory or Config.CHROMA_PERSIST_DIRECTORY
         self.embedding_model = embedding_model or Config.EMBEDDING_MODEL
+        self.collection_name = normalize_collection_name(collection_name or Config.DEFAULT_COLLECTION)
         
         # 确保目录存在
         os.makedirs(self.persist_directory, exist_ok=True)
@@ -41,83 +153,468 @@ class VectorStore:
             )
         
         # 初始化向量数据库
-        self.vectorstore = Chroma(
-            persist_directory=self.persist_directory,
-            embedding_function=self.embeddings,
-            client_settings=Settings(
+        self.read_only = read_only
+        self._index_version = None
+        self._next_version_check = 0.0
+        self._reload_lock = threading.Lock()
+        if self.read_only:
+            from shared_state import get_shared_store
+            self._index_version = get_shared_store().index_version()
+        self._open_client()
+        
+        # 文档块原文与出处存储，按块ID提供引用原文
+        self.source_store = source_store or SourceStore()
+        
+        logger.info(f"向量存储初始化完成，持久化目录: {self.persist_directory}，默认集合: {self.collection_name}"
+                    f"{'（只读）' if self.read_only else ''}")
+    
+    def _open_client(self) -> None:
+        """打开Chroma客户端（集合缓存为空的新一代）；可写时确保默认集合存在"""
+        self._generation = _IndexGeneration(chromadb.PersistentClient(
+            path=self.persist_directory,
+            settings=Settings(
                 anonymized_telemetry=False,
                 allow_reset=True
             )
-        )
+        ))
+        if not self.read_only:
+            self.get_collection(create=True)
+    
+    @property
+    def _client(self):
+        return self._generation.client
+    
+    @property
+    def _collections(self) -> Dict[str, Chroma]:
+        return self._generation.collections
+    
+    @contextmanager
+    def _reading(self):
+        """
+        读取期间固定使用当前这一代索引，期间重新加载也不会关闭它；
+        读取结束时如果它已被替换且没有其他读取，随即关闭
+        """
+        self.refresh_if_stale()
+        with self._reload_lock:
+            generation = self._generation
+            generation.readers += 1
+        try:
+            yield generation
+        finally:
+            with self._reload_lock:
+                generation.readers -= 1
+                close = generation.retired and generation.readers == 0
+            if close:
+                generation.close()
+    
+    def refresh_if_stale(self) -> bool:
+        """
+        只读模式下检查共享的索引版本（每 INDEX_CHECK_INTERVAL 秒最多一次），
+        入库进程写入过新数据时重新加载索引，返回是否重新加载
+        
+        Chroma 本地模式把向量索引加载在进程内存中，其他进程写入的数据要重新打开客户端才能看到；
+        嵌入模型保持不变，正在进行的检索继续使用旧的客户端直至完成，之后关闭旧客户端
+        """
+        if not self.read_only or time.monotonic() < self._next_version_check:
+            return False
+        with self._reload_lock:
+            if time.monotonic() < self._next_version_check:
+                return False
+            self._next_version_check = time.monotonic() + Config.INDEX_CHECK_INTERVAL
+            from shared_state import get_shared_store
+            version = get_shared_store().index_version()
+            if version == self._index_version:
+                return False
+            # 同一路径的客户端在进程内共用一个 System，需先清除缓存才能重新从磁盘加载；
+            # 在锁内整体替换客户端和集合缓存，并发读取不会把旧客户端的集合放进新的缓存
+            from chromadb.api.client import SharedSystemClient
+            previous = self._generation
+            SharedSystemClient.clear_system_cache()
+            self._open_client()
+            previous.retired = True
+            close = previous.readers == 0
+            logger.info(f"索引版本 {self._index_version} -> {version}，已重新加载向量索引")
+            self._index_version = version
+        if close:
+            previous.close()
+        return True
+    
+    def _check_writable(self) -> None:
+        if self.read_only:
+            raise RuntimeError("只读模式下不能修改索引，写操作需提交给入库进程")
+    
+    def get_collection(self, collection_name: Optional[str] = None, create: bool = False,
+                       generation: Optional[_IndexGeneration] = None) -> Chroma:
+        """
+        获取指定名称的集合，未指定时返回默认集合
+        
+        只有写入路径（create=True）会创建不存在的集合；读取不存在的集合时抛出 CollectionNotFoundError，
+        拼错的集合名不会被自动创建为空集合。generation 为读取期间固定使用的那一代索引
+        """
+        if generation is None:
+            self.refresh_if_stale()
+            generation = self._generation
+        name = normalize_collection_name(collection_name) if collection_name else self.collection_name
+        collection = generation.collections.get(name)
+        if collection is not None:
+            return collection
         
-        logger.info(f"向量存储初始化完成，持久化目录: {self.persist_directory}")
+        if create:
+            self._check_writable()
+            collection = Chroma(
+                collection_name=name,
+                embedding_function=self.embeddings,
+                client=generation.client,
+                persist_directory=self.persist_directory,
+                collection_metadata={"display_name": collection_name.strip()} if collection_name else None
+            )
+        else:
+            try:
+                existing = generation.client.get_collection(name, embedding_function=None)
+            except ValueError:
+                raise CollectionNotFoundError(collection_name or name)
+            collection = _ExistingChroma(generation.client, existing, self.embeddings, self.persist_directory)
+        generation.collections[name] = collection
+        logger.info(f"打开集合: {collection_name or name} ({name})")
+        return collection
     
-    def add_documents(self, documents: List[Document]) -> None:
-        """添加文档到向量存储"""
+    def _read_collection(self, collection_name: Optional[str], generation: _IndexGeneration) -> Optional[Chroma]:
+        """
+        读取路径使用的集合：只读模式下入库进程尚未创建默认集合时返回 None（知识库为空），
+        指定的集合不存在时抛出 CollectionNotFoundError
+        """
+        try:
+            return self.get_collection(collection_name, generation=generation)
+        except CollectionNotFoundError:
+            if collection_name and normalize_collection_name(collection_name) != self.collection_name:
+                raise
+            return None
+    
+    def list_collections(self) -> List[Dict[str, Any]]:
+        """列出所有集合及其文档数"""
+        try:
+            collections = []
+            with self._reading() as generation:
+                for collection in generation.client.list_collections():
+                    metadata = collection.metadata or {}
+                    collections.append({
+                        "name": collection.name,
+                        "display_name": metadata.get("display_name", collection.name),
+                        "total_documents": collection.count()
+                    })
+            return collections
+        except Exception as e:
+            logger.error(f"列出集合失败: {e}")
+            return []
+    
+    def as_retriever(self, k: int = 4, collection_name: Optional[str] = None,
+                     metadata_filter: Optional[Dict[str, Any]] = None):
+        """创建限定集合与元数据过滤条件的检索器"""
+        search_kwargs = {"k": k}
+        where = build_metadata_filter(metadata_filter)
+        if where:
+            search_kwargs["filter"] = where
+        return self.get_collection(collection_name).as_retriever(
+            search_type="similarity",
+            search_kwargs=search_kwargs
+        )
+    
+    def add_documents(self, documents: List[Document], collection_name: Optional[str] = None) -> None:
+        """
+        添加文档到向量存储
+        
+        编码（embed）与写入持久化（persist）分两步执行，分别计入阶段耗时指标
+        """
         if not documents:
             logger.warning("没有文档需要添加")
             return
+        self._check_writable()
         
         try:
-            # 添加文档到向量存储
-            self.vectorstore.add_documents(documents)
+            collection = self.get_collection(collection_name, create=True)
+            
+            # 带 chunk_id 的块以其为ID，重复导入同一文件时覆盖而不是重复
+            ids = [doc.metadata.get("chunk_id") for doc in documents]
+            if not all(ids):
+                ids = [str(uuid.uuid4()) for _ in documents]
+            self._delete_replaced_documents(collection, documents, ids)
+            texts = [doc.page_content for doc in documents]
+            
+            with timed("embed", items=len(texts)):
+                embeddings = self.embeddings.embed_documents(texts)
             
-            # 持久化到磁盘
-            self.vectorstore.persist()
+            with timed("persist", items=len(texts)):
+                collection._collection.upsert(
+                    ids=ids,
+                    embeddings=embeddings,
+                    metadatas=[doc.metadata or None for doc in documents],
+                    documents=texts
+                )
+                # 持久化到磁盘
+                collection.persist()
+                self.source_store.add_chunks(documents, collection._collection.name)
             
             logger.info(f"成功添加 {len(documents)} 个文档到向量存储")
         except Exception as e:
             logger.error(f"添加文档到向量存储失败: {e}")
             raise
     
-    def similarity_search(self, query: str, k: int = 4) -> List[Document]:
+    def _delete_replaced_documents(self, collection: Chroma, documents: List[Document], ids: List[str]) -> None:
+        """
+        删除集合中同一文档（相同 doc_id）旧版本的块
+        
+        上传文件按内容哈希存储，修改后重新上传的文件块ID会变化，upsert 不会覆盖旧版本的块；
+        只有调用方通过 doc_id 明确指定文档身份时才替换，同名的不同文件互不影响
+        """
+        doc_ids = {doc.metadata["doc_id"] for doc in documents if doc.metadata.get("doc_id")}
+        new_ids = set(ids)
+        for doc_id in doc_ids:
+            stale_ids = [chunk_id for chunk_id in collection._collection.get(where={"doc_id": doc_id}, include=[])["ids"]
+                         if chunk_id not in new_ids]
+            if stale_ids:
+                collection._collection.delete(ids=stale_ids)
+                self.source_store.delete_chunks(stale_ids, collection._collection.name)
+                logger.info(f"已删除文档 {doc_id} 旧版本的 {len(stale_ids)} 个文档块")
+    
+    def similarity_search(self, query: str, k: int = 4, collection_name: Optional[str] = None,
+                          metadata_filter: Optional[Dict[str, Any]] = None) -> List[Document]:
         """相似性搜索"""
         try:
-            results = self.vectorstore.similarity_search(query, k=k)
+            with self._reading() as generation:
+                collection = self._read_collection(collection_name, generation)
+                if collection is None:
+                    return []
+                results = collection.similarity_search(
+                    query, k=k, filter=build_metadata_filter(metadata_filter)
+                )
             logger.info(f"相似性搜索完成，返回 {len(results)} 个结果")
             return results
+        except CollectionNotFoundError:
+            raise
         except Exception as e:
             logger.error(f"相似性搜索失败: {e}")
             return []
     
-    def similarity_search_with_score(self, query: str, k: int = 4) -> List[tuple]:
+    def similarity_search_with_score(self, query: str, k: int = 4, collection_name: Optional[str] = None,
+                                     metadata_filter: Optional[Dict[str, Any]] = None) -> List[tuple]:
         """带分数的相似性搜索"""
         try:
-            results = self.vectorstore.similarity_search_with_score(query, k=k)
+            with self._reading() as generation:
+                collection = self._read_collection(collection_name, generation)
+                if collection is None:
+                    return []
+                results = collection.similarity_search_with_score(
+                    query, k=k, filter=build_metadata_filter(metadata_filter)
+                )
             logger.info(f"带分数的相似性搜索完成，返回 {len(results)} 个结果")
             return results
+        except CollectionNotFoundError:
+            raise
         except Exception as e:
             logger.error(f"带分数的相似性搜索失败: {e}")
             return []
     
-    def get_collection_stats(self) -> Dict[str, Any]:
+    def _query_candidates(self, query_embeddings: List[List[float]], n_results: int,
+                          collection_name: Optional[str] = None,
+                          metadata_filter: Optional[Dict[str, Any]] = None,
+                          include_embeddings: bool = False) -> List[List[tuple]]:
+        """按查询向量批量召回候选，返回每个查询的 (文档, 距离, 嵌入向量) 列表"""
+        include = ["documents", "metadatas", "distances"]
+        if include_embeddings:
+            include.append("embeddings")
+        
+        with self._reading() as generation:
+            collection = self._read_collection(collection_name, generation)
+            if collection is None:
+                return [[] for _ in query_embeddings]
+            results = collection._collection.query(
+                query_embeddings=query_embeddings,
+                n_results=n_results,
+                where=build_metadata_filter(metadata_filter),
+                include=include
+            )
+        
+        batches = []
+        for i in range(len(query_embeddings)):
+            embeddings = results["embeddings"][i] if include_embeddings else None
+            candidates = []
+            for j, (content, metadata, distance) in enumerate(zip(
+                results["documents"][i], results["metadatas"][i], results["distances"][i]
+            )):
+                doc = Document(page_content=content, metadata=metadata or {})
+                candidates.append((doc, distance, embeddings[j] if embeddings is not None else None))
+            batches.append(candidates)
+        return batches
+    
+    def retrieve(self, query: str, k: int = 4, strategy: str = "similarity", fetch_k: int = 20,
+                 lambda_mult: float = 0.5, score_threshold: Optional[float] = None,
+                 collection_name: Optional[str] = None,
+                 metadata_filter: Optional[Dict[str, Any]] = None,
+                 rerank: bool = False, rerank_top_n: Optional[int] = None) -> List[tuple]:
+        """
+        按检索策略搜索文档
+        
+        Args:
+            query: 查询文本
+            k: 返回数量
+            strategy: similarity（相似度）/ mmr（最大边际相关性）/ threshold（相似度+最低分数）
+            fetch_k: MMR 第一阶段召回的候选数量（同时重排序时至少为参与重排序候选数的两倍）
+            lambda_mult: MMR 相关性与多样性的权衡系数
+            score_threshold: 最低相关度（余弦相似度，0-1）
+            collection_name: 集合名
+            metadata_filter: 元数据过滤条件
+            rerank: 是否使用交叉编码器重排序（先按策略选出 rerank_top_n 个候选，再重排保留 k 个）
+            rerank_top_n: 参与重排序的候选数量
+        
+        Returns:
+            (文档, 距离) 列表；重排序时交叉编码器分数写入文档元数据 rerank_score
+        """
+        try:
+            with timed("retrieve", items=1), \
+                    span("vector_store.retrieve", **{"retrieval.k": k, "retrieval.strategy": strategy,
+                                                     "retrieval.fetch_k": fetch_k,
+                                                     "retrieval.collection": collection_name}) as current:
+                query_embedding = self.embeddings.embed_query(query)
+                results = self._retrieve_by_embeddings(
+                    [query], [query_embedding], k=k, strategy=strategy, fetch_k=fetch_k,
+                    lambda_mult=lambda_mult, score_threshold=score_threshold,
+                    collection_name=collection_name, metadata_filter=metadata_filter,
+                    rerank=rerank, rerank_top_n=rerank_top_n
+                )[0]
+                current.set_attribute("retrieval.documents", len(results))
+            logger.info(f"检索完成（策略: {strategy}），返回 {len(results)} 个结果")
+            return results
+        except ValueError:
+            raise
+        except Exception as e:
+            logger.error(f"检索失败: {e}")
+            return []
+    
+    def batch_retrieve(self, queries: List[str], k: int = 4, strategy: str = "similarity",
+                       fetch_k: int = 20, lambda_mult: float = 0.5,
+                       score_threshold: Optional[float] = None,
+                       collection_name: Optional[str] = None,
+                       metadata_filter: Optional[Dict[str, Any]] = None,
+                       rerank: bool = False, rerank_top_n: Optional[int] = None) -> List[List[tuple]]:
+        """
+        批量检索：所有查询一次性编码，并通过一次多查询向量检索召回候选
+        
+        参数含义与 retrieve 相同，返回与 queries 顺序一致的 (文档, 距离) 列表
+        """
+        if not queries:
+            return []
+        
+        with timed("retrieve", items=len(queries)), \
+                span("vector_store.batch_retrieve", **{"retrieval.k": k, "retrieval.strategy": strategy,
+                                                       "retrieval.queries": len(queries),
+                                                       "retrieval.collection": collection_name}):
+            query_embeddings = self.embeddings.embed_documents(queries)
+            results = self._retrieve_by_embeddings(
+                queries, query_embeddings, k=k, strategy=strategy, fetch_k=fetch_k,
+                lambda_mult=lambda_mult, score_threshold=score_threshold,
+                collection_name=collection_name, metadata_filter=metadata_filter,
+                rerank=rerank, rerank_top_n=rerank_top_n
+            )
+        logger.info(f"批量检索完成（策略: {strategy}），共 {len(queries)} 个查询")
+        return results
+    
+    def _retrieve_by_embeddings(self, queries: List[str], query_embeddings: List[List[float]],
+                                k: int, strategy: str, fetch_k: int, lambda_mult: float,
+                                score_threshold: Optional[float], collection_name: Optional[str],
+                                metadata_filter: Optional[Dict[str, Any]], rerank: bool,
+                                rerank_top_n: Optional[int]) -> List[List[tuple]]:
+        """对已编码的查询执行召回、策略选择和可选的重排序"""
+        use_mmr = strategy == "mmr"
+        select_k = max(rerank_top_n or Config.RERANK_TOP_N, k) if rerank else k
+        n_results = select_k
+        if use_mmr:
+            # 同时重排序时 MMR 要从候选中选出 select_k 个交给重排序；候选池不比它大时 MMR 不起作用，
+            # 因此至少召回 select_k 的两倍
+            n_results = max(fetch_k, 2 * select_k if rerank else select_k)
+        batches = self._query_candidates(
+            query_embeddings,
+            n_results=n_results,
+            collection_name=collection_name,
+            metadata_filter=metadata_filter,
+            include_embeddings=use_mmr
+        )
+        
+        results = []
+        for query, query_embedding, candidates in zip(queries, query_embeddings, batches):
+            selected = select_candidates(
+                query_embedding, candidates,
+                strategy=strategy, k=select_k, lambda_mult=lambda_mult, score_threshold=score_threshold
+            )
+            if rerank:
+                selected = self._rerank(query, selected, k)
+            results.append(selected)
+        return results
+    
+    def _rerank(self, query: str, results: List[tuple], k: int) -> List[tuple]:
+        """用交叉编码器对 (文档, 距离) 列表重排序，保留前 k 个"""
+        distances = {id(doc): distance for doc, distance in results}
+        with timed("rerank", items=len(results)), \
+                span("rerank", **{"rerank.candidates": len(results), "retrieval.k": k}):
+            reranked = get_reranker().rerank(query, [doc for doc, _ in results], top_k=k)
+        output = []
+        for doc, score in reranked:
+            if score is not None:
+                doc.metadata["rerank_score"] = score
+            output.append((doc, distances[id(doc)]))
+        return output
+    
+    def get_collection_stats(self, collection_name: Optional[str] = None) -> Dict[str, Any]:
         """获取集合统计信息"""
         try:
-            collection = self.vectorstore._collection
-            count = collection.count()
-            return {
-                "total_documents": count,
-                "persist_directory": self.persist_directory,
-                "embedding_model": self.embedding_model
-            }
+            with self._reading() as generation:
+                collection = self._read_collection(collection_name, generation)
+                return {
+                    "total_documents": collection._collection.count() if collection is not None else 0,
+                    "persist_directory": self.persist_directory,
+                    "embedding_model": self.embedding_model,
+                    "collection": collection._collection.name if collection is not None else self.collection_name
+                }
+        except CollectionNotFoundError:
+            raise
         except Exception as e:
             logger.error(f"获取集合统计信息失败: {e}")
             return {}
     
-    def delete_collection(self) -> bool:
-        """删除整个集合"""
+    def delete_collection(self, collection_name: Optional[str] = None) -> bool:
+        """
+        删除整个集合
+        
+        Raises:
+            CollectionNotFoundError: 集合不存在
+        """
+        self._check_writable()
+        collection = self.get_collection(collection_name)
         try:
-            self.vectorstore._collection.delete()
+            name = collection._collection.name
+            collection.delete_collection()
+            self._collections.pop(name, None)
+            self.source_store.delete_collection(name)
+            if name == self.collection_name:
+                # 默认集合删除后立即重建为空集合
+                self._reopen_default_collection()
             logger.info("集合删除成功")
             return True
         except Exception as e:
             logger.error(f"删除集合失败: {e}")
             return False
     
+    def _reopen_default_collection(self) -> None:
+        """清空集合缓存并重新创建默认集合"""
+        self._collections.clear()
+        self.get_collection(create=True)
+    
     def reset(self) -> bool:
         """重置向量存储"""
+        self._check_writable()
         try:
-            self.vectorstore._client.reset()
+            self._client.reset()
+            self._reopen_default_collection()
+            self.source_store.reset()
             logger.info("向量存储重置成功")
             return True
         except Exception as e:
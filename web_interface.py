@@ -33,6 +33,9 @@ def upload_files(files):
             files_data.append(('files', (file.name, file.getvalue(), file.type)))
         
         response = requests.post(f"{API_BASE_URL}/upload", files=files_data)
+        if response.status_code == 413:
+            st.error(response.json().get("detail", "文件过大"))
+            return None
         return response.json() if response.status_code == 200 else None
     except Exception as e:
         st.error(f"上传失败: {str(e)}")